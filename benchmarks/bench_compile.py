@@ -0,0 +1,152 @@
+"""Time and memory profile each stage of compile-models on synthetic data
+served from a local S3 stand-in. Besides the collection stages and
+create_models as a whole, the stages recorded by enclave_mgmt.metrics
+(scrubbing, the lookups, each model builder, validation of each model and
+writing) are listed with their CPU time, rows and peak RSS.
+
+    python -m benchmarks.bench_compile --courses 50 --students 30 \
+        --events 500 --trace_memory
+"""
+import argparse
+import resource
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from unittest.mock import patch
+
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import DATA_BUCKET, EVENTS_BUCKET, generate
+from enclave_mgmt import metrics
+from enclave_mgmt.collect_data import (
+    DEFAULT_MAX_WORKERS, collect_content_dfs, collect_event_data_dfs,
+    collect_moodle_dfs
+)
+from enclave_mgmt.create_models import create_models
+
+
+def max_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def run_stage(name, function, trace_memory):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with metrics.stage(name):
+        result = function()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6 if trace_memory else None
+    print(" ".join([
+        name.ljust(24), f"{seconds:10.3f}",
+        "-".rjust(12) if peak is None else f"{peak:12.1f}",
+        f"{max_rss_mb():12.1f}"
+    ]))
+    return result
+
+
+def format_rows(rows):
+    return "-".rjust(10) if rows is None else f"{rows:10d}"
+
+
+def print_recorded_stages(recorder):
+    print(" ".join([
+        "recorded stage".ljust(48), "wall s".rjust(8), "cpu s".rjust(8),
+        "rows in".rjust(10), "rows out".rjust(10), "peak RSS MB".rjust(12)
+    ]))
+    stages = sorted(
+        recorder.report()["stages"], key=lambda entry: entry["start_seconds"]
+    )
+    for entry in stages:
+        print(" ".join([
+            entry["stage"][:48].ljust(48),
+            f"{entry['wall_seconds']:8.3f}", f"{entry['cpu_seconds']:8.3f}",
+            format_rows(entry["rows_in"]), format_rows(entry["rows_out"]),
+            f"{entry['peak_rss_bytes'] / 1e6:12.1f}"
+        ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compile-models')
+    parser.add_argument('--courses', type=int, default=10)
+    parser.add_argument('--students', type=int, default=30,
+                        help='students per course')
+    parser.add_argument('--events', type=int, default=100,
+                        help='events per student')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data_dir', type=str,
+                        help='keep the generated data in this directory, or '
+                             'reuse it without regenerating when the '
+                             'directory already holds data (the sizing and '
+                             'seed options are then ignored)')
+    parser.add_argument('--max_workers', type=int,
+                        default=DEFAULT_MAX_WORKERS)
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='report the peak Python heap of each stage '
+                             '(slows every stage down)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(args.data_dir or tmp_dir) / "s3"
+        output_dir = Path(tmp_dir) / "output"
+        output_dir.mkdir()
+
+        if (data_dir / DATA_BUCKET).is_dir() and \
+                (data_dir / EVENTS_BUCKET).is_dir():
+            data_bucket, data_prefix, events_bucket, events_prefix = \
+                DATA_BUCKET, "data", EVENTS_BUCKET, "events"
+            print(f"Reusing data in {data_dir}")
+        else:
+            start = time.perf_counter()
+            data_bucket, data_prefix, events_bucket, events_prefix = \
+                generate(
+                    data_dir, args.courses, args.students, args.events,
+                    args.seed
+                )
+            print(f"Generated data in {time.perf_counter() - start:.3f}s")
+
+        s3_client = LocalS3Client(data_dir)
+        if args.trace_memory:
+            tracemalloc.start()
+        print(" ".join([
+            "stage".ljust(24), "seconds".rjust(10), "peak heap MB".rjust(12),
+            "max RSS MB".rjust(12)
+        ]))
+        with metrics.recording() as recorder:
+            with patch("boto3.client", lambda service, **kwargs: s3_client):
+                moodle_dfs = run_stage(
+                    "collect_moodle_dfs",
+                    lambda: collect_moodle_dfs(
+                        data_bucket, data_prefix, args.max_workers
+                    ),
+                    args.trace_memory
+                )
+                content_dfs = run_stage(
+                    "collect_content_dfs",
+                    lambda: collect_content_dfs(data_bucket, data_prefix),
+                    args.trace_memory
+                )
+                event_dfs = run_stage(
+                    "collect_event_data_dfs",
+                    lambda: collect_event_data_dfs(
+                        events_bucket, events_prefix
+                    ),
+                    args.trace_memory
+                )
+            all_raw_dfs = moodle_dfs | content_dfs | event_dfs
+            report = run_stage(
+                "create_models",
+                lambda: create_models(str(output_dir), all_raw_dfs),
+                args.trace_memory
+            )
+
+    print()
+    print_recorded_stages(recorder)
+    print()
+    for entry in report:
+        print(f"{entry['file'].ljust(48)} {entry['rows']:10d} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Compare the memory used by event tables with plain object columns and
+with the compact dtypes applied after ingestion, and the peak memory of
+parsing synthetic events files when the whole table is compacted after it
+is concatenated against compacting each chunk as it is parsed
+
+    python -m benchmarks.bench_memory --rows 1000000 --courses 20 \
+        --students 50 --events 1000
+"""
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import threading
+from pathlib import Path
+
+from benchmarks.example_data import load_example_table
+from benchmarks.synthetic_data import EVENTS_BUCKET, generate
+from enclave_mgmt.collect_data import (
+    EVENT_FILES, compact_event_df, read_compact_events
+)
+from enclave_mgmt.create_models import (
+    MODEL_CONTENT_LOADS, MODEL_IB_INPUT_SUBMISSIONS,
+    MODEL_IB_PSET_PROBLEM_ATTEMPTS
+)
+from enclave_mgmt.parse_events import read_events
+
+EVENT_TABLES = [
+    MODEL_CONTENT_LOADS,
+    MODEL_IB_PSET_PROBLEM_ATTEMPTS,
+    MODEL_IB_INPUT_SUBMISSIONS,
+]
+
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1e6
+
+
+def compact_after_concat(stream, normalize_chunk):
+    return compact_event_df(
+        read_events(stream, normalize_chunk=normalize_chunk)
+    )
+
+
+def compact_per_chunk(stream, normalize_chunk):
+    return read_compact_events(stream, normalize_chunk=normalize_chunk)
+
+
+READERS = {
+    "compact after concat": compact_after_concat,
+    "compact per chunk": compact_per_chunk,
+}
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def parse_peak(reader, path, normalize_chunk, results):
+    """Sample the resident memory of a fresh process while it parses path.
+    ru_maxrss is not used as it keeps the high-water mark of the parent.
+    """
+    baseline = rss_mb()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            peak[0] = max(peak[0], rss_mb())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        with open(path, "rb") as f:
+            df = READERS[reader](f, normalize_chunk)
+    finally:
+        done.set()
+        sampler.join()
+    results.put((max(peak[0], rss_mb()) - baseline, memory_mb(df)))
+
+
+def compare_parse_peaks(courses, students, events):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, _, _, events_prefix = generate(
+            tmp_dir, courses, students, events
+        )
+        events_path = Path(tmp_dir) / EVENTS_BUCKET / events_prefix
+        print(" ".join([
+            "events file".ljust(36), "reader".ljust(22),
+            "peak RSS MB".rjust(12), "table MB".rjust(10)
+        ]))
+        context = multiprocessing.get_context("spawn")
+        for _, file_name, normalize_chunk in EVENT_FILES:
+            for reader in READERS:
+                results = context.Queue()
+                process = context.Process(
+                    target=parse_peak,
+                    args=(reader, events_path / file_name, normalize_chunk,
+                          results)
+                )
+                process.start()
+                peak, table = results.get()
+                process.join()
+                print(" ".join([
+                    file_name.ljust(36), reader.ljust(22), f"{peak:12.1f}",
+                    f"{table:10.1f}"
+                ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark event memory')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='rows per table')
+    parser.add_argument('--courses', type=int, default=20)
+    parser.add_argument('--students', type=int, default=50,
+                        help='students per course')
+    parser.add_argument('--events', type=int, default=1000,
+                        help='events per student for the parse comparison, '
+                             '0 to skip it')
+    args = parser.parse_args()
+
+    print(" ".join([
+        "table".ljust(32), "object MB".rjust(12), "compact MB".rjust(12),
+        "reduction".rjust(10)
+    ]))
+    for file_name in EVENT_TABLES:
+        df = load_example_table(file_name, args.rows)
+        # Example rows are repeated to reach the requested size, so give
+        # each row its own impression like real events
+        df["impression_id"] = df["impression_id"] + df.index.astype(str)
+        before = memory_mb(df)
+        after = memory_mb(compact_event_df(df.copy()))
+        print(" ".join([
+            file_name.ljust(32), f"{before:12.1f}", f"{after:12.1f}",
+            f"{before / after:9.1f}x"
+        ]))
+
+    if args.events > 0:
+        print()
+        compare_parse_peaks(args.courses, args.students, args.events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compare building the models with different numbers of model worker
+threads on synthetic data served from a local S3 stand-in. Validation is
+largely GIL bound so the speedup is limited by how much of each build
+releases the GIL.
+
+    python -m benchmarks.bench_model_workers --courses 50 --students 30 \
+        --events 200 --model_workers 1 4
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
+from enclave_mgmt.collect_data import collect_data
+from enclave_mgmt.cpus import available_cpus
+from enclave_mgmt.create_models import create_models
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark create_models model workers'
+    )
+    parser.add_argument('--courses', type=int, default=50)
+    parser.add_argument('--students', type=int, default=30,
+                        help='students per course')
+    parser.add_argument('--events', type=int, default=200,
+                        help='events per student')
+    parser.add_argument('--model_workers', type=int, nargs='+',
+                        default=[1, available_cpus()])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(tmp_dir) / "s3"
+        buckets = generate(data_dir, args.courses, args.students, args.events)
+        s3_client = LocalS3Client(data_dir)
+        print(f"{available_cpus()} CPUs available")
+        for model_workers in args.model_workers:
+            timings = []
+            for run in range(args.repeat):
+                # create_models scrubs the raw dataframes in place so each
+                # run starts from freshly collected data
+                with patch("boto3.client",
+                           lambda service, **kwargs: s3_client):
+                    all_raw_dfs = collect_data(*buckets)
+                output_dir = Path(tmp_dir) / f"output-{model_workers}-{run}"
+                output_dir.mkdir()
+                start = time.perf_counter()
+                create_models(
+                    str(output_dir), all_raw_dfs, write_workers=1,
+                    model_workers=model_workers
+                )
+                timings.append(time.perf_counter() - start)
+            print(f"model_workers {model_workers:3d} {min(timings):8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
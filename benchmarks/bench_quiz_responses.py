@@ -0,0 +1,76 @@
+"""Compare building the quiz attempt and multichoice response tables with
+index lookups against the chained merges on synthetic Moodle data
+
+    python -m benchmarks.bench_quiz_responses --courses 100 --students 100
+"""
+import argparse
+import tempfile
+import time
+from unittest.mock import patch
+
+import pandas as pd
+
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
+from enclave_mgmt.collect_data import collect_content_dfs, collect_moodle_dfs
+from enclave_mgmt.create_models import (
+    assessment_ids_lookup, lookup_quiz_attempts_and_multichoice_responses,
+    merge_quiz_attempts_and_multichoice_responses, multichoice_answer_model,
+    scrub_raw_dfs, user_uuids_lookup
+)
+from enclave_mgmt.validate_models import Validator, VALIDATION_LEVEL_OFF
+
+BUILDERS = {
+    "merge": merge_quiz_attempts_and_multichoice_responses,
+    "lookup": lookup_quiz_attempts_and_multichoice_responses,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark quiz attempt and response models'
+    )
+    parser.add_argument('--courses', type=int, default=100)
+    parser.add_argument('--students', type=int, default=100,
+                        help='students per course')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_bucket, data_prefix, _, _ = generate(
+            tmp_dir, args.courses, args.students, events=0
+        )
+        s3_client = LocalS3Client(tmp_dir)
+        with patch("boto3.client", lambda service, **kwargs: s3_client):
+            raw_dfs = collect_moodle_dfs(data_bucket, data_prefix) | \
+                collect_content_dfs(data_bucket, data_prefix)
+
+    clean_raw_df = scrub_raw_dfs(raw_dfs)
+    user_uuids = user_uuids_lookup(clean_raw_df)
+    assessment_ids = assessment_ids_lookup(clean_raw_df)
+    answers_df = multichoice_answer_model(
+        clean_raw_df, Validator(level=VALIDATION_LEVEL_OFF)
+    )
+    print(
+        f"{len(clean_raw_df['attempts_summary'])} attempts, "
+        f"{len(clean_raw_df['attempt_multichoice_response'])} responses"
+    )
+
+    results = {}
+    for name, build in BUILDERS.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[name] = build(
+                clean_raw_df, answers_df, user_uuids, assessment_ids
+            )
+            timings.append(time.perf_counter() - start)
+        print(f"{name.ljust(8)} {min(timings):8.3f}s")
+
+    for merged_df, looked_up_df in zip(results["merge"], results["lookup"]):
+        pd.testing.assert_frame_equal(looked_up_df, merged_df)
+    print("outputs identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Compare the scrub stage and grade coercions against the per value Python
+versions they replaced on synthetic Moodle grade and user rows
+
+    python -m benchmarks.bench_scrub --rows 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from enclave_mgmt.create_models import scrub_raw_dfs
+
+
+def raw_tables(rows, seed):
+    rng = np.random.default_rng(seed)
+    percentages = pd.Series(
+        rng.integers(0, 10001, rows) / 100
+    ).map("{:.2f} %".format)
+    graded = rng.random(rows) >= 0.2
+    grades = pd.DataFrame({
+        'user_id': rng.integers(0, rows // 10 + 1, rows),
+        'grade_percentage': percentages.where(graded, '-'),
+        'assessment_name': pd.Series(
+            rng.integers(0, 50, rows)
+        ).map("Quiz {}".format),
+        'course_id': rng.integers(0, 100, rows),
+        'time_submitted': pd.Series(
+            1700000000 + np.arange(rows)
+        ).where(graded),
+    })
+    users = pd.DataFrame({
+        'email': pd.Series(np.arange(rows)).map("User.{}@Example.org".format)
+    })
+    return {'grades': grades, 'moodle_users': users}
+
+
+def python_scrub(all_raw_dfs):
+    """The scrub stage and grade coercions as they were done value by value
+    with apply and map
+    """
+    moodle_users_df = all_raw_dfs['moodle_users']
+    moodle_users_df['email'] = moodle_users_df['email'].apply(
+        lambda col: col.lower())
+
+    grade_df = all_raw_dfs['grades']
+    grade_df = grade_df[grade_df['assessment_name'].notnull()]
+
+    def convert_percentage(x):
+        if x == '-':
+            return None
+        return float(x.strip("%"))
+
+    grade_df = grade_df.assign(
+        grade_percentage=grade_df['grade_percentage'].map(convert_percentage)
+    )
+    grade_df = grade_df[grade_df['grade_percentage'].notnull()]
+    grade_df = grade_df.assign(
+        time_submitted=grade_df['time_submitted'].astype(int)
+    )
+    return {'grades': grade_df, 'moodle_users': moodle_users_df}
+
+
+def vectorized_scrub(all_raw_dfs):
+    clean_raw_df = scrub_raw_dfs(all_raw_dfs)
+    grade_df = clean_raw_df['grades']
+    grade_df = grade_df[grade_df['grade_percentage'].notnull()]
+    grade_df = grade_df.assign(
+        time_submitted=grade_df['time_submitted'].astype(int)
+    )
+    return clean_raw_df | {'grades': grade_df}
+
+
+SCRUBBERS = {
+    "python": python_scrub,
+    "vectorized": vectorized_scrub,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scrub stage')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='grade and user rows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tables = raw_tables(args.rows, args.seed)
+    results = {}
+    for name, scrub in SCRUBBERS.items():
+        timings = []
+        for _ in range(args.repeat):
+            raw_dfs = {
+                table: df.copy() for table, df in tables.items()
+            }
+            start = time.perf_counter()
+            results[name] = scrub(raw_dfs)
+            timings.append(time.perf_counter() - start)
+        print(f"{name.ljust(12)} {min(timings):8.3f}s")
+
+    for table, df in results["python"].items():
+        pd.testing.assert_frame_equal(results["vectorized"][table], df)
+    print("outputs identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare validation modes on each of the model tables
+
+    python -m benchmarks.bench_validation --rows 100000
+"""
+import argparse
+import time
+
+from benchmarks.example_data import load_example_tables
+from enclave_mgmt.create_models import MODEL_CLASSES
+from enclave_mgmt.validate_models import VALIDATION_FUNCTIONS
+
+
+def time_call(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark validation')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows per table')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing repetitions (best is reported)')
+    parser.add_argument('--modes', nargs='+',
+                        default=list(VALIDATION_FUNCTIONS),
+                        choices=list(VALIDATION_FUNCTIONS),
+                        help='validation modes to compare')
+    args = parser.parse_args()
+
+    tables = load_example_tables(args.rows)
+    # Speedups are reported relative to the last mode, by default the row by
+    # row pydantic loop
+    baseline = args.modes[-1]
+    print(" ".join(
+        ["table".ljust(40)] + [mode.rjust(12) for mode in args.modes] +
+        [f"{mode} x".rjust(14) for mode in args.modes[:-1]]
+    ))
+    for file_name, model in MODEL_CLASSES.items():
+        df = tables[file_name]
+        timings = {
+            mode: time_call(
+                VALIDATION_FUNCTIONS[mode], df, model, repeat=args.repeat
+            )
+            for mode in args.modes
+        }
+        print(" ".join(
+            [file_name.ljust(40)] +
+            [f"{timings[mode]:11.3f}s" for mode in args.modes] +
+            [f"{timings[baseline] / timings[mode]:13.1f}x"
+             for mode in args.modes[:-1]]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from ast import literal_eval
+from pathlib import Path
+import pandas as pd
+
+from enclave_mgmt.create_models import MODEL_CLASSES
+
+EXAMPLE_DATA_PATH = Path(__file__).parent.parent / "examples" / "data"
+
+
+def load_example_table(file_name, rows=None):
+    """Load an example model CSV with the types create_models produces,
+    optionally repeated up to the requested number of rows
+    """
+    df = pd.read_csv(EXAMPLE_DATA_PATH / file_name, keep_default_na=False)
+    if "response" in df.columns and "problem_type" in df.columns:
+        multiselect = df["problem_type"] == "multiselect"
+        df["response"] = df["response"].astype(object)
+        df.loc[multiselect, "response"] = \
+            df.loc[multiselect, "response"].map(literal_eval)
+    if rows is not None and len(df) > 0:
+        repeats = -(-rows // len(df))
+        df = pd.concat([df] * repeats, ignore_index=True).iloc[:rows]
+    return df
+
+
+def load_example_tables(rows=None):
+    return {
+        file_name: load_example_table(file_name, rows)
+        for file_name in MODEL_CLASSES
+    }
@@ -0,0 +1,75 @@
+import hashlib
+import io
+from botocore.exceptions import ClientError
+from pathlib import Path
+
+PAGE_SIZE = 1000
+
+
+class LocalS3Client:
+    """Directory backed stand-in for the parts of the boto3 S3 client that
+    compile-models uses. Objects are read from root/<bucket>/<key> and
+    ETags are the MD5 of the file contents like single part uploads.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.etags = {}
+
+    def path(self, bucket, key):
+        return self.root / bucket / key
+
+    def etag(self, path):
+        stat = path.stat()
+        cache_key = (path, stat.st_mtime_ns, stat.st_size)
+        if cache_key not in self.etags:
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    md5.update(block)
+            self.etags[cache_key] = f'"{md5.hexdigest()}"'
+        return self.etags[cache_key]
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        path = self.path(Bucket, Key)
+        if not path.is_file():
+            raise ClientError({
+                "Error": {"Code": "NoSuchKey", "Message": Key},
+                "ResponseMetadata": {"HTTPStatusCode": 404}
+            }, "GetObject")
+        etag = self.etag(path)
+        if IfNoneMatch == etag:
+            raise ClientError({
+                "Error": {"Code": "304", "Message": "Not Modified"},
+                "ResponseMetadata": {"HTTPStatusCode": 304}
+            }, "GetObject")
+        # The body is read into memory so callers that never close it, as
+        # boto3 StreamingBody allows, do not leak an open file
+        return {
+            "Body": io.BytesIO(path.read_bytes()),
+            "ETag": etag,
+            "ContentLength": path.stat().st_size,
+        }
+
+    def get_paginator(self, operation_name):
+        if operation_name != "list_objects":
+            raise NotImplementedError(operation_name)
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        bucket_path = self.root / Bucket
+        keys = sorted(
+            path.relative_to(bucket_path).as_posix()
+            for path in bucket_path.rglob("*") if path.is_file()
+        )
+        contents = [
+            {
+                "Key": key,
+                "ETag": self.etag(bucket_path / key),
+                "Size": (bucket_path / key).stat().st_size,
+            }
+            for key in keys if key.startswith(Prefix)
+        ]
+        for start in range(0, max(len(contents), 1), PAGE_SIZE):
+            page = contents[start:start + PAGE_SIZE]
+            yield {"Contents": page} if page else {}
@@ -0,0 +1,418 @@
+"""Generate synthetic RAISE data at arbitrary scale in the S3 layout that
+compile-models reads, under root/<bucket>/<key>
+
+    python -m benchmarks.synthetic_data /tmp/raise --courses 20 \
+        --students 30 --events 200
+"""
+import argparse
+import csv
+import json
+import random
+from pathlib import Path
+from uuid import UUID
+
+DATA_BUCKET = "raise-data"
+DATA_PREFIX = "data"
+EVENTS_BUCKET = "raise-events"
+EVENTS_PREFIX = "events"
+
+UNITS = 3
+SECTIONS = ["A", "B"]
+QUESTIONS_PER_QUIZ = 5
+ANSWERS_PER_QUESTION = 4
+CONTENT_ITEMS = 200
+VARIANTS = ["main", "variant1", "variant2"]
+PROBLEM_TYPES = ["input", "dropdown", "multiplechoice", "multiselect"]
+OPTIONS = ["red", "blue", "green", "yellow"]
+FIRST_NAMES = ["Ana", "Ben", "Cleo", "Dev", "Eli", "Fay", "Gus", "Hana"]
+LAST_NAMES = ["Garcia", "Nguyen", "Smith", "Okafor", "Kim", "Rossi"]
+START_TIME = 1661000000
+# Share of events from users that are not enrolled in the event course,
+# which create_models filters out
+UNENROLLED_EVENT_RATE = 0.02
+
+
+def random_uuid(rng):
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def quiz_names():
+    return [
+        f"Unit {unit}, Section {section} Quiz"
+        for unit in range(1, UNITS + 1) for section in SECTIONS
+    ]
+
+
+def write_csv(path, columns, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def generate_content(rng, content_path):
+    """Write the content CSVs and return the ids that Moodle data and
+    events refer to
+    """
+    questions = {}
+    question_rows = []
+    question_content_rows = []
+    answer_rows = []
+    for quiz_name in quiz_names():
+        for question_number in range(1, QUESTIONS_PER_QUIZ + 1):
+            question_id = random_uuid(rng)
+            answers = [
+                f"<p>{rng.randint(0, 99)}{index}</p>"
+                for index in range(ANSWERS_PER_QUESTION)
+            ]
+            questions[(quiz_name, question_number)] = answers
+            question_rows.append([quiz_name, question_number, question_id])
+            question_content_rows.append(
+                [question_id, f"<p>Question {question_number}</p>",
+                 "multichoice"]
+            )
+            for index, answer in enumerate(answers):
+                answer_rows.append([
+                    question_id, answer, 1.0 if index == 0 else 0.0,
+                    "correct" if index == 0 else "incorrect"
+                ])
+
+    content_ids = [random_uuid(rng) for _ in range(CONTENT_ITEMS)]
+    inputs = []
+    input_rows = []
+    psets = []
+    problem_rows = []
+    course_content_rows = []
+    for index, content_id in enumerate(content_ids):
+        course_content_rows.append([
+            f"Unit {index % UNITS + 1}", f"Lesson {index}", f"Page {index}",
+            content_id
+        ])
+        if index % 2 == 0:
+            input_id = random_uuid(rng)
+            inputs.append((content_id, input_id))
+            for variant in VARIANTS:
+                input_rows.append([
+                    input_id, content_id, variant,
+                    f"<div><p>Input {index} ({variant})</p></div>",
+                    "Enter a number"
+                ])
+        else:
+            pset_id = random_uuid(rng)
+            problems = []
+            for problem_type in PROBLEM_TYPES:
+                problem_id = random_uuid(rng)
+                problems.append((problem_id, problem_type))
+                solution = json.dumps(OPTIONS[:2]) \
+                    if problem_type == "multiselect" else OPTIONS[0]
+                for variant in VARIANTS:
+                    problem_rows.append([
+                        problem_id, content_id, variant,
+                        f"<div><p>Problem {index} ({variant})</p></div>",
+                        pset_id, problem_type, solution, json.dumps(OPTIONS)
+                    ])
+            psets.append((content_id, pset_id, problems))
+
+    write_csv(
+        content_path / "quiz_questions.csv",
+        ["quiz_name", "question_number", "question_id"], question_rows
+    )
+    write_csv(
+        content_path / "quiz_question_contents.csv",
+        ["id", "text", "type"], question_content_rows
+    )
+    write_csv(
+        content_path / "quiz_multichoice_answers.csv",
+        ["question_id", "text", "grade", "feedback"], answer_rows
+    )
+    write_csv(
+        content_path / "ib_input_instances.csv",
+        ["id", "content_id", "variant", "content", "prompt"], input_rows
+    )
+    write_csv(
+        content_path / "ib_pset_problems.csv",
+        ["id", "content_id", "variant", "content", "pset_id",
+         "problem_type", "solution", "solution_options"], problem_rows
+    )
+    write_csv(
+        content_path / "course_contents.csv",
+        ["section", "content_id", "activity_name", "lesson_page", "visible"],
+        [[section, content_id, activity, page, 1]
+         for section, activity, page, content_id in course_content_rows]
+    )
+    return questions, content_ids, inputs, psets
+
+
+def generate_course_users(rng, course_id, user_ids):
+    course = {
+        "fullname": f"Algebra 1 Course {course_id}",
+        "id": course_id,
+        "shortname": f"Alg1-{course_id}",
+    }
+    users = []
+    for index, (user_id, user_uuid) in enumerate(user_ids):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        email = f"{first_name}.{last_name}{user_id}@example.org"
+        users.append({
+            "email": email,
+            "enrolledcourses": [course],
+            "firstname": first_name,
+            "lastname": last_name,
+            "id": user_id,
+            "uuid": user_uuid,
+            "roles": [{
+                "shortname": "teacher" if index == 0 else "student"
+            }],
+            "username": email,
+        })
+    return users
+
+
+def generate_course_grades(rng, course_id, student_ids, questions, counters):
+    quizzes = []
+    for quiz_name in quiz_names():
+        counters["quiz"] += 1
+        quizzes.append({
+            "id": counters["quiz"],
+            "name": quiz_name,
+            "sumgrades": QUESTIONS_PER_QUIZ,
+            "course": course_id,
+        })
+
+    usergrades = []
+    attempts = {}
+    for user_id in student_ids:
+        gradeitems = []
+        user_attempts = {}
+        for quiz in quizzes:
+            if rng.random() < 0.2:
+                # Quiz not taken yet
+                gradeitems.append({
+                    "itemname": quiz["name"],
+                    "percentageformatted": "-",
+                    "gradedatesubmitted": None,
+                })
+                continue
+            summaries = []
+            details = {}
+            time_started = START_TIME + rng.randint(0, 10000000)
+            for attempt_number in range(1, rng.randint(1, 2) + 1):
+                counters["attempt"] += 1
+                attempt_id = counters["attempt"]
+                answers = []
+                for question_number in range(1, QUESTIONS_PER_QUIZ + 1):
+                    options = questions[(quiz["name"], question_number)]
+                    answers.append({
+                        "slot": question_number,
+                        "answer": [] if rng.random() < 0.1
+                        else [rng.choice(options)]
+                    })
+                score = sum(
+                    1 for answer in answers
+                    if answer["answer"] and answer["answer"][0] ==
+                    questions[(quiz["name"], answer["slot"])][0]
+                )
+                summaries.append({
+                    "id": attempt_id,
+                    "quiz": quiz["id"],
+                    "userid": user_id,
+                    "attempt": attempt_number,
+                    "timestart": time_started,
+                    "timefinish": time_started + 600,
+                    "sumgrades": score,
+                })
+                details[str(attempt_id)] = {
+                    "attempt": {
+                        "id": attempt_id,
+                        "quiz": quiz["id"],
+                        "userid": user_id,
+                        "attempt": attempt_number,
+                    },
+                    "questions": answers,
+                }
+                time_started += 3600
+            user_attempts[str(quiz["id"])] = {
+                "summaries": summaries, "details": details
+            }
+            percentage = 100 * summaries[-1]["sumgrades"] / QUESTIONS_PER_QUIZ
+            gradeitems.append({
+                "itemname": quiz["name"],
+                "percentageformatted": f"{percentage:.2f} %",
+                "gradedatesubmitted": summaries[-1]["timefinish"],
+            })
+        # Course total
+        gradeitems.append({
+            "itemname": None,
+            "percentageformatted": "-",
+            "gradedatesubmitted": None,
+        })
+        usergrades.append({
+            "courseid": course_id, "userid": user_id, "gradeitems": gradeitems
+        })
+        attempts[str(user_id)] = user_attempts
+    return {
+        "usergrades": usergrades,
+        "warnings": [],
+        "quizzes": quizzes,
+        "attempts": attempts,
+    }
+
+
+class EventWriter:
+    """Stream events into a {"data": [...]} events file"""
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "w")
+        self.file.write('{"data": [')
+        self.count = 0
+
+    def write(self, event):
+        if self.count:
+            self.file.write(", ")
+        self.file.write(json.dumps(event))
+        self.count += 1
+
+    def close(self):
+        self.file.write("]}")
+        self.file.close()
+
+
+def generate_events(rng, events_path, enrollments, events_per_student,
+                    content_ids, inputs, psets):
+    writers = {
+        name: EventWriter(events_path / f"{name}.json")
+        for name in [
+            "content_loaded_v1",
+            "ib_pset_problem_attempted_v1",
+            "ib_input_submitted_v1",
+        ]
+    }
+    other_uuids = [random_uuid(rng) for _ in range(10)]
+    for course_id, user_uuid in enrollments:
+        timestamp = START_TIME
+        for _ in range(events_per_student):
+            event_uuid = user_uuid
+            if rng.random() < UNENROLLED_EVENT_RATE:
+                event_uuid = rng.choice(other_uuids)
+            timestamp += rng.randint(1, 600)
+            base = {
+                "user_uuid": event_uuid,
+                "course_id": course_id,
+                "impression_id": random_uuid(rng),
+                "source_uri": "https://example.org",
+                "timestamp": timestamp,
+                "variant": rng.choice(VARIANTS),
+            }
+            kind = rng.random()
+            if kind < 0.5:
+                writers["content_loaded_v1"].write({
+                    **base,
+                    "eventname": "content_loaded_v1",
+                    "content_id": rng.choice(content_ids),
+                })
+            elif kind < 0.8:
+                content_id, pset_id, problems = rng.choice(psets)
+                problem_id, problem_type = rng.choice(problems)
+                if problem_type == "multiselect":
+                    response = {
+                        "string": None,
+                        "array": rng.sample(OPTIONS, rng.randint(1, 3))
+                    }
+                else:
+                    response = {"string": rng.choice(OPTIONS), "array": None}
+                writers["ib_pset_problem_attempted_v1"].write({
+                    **base,
+                    "eventname": "ib_pset_problem_attempted_v1",
+                    "content_id": content_id,
+                    "pset_content_id": pset_id,
+                    "pset_problem_content_id": problem_id,
+                    "problem_type": problem_type,
+                    "response": response,
+                    "correct": rng.random() < 0.5,
+                    "attempt": rng.randint(1, 3),
+                    "final_attempt": rng.random() < 0.3,
+                })
+            else:
+                content_id, input_id = rng.choice(inputs)
+                writers["ib_input_submitted_v1"].write({
+                    **base,
+                    "eventname": "ib_input_submitted_v1",
+                    "content_id": content_id,
+                    "input_content_id": input_id,
+                    "response": str(rng.randint(0, 100)),
+                })
+    for writer in writers.values():
+        writer.close()
+
+
+def generate(root, courses=10, students=30, events=100, seed=0,
+             data_prefix=DATA_PREFIX, events_prefix=EVENTS_PREFIX):
+    """Generate courses x students Moodle users with grades and quiz
+    attempts, the content CSVs and about events events per student. Returns
+    the arguments compile-models needs to read the data.
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    data_path = root / DATA_BUCKET / data_prefix
+    questions, content_ids, inputs, psets = generate_content(
+        rng, data_path / "content"
+    )
+
+    counters = {"user": 0, "quiz": 0, "attempt": 0}
+    enrollments = []
+    for course_id in range(1, courses + 1):
+        user_ids = []
+        # One teacher followed by the students of the course
+        for _ in range(students + 1):
+            counters["user"] += 1
+            user_ids.append((counters["user"], random_uuid(rng)))
+        write_json(
+            data_path / "moodle" / "users" / f"{course_id}.json",
+            generate_course_users(rng, course_id, user_ids)
+        )
+        write_json(
+            data_path / "moodle" / "grades" / f"{course_id}.json",
+            generate_course_grades(
+                rng, course_id, [user_id for user_id, _ in user_ids[1:]],
+                questions, counters
+            )
+        )
+        enrollments.extend(
+            (course_id, user_uuid) for _, user_uuid in user_ids[1:]
+        )
+
+    generate_events(
+        rng, root / EVENTS_BUCKET / events_prefix, enrollments, events,
+        content_ids, inputs, psets
+    )
+    return DATA_BUCKET, data_prefix, EVENTS_BUCKET, events_prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic RAISE data'
+    )
+    parser.add_argument('root', type=str,
+                        help='directory to write <bucket>/<key> files to')
+    parser.add_argument('--courses', type=int, default=10)
+    parser.add_argument('--students', type=int, default=30,
+                        help='students per course')
+    parser.add_argument('--events', type=int, default=100,
+                        help='events per student')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.root, args.courses, args.students, args.events, args.seed)
+
+
+if __name__ == "__main__":
+    main()
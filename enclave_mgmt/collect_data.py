@@ -1,333 +1,844 @@
+import hashlib
 import json
+import mmap
+import shutil
+import tempfile
+import time
 import boto3
+import numpy as np
 import pandas as pd
-from io import BytesIO
+from pandas.api.types import union_categoricals
+from botocore.config import Config
+from botocore.exceptions import (
+    BotoCoreError, ClientError, ConnectionError as BotoConnectionError,
+    HTTPClientError, IncompleteReadError
+)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from uuid import uuid4
 
+from enclave_mgmt import metrics
+from enclave_mgmt.object_cache import SOURCE_S3
+from enclave_mgmt.parse_events import DEFAULT_CHUNK_ROWS, iter_event_chunks
+
+
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_SECONDS = 0.5
+
+# Event key columns repeat heavily (a few thousand users and content items
+# across millions of events, one event name per file and a handful of
+# source URIs) so they are stored as categoricals. Impression ids are close
+# to unique and are kept as Arrow backed strings instead.
+EVENT_CATEGORY_COLUMNS = [
+    'eventname',
+    'source_uri',
+    'user_uuid',
+    'content_id',
+    'input_content_id',
+    'pset_content_id',
+    'pset_problem_content_id',
+    'variant',
+    'problem_type',
+]
+EVENT_STRING_COLUMNS = ['impression_id']
+COMPACT_STRING_DTYPE = "string[pyarrow]"
+
+# Objects larger than this are spooled to a memory mapped temporary file
+# before parsing so the S3 connection is released as soon as possible
+DEFAULT_SPOOL_BYTES = 64 * 1024 * 1024
+SPOOL_BUFFER_BYTES = 1024 * 1024
+
+# Explicit dtypes for the content CSV columns used by the models so pandas
+# does not have to infer them
+CONTENT_CSV_DTYPES = {
+    "quiz_questions": {
+        "quiz_name": str,
+        "question_number": "int64",
+        "question_id": str,
+    },
+    "quiz_question_contents": {"id": str, "text": str, "type": str},
+    "quiz_multichoice_answers": {
+        "question_id": str,
+        "text": str,
+        "grade": "float64",
+        "feedback": str,
+    },
+    "ib_input_instances": {
+        "id": str,
+        "content_id": str,
+        "variant": str,
+        "content": str,
+        "prompt": str,
+    },
+    "ib_pset_problems": {
+        "id": str,
+        "content_id": str,
+        "variant": str,
+        "content": str,
+        "pset_id": str,
+        "problem_type": str,
+        "solution": str,
+        "solution_options": str,
+    },
+    "course_contents": {
+        "section": str,
+        "content_id": str,
+        "activity_name": str,
+        "lesson_page": str,
+    },
+}
+
+RETRYABLE_ERROR_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+# Connection and read level failures (EndpointConnectionError,
+# ConnectTimeoutError, ConnectionClosedError, ReadTimeoutError,
+# ResponseStreamingError, IncompleteReadError, ...). Other botocore errors
+# such as NoCredentialsError or ParamValidationError fail the same way on
+# every attempt.
+RETRYABLE_BOTOCORE_ERRORS = (
+    BotoConnectionError, HTTPClientError, IncompleteReadError
+)
+
+
+def collect_data(data_bucket, data_key, events_bucket, events_key,
+                 max_workers=DEFAULT_MAX_WORKERS, course_ids=None,
+                 cache=None, event_chunk_rows=None, tables=None):
+    """Collect all raw dataframes, or only the objects needed for the
+    dataframes named in tables. When course_ids is given only data for
+    those courses is fetched and kept. When an ObjectCache is given only
+    objects that changed since they were cached are downloaded. When
+    event_chunk_rows is given event tables are iterators of chunks that
+    are parsed as they are consumed.
+
+    The Moodle, content and event collectors read independent prefixes so
+    they run concurrently over one S3 client unless max_workers is 1.
+    """
+    s3_client = create_s3_client(max_workers)
+    collectors = [
+        ("collect_moodle_dfs", lambda: collect_moodle_dfs(
+            data_bucket, data_key, max_workers, course_ids, cache, s3_client,
+            tables
+        )),
+        ("collect_content_dfs", lambda: collect_content_dfs(
+            data_bucket, data_key, cache, s3_client, tables
+        )),
+        ("collect_event_data_dfs", lambda: collect_event_data_dfs(
+            events_bucket, events_key, course_ids, cache, event_chunk_rows,
+            s3_client, tables
+        )),
+    ]
+    if max_workers <= 1:
+        results = [run_collector(*collector) for collector in collectors]
+    else:
+        with ThreadPoolExecutor(max_workers=len(collectors)) as executor:
+            futures = [
+                executor.submit(run_collector, *collector)
+                for collector in collectors
+            ]
+            results = [future.result() for future in futures]
 
-def collect_data(data_bucket, data_key, events_bucket, events_key):
-    moodle_dfs = collect_moodle_dfs(data_bucket, data_key)
-    content_dfs = collect_content_dfs(data_bucket, data_key)
-    event_data = collect_event_data_dfs(events_bucket, events_key)
-    all_raw_dfs = moodle_dfs | content_dfs | event_data
+    all_raw_dfs = {}
+    for raw_dfs in results:
+        all_raw_dfs |= raw_dfs
     return all_raw_dfs
 
 
-def collect_moodle_dfs(bucket, prefix):
-    grades_dict, users_dict = {}, {}
-    s3_client = boto3.client("s3")
+def create_s3_client(max_workers=DEFAULT_MAX_WORKERS):
+    """Create an S3 client that can be shared by the concurrent collectors.
+    The connection pool fits every concurrent Moodle download plus the
+    content download and the event file bodies, which stay open while
+    chunked events are consumed.
+    """
+    return boto3.client("s3", config=Config(
+        max_pool_connections=max(1, max_workers) + len(EVENT_FILES) + 1
+    ))
+
+
+def is_needed(names, tables=None):
+    return tables is None or not set(tables).isdisjoint(names)
+
+
+def run_collector(name, collect):
+    with metrics.stage(name) as entry:
+        raw_dfs = collect()
+        entry["rows_out"] = metrics.count_rows(*raw_dfs.values())
+    return raw_dfs
+
+
+def is_retryable_error(error):
+    if isinstance(error, ClientError):
+        error_code = error.response.get("Error", {}).get("Code")
+        status_code = error.response.get(
+            "ResponseMetadata", {}
+        ).get("HTTPStatusCode", 0)
+        return error_code in RETRYABLE_ERROR_CODES or status_code >= 500
+    return isinstance(error, RETRYABLE_BOTOCORE_ERRORS)
+
+
+def get_object_contents(s3_client, bucket, key,
+                        max_attempts=DEFAULT_MAX_ATTEMPTS,
+                        backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    for attempt in range(max_attempts):
+        try:
+            data = s3_client.get_object(Bucket=bucket, Key=key)
+            return data["Body"].read()
+        except (BotoCoreError, ClientError) as error:
+            if attempt == max_attempts - 1 or not is_retryable_error(error):
+                raise
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+
+def fetch_objects(s3_client, bucket, keys,
+                  max_workers=DEFAULT_MAX_WORKERS,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS,
+                  backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    """Yield (key, contents) for each key in the order the keys were given
+    while downloading up to max_workers objects concurrently. Only a bounded
+    number of downloaded objects are buffered ahead of the consumer.
+    """
+    max_workers = max(1, max_workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key in keys:
+            pending.append((key, executor.submit(
+                get_object_contents,
+                s3_client, bucket, key, max_attempts, backoff_seconds
+            )))
+            if len(pending) >= 2 * max_workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+def fetch_cached_objects(s3_client, bucket, objects, parse,
+                         max_workers=DEFAULT_MAX_WORKERS, cache=None,
+                         variant=None):
+    """Yield (key, parse(key, contents)) for each (key, etag) in objects in
+    order. Objects whose ETag and variant match the cache are read from it
+    and the rest are downloaded concurrently with fetch_objects.
+    """
+    objects = list(objects)
+
+    def is_cached(key, etag):
+        return cache is not None and cache.has(bucket, key, etag, variant)
+
+    fetched = fetch_objects(
+        s3_client, bucket,
+        [key for key, etag in objects if not is_cached(key, etag)],
+        max_workers
+    )
+    for key, etag in objects:
+        if is_cached(key, etag):
+            yield key, cache.get(bucket, key)
+            continue
+        _, contents = next(fetched)
+        metrics.add_s3_bytes(len(contents))
+        value = parse(key, contents)
+        if cache is not None:
+            cache.put(bucket, key, etag, value, variant)
+        yield key, value
+
+
+def is_not_modified(error):
+    return error.response.get("Error", {}).get("Code") in \
+        ("304", "NotModified") or error.response.get(
+            "ResponseMetadata", {}
+        ).get("HTTPStatusCode") == 304
+
+
+def get_parsed_object(s3_client, bucket, key, parse, cache=None,
+                      variant=None):
+    """Return parse(body) for an object. With a cache the download is
+    conditional on the ETag of the cached copy and the cached value is
+    reused when S3 reports the object as not modified.
+    """
+    params = {"Bucket": bucket, "Key": key}
+    etag = cache.etag(bucket, key, variant) if cache is not None else None
+    if etag is not None:
+        params["IfNoneMatch"] = etag
+    try:
+        data = s3_client.get_object(**params)
+    except ClientError as error:
+        if etag is None or not is_not_modified(error):
+            raise
+        return cache.get(bucket, key)
+    metrics.add_s3_bytes(data.get("ContentLength", 0))
+    with object_body(data) as body:
+        value = parse(body)
+    if cache is not None:
+        cache.put(bucket, key, data.get("ETag"), value, variant)
+    return value
+
+
+@contextmanager
+def object_body(data, spool_bytes=DEFAULT_SPOOL_BYTES):
+    """Yield a readable body for a get_object response without copying it
+    into memory. Small bodies are read straight from the response stream
+    while larger ones are streamed to a temporary file that is memory
+    mapped. The response stream is closed once the body is no longer
+    needed so its connection goes back to the pool.
+    """
+    try:
+        if data.get("ContentLength", 0) <= spool_bytes:
+            yield data["Body"]
+            return
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(data["Body"], spool, SPOOL_BUFFER_BYTES)
+            data["Body"].close()
+            spool.flush()
+            with mmap.mmap(
+                spool.fileno(), 0, access=mmap.ACCESS_READ
+            ) as body:
+                yield body
+    finally:
+        data["Body"].close()
+
+
+def list_objects(s3_client, bucket, prefix):
+    """Yield (key, etag) for each object under prefix"""
     paginator = s3_client.get_paginator('list_objects')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for data_object in page.get("Contents", []):
+            yield data_object.get("Key"), data_object.get("ETag")
 
-    grade_data_iterator = paginator.paginate(
-        Bucket=bucket,
-        Prefix=f"{prefix}/moodle/grades"
-    )
-    users_data_iterator = paginator.paginate(
-        Bucket=bucket,
-        Prefix=f"{prefix}/moodle/users"
-    )
-    for page in grade_data_iterator:
-        for data_object in page.get("Contents"):
-            object_key = data_object.get("Key")
-            course_id = object_key.split("/")[-1].split(".json")[0]
-            data = s3_client.get_object(
-                Bucket=bucket,
-                Key=object_key
+
+def course_id_from_key(object_key):
+    return int(object_key.split("/")[-1].split(".json")[0])
+
+
+def list_course_objects(s3_client, bucket, prefix, course_ids=None):
+    for object_key, etag in list_objects(s3_client, bucket, prefix):
+        if course_ids is None or course_id_from_key(object_key) in course_ids:
+            yield object_key, etag
+
+
+def collect_moodle_dfs(bucket, prefix, max_workers=DEFAULT_MAX_WORKERS,
+                       course_ids=None, cache=None, s3_client=None,
+                       tables=None):
+    s3_client = s3_client or create_s3_client(max_workers)
+    moodle_dfs = {}
+
+    if is_needed(GRADES_SHARD_TABLES, tables):
+        grade_objects = list_course_objects(
+            s3_client, bucket, f"{prefix}/moodle/grades", course_ids
+        )
+        grade_shards = fetch_course_shards(
+            s3_client, bucket, grade_objects, course_grades_shards,
+            max_workers, cache
+        )
+        moodle_dfs |= concat_shards(grade_shards, GRADES_SHARD_TABLES)
+
+    if is_needed(USERS_SHARD_TABLES, tables):
+        users_objects = list_course_objects(
+            s3_client, bucket, f"{prefix}/moodle/users", course_ids
+        )
+        users_shards = fetch_course_shards(
+            s3_client, bucket, users_objects, course_users_shards,
+            max_workers, cache
+        )
+        moodle_dfs |= concat_shards(users_shards, USERS_SHARD_TABLES)
+        # Users enrolled in several courses are de-duplicated by email
+        # address, ignoring case, keeping the first course they were seen in
+        moodle_users = moodle_dfs['moodle_users']
+        moodle_dfs['moodle_users'] = moodle_users[
+            ~moodle_users['email'].str.lower().duplicated()
+        ].reset_index(drop=True)
+    return moodle_dfs
+
+
+def fetch_course_shards(s3_client, bucket, objects, to_shards,
+                        max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """Return the per-course intermediate dataframes for each (key, etag)
+    in objects in order. With a cache the shards are stored keyed by the
+    course and a hash of the source JSON and are only recomputed when the
+    contents of a course change.
+    """
+    if cache is None:
+        return [
+            shards for _, shards in fetch_cached_objects(
+                s3_client, bucket, objects,
+                lambda key, contents: to_shards(
+                    course_id_from_key(key), json.loads(contents)
+                ),
+                max_workers
             )
-            contents = data["Body"].read()
-            grades_dict[int(course_id)] = json.loads(contents)
-
-    for page in users_data_iterator:
-        for data_object in page.get("Contents"):
-            object_key = data_object.get("Key")
-            course_id = object_key.split("/")[-1].split(".json")[0]
-            data = s3_client.get_object(
-                Bucket=bucket,
-                Key=object_key
+        ]
+
+    version = f"{to_shards.__name__}-v{SHARD_FORMAT_VERSION}"
+
+    def store_shards(key, contents):
+        course_id = course_id_from_key(key)
+        shard_id = "-".join([
+            version, str(course_id), hashlib.sha256(contents).hexdigest()
+        ])
+        if not cache.has_shards(shard_id):
+            cache.put_shards(
+                shard_id, to_shards(course_id, json.loads(contents))
             )
-            contents = data["Body"].read()
-            users_dict[int(course_id)] = json.loads(contents)
-
-    return {
-        'moodle_users': generate_users_df(users_dict),
-        'courses': generate_courses_df(users_dict),
-        'enrollments': generate_enrollment_df(users_dict),
-        'grades': generate_grade_df(grades_dict),
-        'quiz_data': generate_quiz_data_df(grades_dict),
-        'attempts_summary': generate_attempts_summary_df(grades_dict),
-        'attempt_multichoice_response':
-        generate_attempt_multichoice_response_df(
-            grades_dict
-        ),
-    }
+        return shard_id
+
+    shards = []
+    for key, shard_id in fetch_cached_objects(
+        s3_client, bucket, objects, store_shards, max_workers, cache, version
+    ):
+        cache.link_shards(bucket, key, shard_id)
+        shards.append(cache.get_shards(shard_id))
+    return shards
+
+
+# Bump whenever the flattening of Moodle JSON into shards changes so shards
+# cached by earlier versions are rebuilt instead of reused
+SHARD_FORMAT_VERSION = 2
+
+GRADES_SHARD_TABLES = [
+    'grades', 'quiz_data', 'attempts_summary', 'attempt_multichoice_response'
+]
+USERS_SHARD_TABLES = ['enrollments', 'courses', 'moodle_users']
+
+
+def course_grades_shards(course_id, course_grades):
+    moodle_tables = MoodleTables()
+    moodle_tables.add_course_grades(course_id, course_grades)
+    moodle_dfs = moodle_tables.to_dfs()
+    return {name: moodle_dfs[name] for name in GRADES_SHARD_TABLES}
+
 
+def course_users_shards(course_id, course_users):
+    moodle_tables = MoodleTables()
+    moodle_tables.add_course_users(course_id, course_users)
+    moodle_dfs = moodle_tables.to_dfs()
+    # Generated UUIDs are stored as strings so shards can be kept as Parquet
+    moodle_dfs['moodle_users']['uuid'] = \
+        moodle_dfs['moodle_users']['uuid'].astype(str)
+    return {name: moodle_dfs[name] for name in USERS_SHARD_TABLES}
 
-def collect_content_dfs(bucket, key):
-    key_questions = key + "/content/quiz_questions.csv"
-    key_question_contents = key + "/content/quiz_question_contents.csv"
-    key_multichoice_answers = key + "/content/quiz_multichoice_answers.csv"
-    key_ib_input_instances = key + "/content/ib_input_instances.csv"
-    key_ib_pset_problems = key + "/content/ib_pset_problems.csv"
-    key_course_contents = key + "/content/course_contents.csv"
-
-    s3_client = boto3.client("s3")
-    quiz_question_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_questions)
-    quiz_question_contents_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_question_contents)
-    quiz_multichoice_answers_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_multichoice_answers)
-    ib_input_instances_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_ib_input_instances)
-    ib_pset_problems_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_ib_pset_problems)
-    course_contents_stream = s3_client.get_object(
-        Bucket=bucket,
-        Key=key_course_contents)
 
+def concat_shards(shards, tables):
+    empty_dfs = MoodleTables().to_dfs()
+    dfs = {}
+    for name in tables:
+        frames = [course[name] for course in shards if len(course[name])]
+        if len(frames) == 0:
+            dfs[name] = empty_dfs[name]
+        else:
+            dfs[name] = pd.concat(frames, ignore_index=True).infer_objects()
+    return dfs
+
+
+def read_content_csv(body, dtype=None):
     # By default pandas will use NaN for empty values in CSVs. We pass
     # keep_default_na=False to avoid this behavior as it will otherwise
     # cause validation errors
-    quiz_question_data = pd.read_csv(
-        BytesIO(quiz_question_stream["Body"].read()),
-        keep_default_na=False
-    )
-    quiz_question_contents_data = pd.read_csv(
-        BytesIO(quiz_question_contents_stream["Body"].read()),
-        keep_default_na=False
-    )
-    quiz_multichoice_answers_data = pd.read_csv(
-        BytesIO(quiz_multichoice_answers_stream["Body"].read()),
-        keep_default_na=False
-    )
-    ib_input_instances_data = pd.read_csv(
-        BytesIO(ib_input_instances_stream["Body"].read()),
-        keep_default_na=False
-    )
-    ib_pset_problems_data = pd.read_csv(
-        BytesIO(ib_pset_problems_stream["Body"].read()),
-        keep_default_na=False
-    )
-    course_contents_data = pd.read_csv(
-        BytesIO(course_contents_stream["Body"].read()),
-        keep_default_na=False
-    )
+    return pd.read_csv(body, keep_default_na=False, dtype=dtype)
+
+
+def collect_content_dfs(bucket, key, cache=None, s3_client=None,
+                        tables=None):
+    s3_client = s3_client or create_s3_client()
+    content_dfs = {}
+    for name, dtype in CONTENT_CSV_DTYPES.items():
+        if not is_needed([name], tables):
+            continue
+        content_dfs[name] = get_parsed_object(
+            s3_client, bucket, f"{key}/content/{name}.csv",
+            lambda body, dtype=dtype: read_content_csv(body, dtype), cache
+        )
+    return content_dfs
 
-    return {"quiz_questions": quiz_question_data,
-            "quiz_question_contents": quiz_question_contents_data,
-            "quiz_multichoice_answers": quiz_multichoice_answers_data,
-            "ib_input_instances": ib_input_instances_data,
-            "ib_pset_problems": ib_pset_problems_data,
-            "course_contents": course_contents_data
-            }
 
+def collect_event_data_dfs(events_bucket, events_key, course_ids=None,
+                           cache=None, chunk_rows=None, s3_client=None,
+                           tables=None):
+    s3_client = s3_client or create_s3_client()
+    # Cached events are already filtered so they can only be reused for the
+    # same set of courses
+    variant = None if course_ids is None else sorted(
+        int(course_id) for course_id in course_ids
+    )
 
-def collect_event_data_dfs(events_bucket, events_key):
+    event_data = {}
+    for name, file_name, normalize_chunk in EVENT_FILES:
+        if not is_needed([name], tables):
+            continue
+        key = f"{events_key}/{file_name}"
+        if chunk_rows is not None:
+            event_data[name] = get_event_chunks(
+                s3_client, events_bucket, key, chunk_rows,
+                normalize_chunk, course_filter(course_ids), cache
+            )
+            continue
+        event_data[name] = get_parsed_object(
+            s3_client, events_bucket, key,
+            lambda body, normalize_chunk=normalize_chunk: read_compact_events(
+                body,
+                normalize_chunk=normalize_chunk,
+                filter_chunk=course_filter(course_ids)
+            ),
+            cache, variant
+        )
+    return event_data
+
+
+def get_event_chunks(s3_client, bucket, key, chunk_rows,
+                     normalize_chunk=None, filter_chunk=None, cache=None):
+    """Yield compacted event chunks parsed from an events file as they are
+    consumed. The file is only requested when the first chunk is pulled so
+    the response stream is not left idle while other tables are built.
+    Chunked events are never cached.
+    """
+    data = s3_client.get_object(Bucket=bucket, Key=key)
+    metrics.add_s3_bytes(data.get("ContentLength", 0))
+    if cache is not None:
+        cache.record(bucket, key, data.get("ETag"), SOURCE_S3)
+    try:
+        for chunk in iter_event_chunks(
+            data["Body"], chunk_rows, normalize_chunk, filter_chunk
+        ):
+            yield compact_event_df(chunk)
+    finally:
+        data["Body"].close()
+
+
+def read_compact_events(stream, chunk_rows=DEFAULT_CHUNK_ROWS,
+                        normalize_chunk=None, filter_chunk=None):
+    """Read an events file into a compacted dataframe. Each chunk is
+    compacted as soon as it is parsed so the whole table is never held with
+    object key columns.
+    """
+    return concat_event_chunks([
+        compact_event_df(chunk) for chunk in iter_event_chunks(
+            stream, chunk_rows, normalize_chunk, filter_chunk
+        )
+    ])
+
+
+def concat_event_chunks(chunks):
+    """Concatenate compacted event chunks. pd.concat turns categoricals with
+    different categories back into object columns, so categorical columns
+    are combined with union_categoricals instead.
+    """
+    if len(chunks) == 0:
+        return pd.DataFrame()
+    columns = chunks[0].columns
+    categoricals = {
+        column: union_categoricals([chunk[column] for chunk in chunks])
+        for column in columns
+        if all(
+            column in chunk.columns and
+            isinstance(chunk[column].dtype, pd.CategoricalDtype)
+            for chunk in chunks
+        )
+    }
+    df = pd.concat(
+        [chunk.drop(columns=list(categoricals)) for chunk in chunks],
+        ignore_index=True
+    )
+    for column, values in categoricals.items():
+        df[column] = values
+    return df[columns]
+
+
+def compact_event_df(df):
+    """Convert event key columns to compact dtypes. The values are unchanged
+    and are converted back to plain columns when models are written.
+    """
+    for column in df.columns:
+        if column in EVENT_CATEGORY_COLUMNS:
+            df[column] = df[column].astype("category")
+        elif column in EVENT_STRING_COLUMNS:
+            df[column] = df[column].astype(COMPACT_STRING_DTYPE)
+    return df
+
+
+def course_filter(course_ids):
+    """Return a chunk filter that drops events outside of course_ids"""
+    if course_ids is None:
+        return None
+    course_ids = list(course_ids)
+
+    def filter_chunk(chunk):
+        return chunk[chunk['course_id'].isin(course_ids)]
+    return filter_chunk
+
+
+def normalize_pset_problem_attempts(df):
+    """Resolve the {"string": ..., "array": ...} union of pset attempt
+    responses for a whole chunk at once. The union is flattened into a
+    string and an array column and the string is kept where it is set and
+    non-empty. response_is_str records which of the two was chosen so
+    validation can type the responses without looking at each value.
+    """
+    if "response" not in df.columns:
+        return df
+    flat = pd.DataFrame(df["response"].tolist(), columns=["string", "array"])
+    strings = flat["string"].to_numpy()
+    is_str = pd.notna(strings) & (strings != "")
+    df["response"] = np.where(is_str, strings, flat["array"].to_numpy())
+    df["response_is_str"] = is_str
+    return df
+
+
+EVENT_FILES = [
+    ("content_loads", "content_loaded_v1.json", None),
+    ("ib_pset_problem_attempts", "ib_pset_problem_attempted_v1.json",
+     normalize_pset_problem_attempts),
+    ("ib_input_submissions", "ib_input_submitted_v1.json", None),
+]
+
+
+class ColumnBuilder:
+    """Accumulate rows as one list per column so dataframes can be built
+    without materializing a dict per row
+    """
+
+    def __init__(self, columns):
+        self.data = {column: [] for column in columns}
+
+    def append(self, *row):
+        for values, value in zip(self.data.values(), row):
+            values.append(value)
+
+    def extend(self, count, *row):
+        """Add count rows where each value is either a list of count values
+        or a scalar that is repeated for every row
+        """
+        for values, value in zip(self.data.values(), row):
+            if isinstance(value, list):
+                values.extend(value)
+            else:
+                values.extend([value] * count)
+
+    def to_df(self):
+        return pd.DataFrame(self.data)
+
+
+GRADE_COLUMNS = [
+    'user_id',
+    'grade_percentage',
+    'assessment_name',
+    'course_id',
+    'time_submitted'
+]
+QUIZ_DATA_COLUMNS = ['quiz_id', 'quiz_name', 'max_grade', 'course_id']
+ATTEMPTS_SUMMARY_COLUMNS = [
+    'course_id',
+    'user_id',
+    'quiz_id',
+    'attempt_id',
+    'attempt_number',
+    'time_started',
+    'time_finished',
+    'attempt_grade'
+]
+ATTEMPT_MULTICHOICE_RESPONSE_COLUMNS = [
+    'course_id',
+    'user_id',
+    'quiz_id',
+    'attempt_id',
+    'attempt_number',
+    'answer',
+    'question_number'
+]
+ENROLLMENT_COLUMNS = ['user_id', 'course_id', 'role']
+COURSE_COLUMNS = ['id', 'name']
+USER_COLUMNS = ['first_name', 'last_name', 'email', 'user_id', 'uuid']
+
+
+class MoodleTables:
+    """Flatten Moodle course JSON into all of the derived tables in a single
+    traversal per course so course objects can be discarded as soon as they
+    have been processed
+    """
+
+    def __init__(self):
+        self.grades = ColumnBuilder(GRADE_COLUMNS)
+        self.quiz_data = ColumnBuilder(QUIZ_DATA_COLUMNS)
+        self.attempts_summary = ColumnBuilder(ATTEMPTS_SUMMARY_COLUMNS)
+        self.attempt_multichoice_response = ColumnBuilder(
+            ATTEMPT_MULTICHOICE_RESPONSE_COLUMNS
+        )
+        self.enrollments = ColumnBuilder(ENROLLMENT_COLUMNS)
+        self.courses = ColumnBuilder(COURSE_COLUMNS)
+        self.moodle_users = ColumnBuilder(USER_COLUMNS)
+        # Use lowercased email addresses to de-duplicate users
+        self.seen_users = set()
+
+    def add_course_grades(self, course_id, course_grades):
+        add_grades(self.grades, course_id, course_grades)
+        add_quizzes(self.quiz_data, course_grades)
+        add_attempts(
+            course_id, course_grades,
+            self.attempts_summary, self.attempt_multichoice_response
+        )
 
-    key_content_loads = events_key + "/content_loaded_v1.json"
-    key_ib_pset_problem_attempts = \
-        events_key + "/ib_pset_problem_attempted_v1.json"
-    key_ib_input_submissions = events_key + "/ib_input_submitted_v1.json"
+    def add_course_users(self, course_id, course_users):
+        add_enrollments(self.enrollments, course_id, course_users)
+        add_course(self.courses, course_id, course_users)
+        add_users(self.moodle_users, course_users, self.seen_users)
+
+    def to_dfs(self):
+        return {
+            'moodle_users': self.moodle_users.to_df(),
+            'courses': self.courses.to_df(),
+            'enrollments': self.enrollments.to_df(),
+            'grades': self.grades.to_df(),
+            'quiz_data': self.quiz_data.to_df(),
+            'attempts_summary': self.attempts_summary.to_df(),
+            'attempt_multichoice_response':
+                self.attempt_multichoice_response.to_df(),
+        }
+
+
+def add_grades(grades, course_id, course_grades):
+    for user in course_grades['usergrades']:
+        gradeitems = user['gradeitems']
+        grades.extend(
+            len(gradeitems),
+            user['userid'],
+            [grade['percentageformatted'] for grade in gradeitems],
+            [grade['itemname'] for grade in gradeitems],
+            course_id,
+            [grade['gradedatesubmitted'] for grade in gradeitems]
+        )
 
-    s3_client = boto3.client("s3")
 
-    content_loads_stream = s3_client.get_object(
-        Bucket=events_bucket,
-        Key=key_content_loads)
-    ib_pset_problem_attempts_stream = s3_client.get_object(
-        Bucket=events_bucket,
-        Key=key_ib_pset_problem_attempts)
-    ib_input_submissions_stream = s3_client.get_object(
-        Bucket=events_bucket,
-        Key=key_ib_input_submissions)
+def add_quizzes(quiz_data, course_grades):
+    for quiz in course_grades['quizzes']:
+        quiz_data.append(
+            quiz['id'],
+            quiz['name'],
+            quiz['sumgrades'],
+            quiz['course']
+        )
 
-    content_loads_data = pd.DataFrame(
-        json.loads(content_loads_stream["Body"].read())['data']
-    )
 
-    # Normalize union type for pset attempt response
-    ib_pset_problem_attempts_json = json.loads(
-        ib_pset_problem_attempts_stream["Body"].read()
-    )['data']
-    ib_pset_problem_attempts_normalized = []
-    for item in ib_pset_problem_attempts_json:
-        item["response"] = \
-            item["response"]["string"] or item["response"]["array"]
-        ib_pset_problem_attempts_normalized.append(item)
-    ib_pset_problem_attempts_data = pd.DataFrame(
-        ib_pset_problem_attempts_normalized
-    )
+def add_attempts(course_id, course_grades, attempts_summary=None,
+                 attempt_multichoice_response=None):
+    for _, users in course_grades['attempts'].items():
+        for _, quiz in users.items():
+            if attempts_summary is not None:
+                for attempt_summary in quiz['summaries']:
+                    attempts_summary.append(
+                        course_id,
+                        attempt_summary['userid'],
+                        attempt_summary['quiz'],
+                        attempt_summary['id'],
+                        attempt_summary['attempt'],
+                        attempt_summary['timestart'],
+                        attempt_summary['timefinish'],
+                        attempt_summary['sumgrades']
+                    )
+            if attempt_multichoice_response is None:
+                continue
+            for _, attempt_detail in quiz['details'].items():
+                attempt = attempt_detail['attempt']
+                for question in attempt_detail['questions']:
+                    answers = question['answer']
+                    attempt_multichoice_response.extend(
+                        len(answers),
+                        course_id,
+                        attempt['userid'],
+                        attempt['quiz'],
+                        attempt['id'],
+                        attempt['attempt'],
+                        list(answers),
+                        question['slot']
+                    )
+
+
+def add_enrollments(enrollments, course_id, course_users):
+    for user in course_users:
+        enrollments.append(
+            user['id'],
+            course_id,
+            user['roles'][0]['shortname']
+        )
 
-    ib_input_submissions_data = pd.DataFrame(
-        json.loads(ib_input_submissions_stream["Body"].read())['data']
-    )
 
-    return {
-        "content_loads": content_loads_data,
-        "ib_pset_problem_attempts": ib_pset_problem_attempts_data,
-        "ib_input_submissions": ib_input_submissions_data
-    }
+def add_course(courses, course_id, course_users):
+    enrolled = course_users[0]['enrolledcourses']
+    for course in enrolled:
+        if course['id'] == course_id:
+            courses.append(course['id'], course['fullname'])
+
+
+def add_users(moodle_users, course_users, seen_users):
+    for user in course_users:
+        user_email = user['email']
+        if user_email.lower() not in seen_users:
+            seen_users.add(user_email.lower())
+            moodle_users.append(
+                user['firstname'],
+                user['lastname'],
+                user_email,
+                user['id'],
+                user['uuid'] or uuid4()
+            )
 
 
 def generate_grade_df(grade_dict):
-    grade_data = []
+    grades = ColumnBuilder(GRADE_COLUMNS)
     for course_id in grade_dict.keys():
-        for user in grade_dict[course_id]['usergrades']:
-            for grade in user['gradeitems']:
-                grade_data.append({
-                    'user_id': user['userid'],
-                    'grade_percentage': grade['percentageformatted'],
-                    'assessment_name': grade['itemname'],
-                    'course_id': course_id,
-                    'time_submitted': grade['gradedatesubmitted']
-                })
-    if len(grade_data) != 0:
-        return pd.DataFrame(grade_data)
-    else:
-        return pd.DataFrame(
-            columns=[
-                'user_id',
-                'grade_percentage',
-                'assessment_name',
-                'course_id',
-                'time_submitted'
-            ]
-        )
+        add_grades(grades, course_id, grade_dict[course_id])
+    return grades.to_df()
 
 
 def generate_quiz_data_df(grade_dict):
-
-    quiz_data = []
+    quiz_data = ColumnBuilder(QUIZ_DATA_COLUMNS)
     for course_id in grade_dict.keys():
-        for quiz in grade_dict[course_id]['quizzes']:
-            quiz_data.append({
-                'quiz_id': quiz['id'],
-                'quiz_name': quiz['name'],
-                'max_grade': quiz['sumgrades'],
-                'course_id': quiz['course']
-            })
-    return pd.DataFrame(quiz_data)
+        add_quizzes(quiz_data, grade_dict[course_id])
+    return quiz_data.to_df()
 
 
 def generate_attempts_summary_df(grade_dict):
-
-    attempt_data = []
+    attempts_summary = ColumnBuilder(ATTEMPTS_SUMMARY_COLUMNS)
     for course_id in grade_dict.keys():
-        for _, users in grade_dict[course_id]['attempts'].items():
-            for _, quiz in users.items():
-                for attempt_summary in quiz['summaries']:
-                    attempt_data.append({
-                        'course_id': course_id,
-                        'user_id': attempt_summary['userid'],
-                        'quiz_id': attempt_summary['quiz'],
-                        'attempt_id': attempt_summary['id'],
-                        'attempt_number': attempt_summary['attempt'],
-                        'time_started': attempt_summary['timestart'],
-                        'time_finished': attempt_summary['timefinish'],
-                        'attempt_grade': attempt_summary['sumgrades']
-                    })
-    if len(attempt_data) != 0:
-        return pd.DataFrame(attempt_data)
-    else:
-        return pd.DataFrame(
-            columns=[
-                'course_id',
-                'user_id',
-                'quiz_id',
-                'attempt_id',
-                'attempt_number',
-                'time_started',
-                'time_finished',
-                'attempt_grade'
-            ]
+        add_attempts(
+            course_id, grade_dict[course_id],
+            attempts_summary=attempts_summary
         )
+    return attempts_summary.to_df()
 
 
 def generate_attempt_multichoice_response_df(grade_dict):
-
-    attempt_multichoice_response_data = []
+    attempt_multichoice_response = ColumnBuilder(
+        ATTEMPT_MULTICHOICE_RESPONSE_COLUMNS
+    )
     for course_id in grade_dict.keys():
-        for _, users in grade_dict[course_id]['attempts'].items():
-            for _, quiz in users.items():
-                for _, attempt_detail in quiz['details'].items():
-                    for question in attempt_detail['questions']:
-                        for answer in question['answer']:
-                            attempt_multichoice_response_data.append(
-                                {
-                                    'course_id': course_id,
-                                    'user_id':
-                                        attempt_detail['attempt']['userid'],
-                                    'quiz_id':
-                                        attempt_detail['attempt']['quiz'],
-                                    'attempt_id':
-                                        attempt_detail['attempt']['id'],
-                                    'attempt_number':
-                                        attempt_detail['attempt']['attempt'],
-                                    'answer': answer,
-                                    'question_number': question['slot'],
-                                }
-                            )
-    if len(attempt_multichoice_response_data) != 0:
-        return pd.DataFrame(attempt_multichoice_response_data)
-    else:
-        return pd.DataFrame(
-            columns=[
-                'course_id',
-                'user_id',
-                'quiz_id',
-                'attempt_id',
-                'attempt_number',
-                'answer',
-                'question_number'
-            ]
+        add_attempts(
+            course_id, grade_dict[course_id],
+            attempt_multichoice_response=attempt_multichoice_response
         )
+    return attempt_multichoice_response.to_df()
 
 
 def generate_enrollment_df(users_dict):
-    enrollment_data = []
+    enrollments = ColumnBuilder(ENROLLMENT_COLUMNS)
     for course_id in users_dict.keys():
-        for user in users_dict[course_id]:
-            enrollment_data.append({
-                'user_id': user['id'],
-                'course_id': course_id,
-                'role': user['roles'][0]['shortname']
-            })
-    return pd.DataFrame(enrollment_data)
+        add_enrollments(enrollments, course_id, users_dict[course_id])
+    return enrollments.to_df()
 
 
 def generate_courses_df(users_dict):
-    course_data = []
+    courses = ColumnBuilder(COURSE_COLUMNS)
     for course_id in users_dict.keys():
-        enrolled = users_dict[course_id][0]['enrolledcourses']
-        for course in enrolled:
-            if course['id'] == course_id:
-                course_data.append({
-                    'id': course['id'],
-                    'name': course['fullname']
-                    })
-    return pd.DataFrame(course_data)
+        add_course(courses, course_id, users_dict[course_id])
+    return courses.to_df()
 
 
 def generate_users_df(users_dict):
-    user_data = []
-    # Use email addresses to de-duplicate users
+    moodle_users = ColumnBuilder(USER_COLUMNS)
     seen_users = set()
-
     for course_id in users_dict.keys():
-        for user in users_dict[course_id]:
-            user_email = user['email']
-            if user_email not in seen_users:
-                seen_users.add(user_email)
-                user_data.append({
-                    "first_name": user['firstname'],
-                    "last_name": user['lastname'],
-                    "email": user_email,
-                    "user_id": user['id'],
-                    "uuid": user['uuid'] or uuid4()
-                })
-    return pd.DataFrame(user_data)
+        add_users(moodle_users, users_dict[course_id], seen_users)
+    return moodle_users.to_df()
@@ -1,11 +1,114 @@
 import os
 import argparse
+import logging
+import sys
 import boto3
 import pandas as pd
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 
-from enclave_mgmt.collect_data import collect_data
-from enclave_mgmt.create_models import create_models
+from enclave_mgmt import metrics
+from enclave_mgmt.cpus import available_cpus
+from enclave_mgmt.collect_data import (
+    collect_data, object_body, DEFAULT_MAX_WORKERS
+)
+from enclave_mgmt.create_models import (
+    create_models, required_raw_tables, DEFAULT_MODEL_WORKERS, MODEL_CLASSES
+)
+from enclave_mgmt.object_cache import ObjectCache
+from enclave_mgmt.write_models import (
+    DEFAULT_WRITE_WORKERS, OUTPUT_FORMATS, OUTPUT_FORMAT_CSV,
+    WRITE_EXECUTORS, WRITE_EXECUTOR_THREAD
+)
+from enclave_mgmt.validate_models import (
+    Validator, VALIDATION_LEVELS, VALIDATION_LEVEL_FULL, VALIDATION_MODES,
+    VALIDATION_MODE_VECTORIZED, DEFAULT_SAMPLE_FRACTION, DEFAULT_SAMPLE_SEED
+)
+
+YEAR_PLACEHOLDER = "{year}"
+YEAR_SPEC_PREFIXES = ['data_prefix', 'events_prefix', 'research_filter_prefix']
+
+RESEARCH_FILTER_COLUMNS = ['course_id', 'research_participation']
+RESEARCH_FILTER_DTYPES = {
+    'course_id': 'int64',
+}
+
+
+def parse_models(values):
+    """Map table names with or without an extension (e.g. users) to model
+    file names
+    """
+    if values is None:
+        return None
+    file_names = {
+        os.path.splitext(file_name)[0]: file_name
+        for file_name in MODEL_CLASSES
+    }
+    models = []
+    for value in values:
+        table = os.path.splitext(value)[0]
+        if table not in file_names:
+            raise argparse.ArgumentTypeError(f"Unknown model {value}")
+        models.append(file_names[table])
+    return models
+
+
+def parse_year_specs(values):
+    """Map YEAR=DATA_PREFIX,EVENTS_PREFIX[,RESEARCH_FILTER_PREFIX] arguments
+    to the prefixes of each year
+    """
+    year_specs = {}
+    for value in values or []:
+        year, _, prefixes = value.partition("=")
+        prefixes = prefixes.split(",")
+        if not year or year in year_specs or len(prefixes) not in (2, 3) \
+                or not all(prefixes):
+            raise argparse.ArgumentTypeError(f"Invalid year spec {value}")
+        year_specs[year] = dict(zip(YEAR_SPEC_PREFIXES, prefixes))
+    return year_specs
+
+
+def parse_table_validation_levels(values):
+    """Map TABLE=LEVEL arguments (e.g. content_loads=sampled) to validation
+    levels keyed by model class
+    """
+    models = {
+        os.path.splitext(file_name)[0]: model
+        for file_name, model in MODEL_CLASSES.items()
+    }
+    model_levels = {}
+    for value in values or []:
+        table, _, level = value.partition("=")
+        table = os.path.splitext(table)[0]
+        if table not in models or level not in VALIDATION_LEVELS:
+            raise argparse.ArgumentTypeError(
+                f"Invalid table validation level {value}"
+            )
+        model_levels[models[table]] = level
+    return model_levels
+
+
+def load_research_filter(bucket, key):
+    s3_client = boto3.client("s3")
+    courses_stream = s3_client.get_object(
+        Bucket=bucket,
+        Key=key)
+    metrics.add_s3_bytes(courses_stream.get("ContentLength", 0))
+    with object_body(courses_stream) as body:
+        courses_data_df = pd.read_csv(
+            body,
+            keep_default_na=False,
+            usecols=RESEARCH_FILTER_COLUMNS,
+            dtype=RESEARCH_FILTER_DTYPES
+        )
+    # Blank participation cells are read as NaN so those courses are not
+    # treated as participating
+    research_participation = pd.to_numeric(
+        courses_data_df['research_participation'], errors='coerce'
+    )
+    research_filter_df = courses_data_df[research_participation == 1]
+    return research_filter_df[[
+        'course_id'
+    ]]
 
 
 def main():
@@ -22,37 +125,208 @@ def main():
                         help='bucket containing research filter data')
     parser.add_argument('--research_filter_prefix', type=str,
                         help='prefix for research filter CSV')
+    parser.add_argument('--max_workers', type=int,
+                        default=DEFAULT_MAX_WORKERS,
+                        help='maximum number of concurrent S3 downloads '
+                             '(1 also collects the Moodle, content and '
+                             'event data sequentially)')
+    parser.add_argument('--cache_dir', type=str,
+                        help='local directory used to cache S3 objects '
+                             'between runs so only changed objects are '
+                             'downloaded')
+    parser.add_argument('--event_chunk_rows', type=int,
+                        help='process event tables out of core in chunks '
+                             'of this many rows instead of loading them '
+                             'whole')
+    parser.add_argument('--validation_mode', type=str,
+                        choices=VALIDATION_MODES,
+                        default=VALIDATION_MODE_VECTORIZED,
+                        help='how model dataframes are validated')
+    parser.add_argument('--validation_level', type=str,
+                        choices=VALIDATION_LEVELS,
+                        default=VALIDATION_LEVEL_FULL,
+                        help='how much of each model is validated')
+    parser.add_argument('--table_validation_level', type=str,
+                        action='append', metavar='TABLE=LEVEL',
+                        help='validation level override for a single table '
+                             '(may be repeated)')
+    parser.add_argument('--validation_sample_fraction', type=float,
+                        default=DEFAULT_SAMPLE_FRACTION,
+                        help='fraction of rows validated at the sampled '
+                             'level')
+    parser.add_argument('--validation_seed', type=int,
+                        default=DEFAULT_SAMPLE_SEED,
+                        help='random seed for sampled validation')
+    parser.add_argument('--output_format', type=str, nargs='+',
+                        choices=OUTPUT_FORMATS,
+                        default=[OUTPUT_FORMAT_CSV],
+                        help='file formats to write each model in')
+    parser.add_argument('--write_workers', type=int,
+                        default=DEFAULT_WRITE_WORKERS,
+                        help='maximum number of model files written '
+                             'concurrently')
+    parser.add_argument('--write_executor', type=str,
+                        choices=list(WRITE_EXECUTORS),
+                        default=WRITE_EXECUTOR_THREAD,
+                        help='use threads or processes to write model files')
+    parser.add_argument('--metrics_stderr', action='store_true',
+                        help='also write each stage of the metrics report '
+                             'to stderr as a JSON line when it ends')
+    parser.add_argument('--model_workers', type=int,
+                        default=DEFAULT_MODEL_WORKERS,
+                        help='maximum number of independent models built '
+                             'concurrently (default 1)')
+    parser.add_argument('--models', type=str, nargs='+',
+                        metavar='TABLE',
+                        help='only compile these tables (e.g. users '
+                             'grades), fetching just the data they need')
+    parser.add_argument('--years', type=str, nargs='+',
+                        help='compile each of these years into '
+                             'CSV_OUTPUT_DIR/<year>/, substituting the year '
+                             'for {year} in the data, events and research '
+                             'filter prefixes')
+    parser.add_argument('--year_spec', type=str, action='append',
+                        metavar='YEAR=DATA_PREFIX,EVENTS_PREFIX'
+                                '[,RESEARCH_FILTER_PREFIX]',
+                        help='compile a year into CSV_OUTPUT_DIR/<year>/ '
+                             'from these prefixes instead of the positional '
+                             'ones (may be repeated and combined with '
+                             '--years)')
+    parser.add_argument('--year_workers', type=int,
+                        help='maximum number of years compiled in parallel '
+                             'worker processes (defaults to one per year up '
+                             'to the number of CPUs)')
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     output_path = os.environ["CSV_OUTPUT_DIR"]
+    try:
+        validator = Validator(
+            mode=args.validation_mode,
+            level=args.validation_level,
+            sample_fraction=args.validation_sample_fraction,
+            seed=args.validation_seed,
+            model_levels=parse_table_validation_levels(
+                args.table_validation_level
+            )
+        )
+        args.models = parse_models(args.models)
+        args.year_specs = parse_year_specs(args.year_spec)
+    except (argparse.ArgumentTypeError, ValueError) as error:
+        parser.error(str(error))
+    if args.event_chunk_rows is not None and args.event_chunk_rows < 1:
+        parser.error("--event_chunk_rows must be at least 1")
+    years = (args.years or []) + list(args.year_specs)
+    if len(set(years)) != len(years):
+        parser.error("--years and --year_spec must not repeat a year")
+    if args.years and not any(
+        YEAR_PLACEHOLDER in (getattr(args, name) or "")
+        for name in YEAR_SPEC_PREFIXES
+    ):
+        parser.error(
+            f"--years needs {YEAR_PLACEHOLDER} in the data, events or "
+            "research filter prefix, otherwise use --year_spec"
+        )
+    if args.year_workers is not None and args.year_workers < 1:
+        parser.error("--year_workers must be at least 1")
+
+    if not years:
+        compile_year(args, output_path, validator)
+        return
+
+    year_workers = min(args.year_workers or available_cpus(), len(years))
+    if year_workers == 1:
+        for year in years:
+            compile_year(args, output_path, validator, year)
+        return
+    # Each worker process creates its own S3 client and connection pool
+    with ProcessPoolExecutor(max_workers=year_workers) as executor:
+        futures = [
+            executor.submit(compile_year, args, output_path, validator, year)
+            for year in years
+        ]
+        for future in futures:
+            future.result()
+
+
+def year_args(args, year):
+    """Return a copy of args for a single year with the prefixes given for
+    it by --year_spec, or with the year substituted into the S3 prefixes.
+    Each year gets its own cache directory so parallel years do not
+    overwrite each other's cache index.
+    """
+    year_args = argparse.Namespace(**vars(args))
+    year_spec = getattr(args, 'year_specs', {}).get(year, {})
+    for name in YEAR_SPEC_PREFIXES:
+        value = getattr(args, name)
+        if name in year_spec:
+            setattr(year_args, name, year_spec[name])
+        elif value is not None:
+            setattr(year_args, name, value.replace(YEAR_PLACEHOLDER, year))
+    if args.cache_dir:
+        year_args.cache_dir = os.path.join(args.cache_dir, year)
+    return year_args
+
+
+def compile_year(args, output_path, validator, year=None):
+    """Compile the models for one year, or for the prefixes as given when
+    year is None, and write the metrics report next to them
+    """
+    if year is not None:
+        args = year_args(args, year)
+        output_path = os.path.join(output_path, year)
+        os.makedirs(output_path, exist_ok=True)
+    with metrics.recording(
+        sys.stderr if args.metrics_stderr else None
+    ) as recorder:
+        run(args, output_path, validator)
+    recorder.write_report(output_path)
+
+
+def run(args, output_path, validator):
+    research_filter_df = None
+    course_ids = None
+    research_filter_bucket = args.research_filter_bucket
+    research_filter_key = args.research_filter_prefix
+    if research_filter_bucket and research_filter_key:
+        with metrics.stage("load_research_filter"):
+            research_filter_df = load_research_filter(
+                research_filter_bucket, research_filter_key
+            )
+        course_ids = set(research_filter_df['course_id'])
+
+    cache = None
+    if args.cache_dir:
+        cache = ObjectCache(args.cache_dir)
 
     all_raw_dfs = collect_data(
         args.data_bucket,
         args.data_prefix,
         args.events_bucket,
-        args.events_prefix
+        args.events_prefix,
+        args.max_workers,
+        course_ids,
+        cache,
+        args.event_chunk_rows,
+        None if args.models is None else required_raw_tables(
+            args.models, research_filter_df is not None
         )
-
-    research_filter_bucket = args.research_filter_bucket
-    research_filter_key = args.research_filter_prefix
-    if research_filter_bucket and research_filter_key:
-        s3_client = boto3.client("s3")
-        courses_stream = s3_client.get_object(
-            Bucket=research_filter_bucket,
-            Key=research_filter_key)
-        courses_data_df = pd.read_csv(
-            BytesIO(courses_stream["Body"].read()),
-            keep_default_na=False
         )
-        research_filter_df = courses_data_df[courses_data_df[
-            'research_participation'] == 1]
-        research_filter_df = research_filter_df[[
-            'course_id'
-        ]]
-        create_models(output_path, all_raw_dfs, research_filter_df)
-    else:
-        create_models(output_path, all_raw_dfs)
+
+    create_models(
+        output_path, all_raw_dfs, research_filter_df,
+        validator=validator,
+        output_formats=args.output_format,
+        write_workers=args.write_workers,
+        write_executor=args.write_executor,
+        models=args.models,
+        model_workers=args.model_workers
+    )
+
+    if cache is not None:
+        cache.save()
+        cache.write_manifest(output_path)
 
 
 if __name__ == "__main__":  # pragma: no cover
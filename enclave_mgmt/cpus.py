@@ -0,0 +1,49 @@
+import math
+import os
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """CPUs allowed by the cgroup CPU quota (e.g. a Kubernetes pod CPU
+    limit) rounded up, or None when there is no quota
+    """
+    cpu_max = read_first_line(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota = read_first_line(CGROUP_V1_CPU_QUOTA)
+        period = read_first_line(CGROUP_V1_CPU_PERIOD)
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        # "max" (v2), missing files or an unlimited quota of -1 (v1)
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return math.ceil(quota / period)
+
+
+def available_cpus():
+    """CPUs this process may run on: the CPUs in its affinity mask capped
+    by the cgroup CPU quota. os.cpu_count() reports every CPU of the node
+    even when the pod is limited to a few of them.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(cpus, 1)
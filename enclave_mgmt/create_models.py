@@ -1,4 +1,10 @@
+import logging
+import numpy as np
 import pandas as pd
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait
+)
+from enclave_mgmt import metrics
 from enclave_mgmt.models import (
     Assessment, ContentLoads, Course, CourseContents, Grade,
     User, QuizMultichoiceAnswer, QuizQuestion,
@@ -7,6 +13,13 @@ from enclave_mgmt.models import (
     IBProblemAttempts, IBInputSubmissions,
     QuizAttempts, QuizAttemptMultichoiceResponses
 )
+from enclave_mgmt.validate_models import DEFAULT_VALIDATOR, rule_columns
+from enclave_mgmt.write_models import (
+    write_models, DEFAULT_WRITE_WORKERS, OUTPUT_FORMAT_CSV,
+    WRITE_EXECUTOR_THREAD
+)
+
+logger = logging.getLogger(__name__)
 
 MODEL_FILE_USERS = "users.csv"
 MODEL_FILE_COURSES = "courses.csv"
@@ -26,65 +39,159 @@ MODEL_CONTENT_LOADS = "content_loads.csv"
 MODEL_IB_PSET_PROBLEM_ATTEMPTS = "ib_pset_problem_attempts.csv"
 MODEL_IB_INPUT_SUBMISSIONS = "ib_input_submissions.csv"
 
+# Model building is mostly GIL bound, so models are built one at a time
+# unless benchmarks/bench_model_workers.py shows more threads pay off
+DEFAULT_MODEL_WORKERS = 1
+
+MODEL_CLASSES = {
+    MODEL_FILE_USERS: User,
+    MODEL_FILE_COURSES: Course,
+    MODEL_FILE_ENROLLMENTS: Enrollment,
+    MODEL_FILE_ASSESSMENTS: Assessment,
+    MODEL_FILE_GRADES: Grade,
+    MODEL_QUIZ_QUESTIONS: QuizQuestion,
+    MODEL_QUIZ_QUESTION_CONTENTS: QuizQuestionContents,
+    MODEL_MULTICHOICE_ANSWERS: QuizMultichoiceAnswer,
+    MODEL_INPUT_INSTANCES: InputInteractiveBlock,
+    MODEL_PSET_PROBLEMS: ProblemSetProblem,
+    MODEL_COURSE_CONTENTS: CourseContents,
+    MODEL_QUIZ_ATTEMPTS: QuizAttempts,
+    MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES: QuizAttemptMultichoiceResponses,
+    MODEL_CONTENT_LOADS: ContentLoads,
+    MODEL_IB_PSET_PROBLEM_ATTEMPTS: IBProblemAttempts,
+    MODEL_IB_INPUT_SUBMISSIONS: IBInputSubmissions,
+}
+
+
+def create_models(output_path, all_raw_dfs, research_filter_df=None,
+                  validator=DEFAULT_VALIDATOR,
+                  output_formats=(OUTPUT_FORMAT_CSV,),
+                  write_workers=DEFAULT_WRITE_WORKERS,
+                  write_executor=WRITE_EXECUTOR_THREAD,
+                  models=None, model_workers=DEFAULT_MODEL_WORKERS):
+    """Build and write the model files in models (all of them by default).
+    Only the nodes of MODEL_NODES those models depend on are built, so
+    all_raw_dfs only needs the tables returned by required_raw_tables.
+    Independent nodes are built concurrently by up to model_workers
+    threads.
+    """
+    models = list(MODEL_CLASSES) if models is None else models
+    with metrics.stage("scrub_raw_dfs"):
+        clean_raw_df = scrub_raw_dfs(all_raw_dfs)
+
+    built = build_nodes(
+        required_nodes(models, research_filter_df is not None),
+        clean_raw_df, validator, model_workers
+    )
 
-def create_models(output_path, all_raw_dfs, research_filter_df=None):
-
-    clean_raw_df = scrub_raw_dfs(all_raw_dfs)
+    if research_filter_df is not None:
+        apply_research_filter(research_filter_df, built)
+
+    tables = {
+        file_name: built[file_name]
+        for file_name in MODEL_CLASSES if file_name in models
+    }
+    return write_models(
+        output_path, tables, MODEL_CLASSES, output_formats,
+        write_workers, write_executor
+    )
 
-    assessments_df, grades_df = assessments_and_grades_model(clean_raw_df)
-    users_df = users_model(clean_raw_df)
-    enrollments_df = enrollments_model(clean_raw_df)
-    courses_df = courses_model(clean_raw_df)
-    quiz_questions_df = questions_model(clean_raw_df, assessments_df)
-    quiz_question_contents_df = question_contents_model(clean_raw_df)
-    quiz_multichoice_answers_df = multichoice_answer_model(clean_raw_df)
-    ib_input_df = ib_input_model(clean_raw_df)
-    ib_problem_df = ib_problem_model(clean_raw_df)
-    course_contents_df = course_contents_model(clean_raw_df)
-    content_loads_df = content_loads_model(clean_raw_df)
-    ib_pset_problem_attempts_df = ib_pset_problem_attempts_model(clean_raw_df)
-    ib_input_submissions_df = ib_input_submissions_model(clean_raw_df)
 
-    (
-        quiz_attempts_df,
-        quiz_attempt_multichoice_responses_df,
-    ) = quiz_attempts_and_multichoice_responses_model(
-        clean_raw_df, assessments_df, quiz_multichoice_answers_df
+def build_node(name, clean_raw_df, validator, built):
+    """Build a node from the outputs of its dependencies in built and
+    return its outputs by name
+    """
+    node = MODEL_NODES[name]
+    result = node.build(
+        clean_raw_df, validator=validator, **{
+            argument: built[dependency]
+            for argument, dependency in node.dependencies.items()
+        }
     )
-
-    if research_filter_df is not None:
-        enrollments_df = filter_dataframes_by_course_id(
-            research_filter_df, enrollments_df
-        )
-        grades_df = filter_dataframes_by_course_id(
-            research_filter_df, grades_df
-        )
-        content_loads_df = filter_dataframes_by_course_id(
-            research_filter_df, content_loads_df
-        )
-        ib_input_submissions_df = filter_dataframes_by_course_id(
-            research_filter_df, ib_input_submissions_df
-        )
-        ib_pset_problem_attempts_df = filter_dataframes_by_course_id(
-            research_filter_df, ib_pset_problem_attempts_df
-        )
-        quiz_attempts_df = filter_dataframes_by_course_id(
-            research_filter_df, quiz_attempts_df
+    if len(node.outputs) == 1:
+        result = (result,)
+    return dict(zip(node.outputs, result))
+
+
+def build_nodes(nodes, clean_raw_df, validator,
+                max_workers=DEFAULT_MODEL_WORKERS):
+    """Build the nodes, given in dependency order, and return all of their
+    outputs by name. Each node is started as soon as the nodes it depends
+    on are built, so the run time approaches the longest chain of
+    dependent nodes rather than the sum of all of them.
+    """
+    built = {}
+    if max_workers <= 1:
+        for name in nodes:
+            built |= build_node(name, clean_raw_df, validator, built)
+        return built
+
+    waiting = {
+        name: {
+            NODE_OUTPUTS[dependency]
+            for dependency in MODEL_NODES[name].dependencies.values()
+        }
+        for name in nodes
+    }
+    done = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while waiting or running:
+            for name in [
+                name for name, dependencies in waiting.items()
+                if dependencies <= done
+            ]:
+                del waiting[name]
+                running[executor.submit(
+                    build_node, name, clean_raw_df, validator, dict(built)
+                )] = name
+            if not running:
+                raise ValueError(
+                    f"Unresolved model dependencies for {sorted(waiting)}"
+                )
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                built |= future.result()
+                done.add(running.pop(future))
+    return built
+
+
+def apply_research_filter(research_filter_df, tables):
+    """Keep only the rows of research courses in each built table"""
+    def by_course_id(df):
+        return filter_dataframes_by_course_id(research_filter_df, df)
+
+    for file_name in [
+        MODEL_FILE_ENROLLMENTS, MODEL_FILE_GRADES, MODEL_QUIZ_ATTEMPTS
+    ]:
+        if file_name in tables:
+            tables[file_name] = by_course_id(tables[file_name])
+    for file_name in [
+        MODEL_CONTENT_LOADS, MODEL_IB_INPUT_SUBMISSIONS,
+        MODEL_IB_PSET_PROBLEM_ATTEMPTS
+    ]:
+        if file_name in tables:
+            tables[file_name] = map_chunks(by_course_id, tables[file_name])
+    if MODEL_FILE_USERS in tables:
+        tables[MODEL_FILE_USERS] = filter_users_by_enrollments(
+            tables[MODEL_FILE_ENROLLMENTS], tables[MODEL_FILE_USERS]
         )
-        users_df = filter_users_by_enrollments(enrollments_df, users_df)
+    if MODEL_FILE_COURSES in tables:
         courses_df = pd.merge(
-            research_filter_df, courses_df,
+            research_filter_df, tables[MODEL_FILE_COURSES],
             left_on='course_id', right_on='id'
         )
-        courses_df = courses_df[
+        tables[MODEL_FILE_COURSES] = courses_df[
             ['id',
              'name']
         ]
+    if MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES in tables:
         quiz_attempt_multichoice_responses_df = pd.merge(
-            quiz_attempts_df, quiz_attempt_multichoice_responses_df,
+            tables[MODEL_QUIZ_ATTEMPTS],
+            tables[MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES],
             left_on='id', right_on='attempt_id'
         )
-        quiz_attempt_multichoice_responses_df = (
+        tables[MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES] = (
             quiz_attempt_multichoice_responses_df[
                 ['attempt_id',
                  'question_number',
@@ -92,134 +199,213 @@ def create_models(output_path, all_raw_dfs, research_filter_df=None):
                  'answer_id']
             ])
 
-    with open(f"{output_path}/{MODEL_FILE_USERS}", "w") as f:
-        users_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_FILE_GRADES}", "w") as f:
-        grades_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_FILE_ENROLLMENTS}", "w") as f:
-        enrollments_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_FILE_COURSES}", "w") as f:
-        courses_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_FILE_ASSESSMENTS}", "w") as f:
-        assessments_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_QUIZ_QUESTIONS}", "w") as f:
-        quiz_questions_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_QUIZ_QUESTION_CONTENTS}", "w") as f:
-        quiz_question_contents_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_MULTICHOICE_ANSWERS}", "w") as f:
-        quiz_multichoice_answers_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_INPUT_INSTANCES}", "w") as f:
-        ib_input_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_PSET_PROBLEMS}", "w") as f:
-        ib_problem_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_COURSE_CONTENTS}", "w") as f:
-        course_contents_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_QUIZ_ATTEMPTS}", "w") as f:
-        quiz_attempts_df.to_csv(f, index=False)
-    with open(
-        f"{output_path}/{MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES}", "w")\
-            as f:
-        quiz_attempt_multichoice_responses_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_CONTENT_LOADS}", "w") as f:
-        content_loads_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_IB_PSET_PROBLEM_ATTEMPTS}", "w") as f:
-        ib_pset_problem_attempts_df.to_csv(f, index=False)
-    with open(f"{output_path}/{MODEL_IB_INPUT_SUBMISSIONS}", "w") as f:
-        ib_input_submissions_df.to_csv(f, index=False)
+
+# Lookups shared by the model builders so that user ids, enrollments and
+# assessment names are indexed once per run. Model builders map keys through
+# these indexes and filter rows with semi-joins instead of merging against
+# the source tables. Each lookup is its own node so a builder only pulls in
+# the raw tables of the lookups it uses.
+
+
+def shared_lookup(values, index):
+    """Series that maps keys through map_column from several model
+    threads at once. pandas builds the hash table of an index lazily on
+    first use and doing so from several threads can corrupt it, so it is
+    built here before the lookup is shared.
+    """
+    lookup = pd.Series(values, index=index)
+    # get_indexer builds the index engine and populates its hash table, the
+    # same path map_column takes. An empty target would return early.
+    lookup.index.get_indexer(lookup.index[:1])
+    return lookup
+
+
+@metrics.model_stage('moodle_users')
+def user_uuids_lookup(clean_raw_df, validator=None):
+    """Series of user uuids indexed by Moodle user id"""
+    moodle_users = clean_raw_df['moodle_users'].drop_duplicates(
+        subset='user_id'
+    )
+    return shared_lookup(
+        moodle_users['uuid'].to_numpy(), moodle_users['user_id']
+    )
+
+
+@metrics.model_stage('enrollments')
+def enrollment_keys_lookup(clean_raw_df, validator=None, user_uuids=None):
+    """Unique (user uuid, course id) pairs of the enrollments"""
+    if user_uuids is None:
+        user_uuids = user_uuids_lookup(clean_raw_df)
+    enrollments = map_column(
+        clean_raw_df['enrollments'], 'user_id', user_uuids, 'user_uuid'
+    )
+    return pd.MultiIndex.from_arrays([
+        enrollments['user_uuid'], enrollments['course_id']
+    ]).unique()
+
+
+@metrics.model_stage('grades')
+def assessment_ids_lookup(clean_raw_df, validator=None):
+    """Series of assessment ids indexed by assessment name in the order the
+    names first appear in the grades
+    """
+    assessment_names = clean_raw_df['grades']['assessment_name'].unique()
+    return shared_lookup(range(len(assessment_names)), assessment_names)
+
+
+def is_enrolled(enrollment_keys, user_uuids, course_ids):
+    return pd.MultiIndex.from_arrays(
+        [user_uuids, course_ids]
+    ).isin(enrollment_keys)
+
+
+def map_column(df, column, lookup, name):
+    """Replace column with its values mapped through lookup (a series
+    indexed by the column values) and rename it to name. Rows without a
+    match are dropped like an inner merge would.
+    """
+    positions = lookup.index.get_indexer(df[column])
+    matched = positions >= 0
+    df = df[matched].reset_index(drop=True)
+    df[column] = lookup.to_numpy()[positions[matched]]
+    return df.rename(columns={column: name})
+
+
+def map_chunks(function, table):
+    """Apply function to a dataframe, or lazily to each chunk when event
+    tables are processed as iterators of dataframe chunks
+    """
+    if isinstance(table, pd.DataFrame):
+        return function(table)
+    return (function(chunk) for chunk in table)
+
+
+def parse_percentages(series):
+    """Parse Moodle formatted percentages (e.g. "85.00 %") as floats with
+    "-" (not graded) as NaN. Grades repeat heavily so each distinct value is
+    parsed once and the results are taken back out by code.
+    """
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = uniques.where(uniques.ne('-')).str.strip('%').astype(float)
+    return pd.Series(
+        np.where(codes >= 0, parsed.to_numpy()[codes], np.nan),
+        index=series.index
+    )
 
 
 def scrub_raw_dfs(all_raw_dfs):
-    moodle_users_df = all_raw_dfs['moodle_users']
+    if 'moodle_users' in all_raw_dfs:
+        moodle_users_df = all_raw_dfs['moodle_users']
 
-    moodle_users_df['email'] = moodle_users_df['email'].apply(
-        lambda col: col.lower())
+        moodle_users_df['email'] = moodle_users_df['email'].str.lower()
 
-    grade_df = all_raw_dfs['grades']
-    grade_df = grade_df[grade_df['assessment_name'].notnull()]
+        all_raw_dfs['moodle_users'] = moodle_users_df
+
+    if 'grades' in all_raw_dfs:
+        grade_df = all_raw_dfs['grades']
+        grade_df = grade_df[grade_df['assessment_name'].notnull()].copy()
+        grade_df['grade_percentage'] = parse_percentages(
+            grade_df['grade_percentage']
+        )
+        # Ungraded rows have no submission time so timestamps stay numeric
+        # with NaN until the grades model drops them and casts to integers
+        grade_df['time_submitted'] = pd.to_numeric(
+            grade_df['time_submitted']
+        )
 
-    all_raw_dfs['moodle_users'] = moodle_users_df
-    all_raw_dfs['grades'] = grade_df
+        all_raw_dfs['grades'] = grade_df
     return all_raw_dfs
 
 
-def multichoice_answer_model(clean_raw_df):
+@metrics.model_stage('quiz_multichoice_answers')
+def multichoice_answer_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     quiz_multichoice_answer_df = clean_raw_df['quiz_multichoice_answers']
     quiz_multichoice_answer_df.insert(
         0, 'id', quiz_multichoice_answer_df.index
     )
-    for item in quiz_multichoice_answer_df.to_dict(orient='records'):
-        QuizMultichoiceAnswer.model_validate(item)
+    validator.validate(quiz_multichoice_answer_df, QuizMultichoiceAnswer)
     return quiz_multichoice_answer_df
 
 
-def question_contents_model(clean_raw_df):
+@metrics.model_stage('quiz_question_contents')
+def question_contents_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     quiz_question_contents_df = clean_raw_df['quiz_question_contents']
-    for item in quiz_question_contents_df.to_dict(orient='records'):
-        QuizQuestionContents.model_validate(item)
+    validator.validate(quiz_question_contents_df, QuizQuestionContents)
     return quiz_question_contents_df
 
 
-def questions_model(clean_raw_df, assessments_df):
+@metrics.model_stage('quiz_questions')
+def questions_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                    assessment_ids=None):
+    if assessment_ids is None:
+        assessment_ids = assessment_ids_lookup(clean_raw_df)
     quiz_questions_df = clean_raw_df['quiz_questions']
-    quiz_questions_df = pd.merge(
-        quiz_questions_df, assessments_df, left_on='quiz_name', right_on='name'
+    quiz_questions_df = map_column(
+        quiz_questions_df, 'quiz_name', assessment_ids, 'assessment_id'
     )
-    quiz_questions_df.rename(columns={'id': 'assessment_id'}, inplace=True)
     quiz_questions_df = quiz_questions_df[
         ['assessment_id',
          'question_number',
          'question_id']
     ]
-    for item in quiz_questions_df.to_dict(orient='records'):
-        QuizQuestion.model_validate(item)
+    validator.validate(quiz_questions_df, QuizQuestion)
     return quiz_questions_df
 
 
-def courses_model(clean_raw_df):
+@metrics.model_stage('courses')
+def courses_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     courses_df = clean_raw_df['courses']
 
-    for item in courses_df.to_dict(orient='records'):
-        Course.model_validate(item)
+    validator.validate(courses_df, Course)
 
     return courses_df
 
 
-def enrollments_model(clean_raw_df):
+@metrics.model_stage('enrollments')
+def enrollments_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                      user_uuids=None):
+    if user_uuids is None:
+        user_uuids = user_uuids_lookup(clean_raw_df)
     enrollments_df = clean_raw_df['enrollments']
-    users_df = clean_raw_df['moodle_users'][['user_id', 'uuid']]
-    enrollments_df = pd.merge(enrollments_df, users_df, on='user_id')
-    enrollments_df.rename(columns={'uuid': 'user_uuid'}, inplace=True)
+    enrollments_df = map_column(
+        enrollments_df, 'user_id', user_uuids, 'user_uuid'
+    )
     enrollments_df = enrollments_df[['user_uuid', 'course_id', 'role']]
 
-    for item in enrollments_df.to_dict(orient='records'):
-        Enrollment.model_validate(item)
+    validator.validate(enrollments_df, Enrollment)
 
     return enrollments_df
 
 
-def users_model(clean_raw_df):
+@metrics.model_stage('moodle_users')
+def users_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     users_df = clean_raw_df['moodle_users']
     users_df = users_df[['uuid', 'first_name', 'last_name', 'email']]
 
-    for item in users_df.to_dict(orient='records'):
-        User.model_validate(item)
+    validator.validate(users_df, User)
 
     return users_df
 
 
-def assessments_and_grades_model(clean_raw_df):
+@metrics.model_stage('grades')
+def assessments_and_grades_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                                 assessment_ids=None, user_uuids=None):
+    if assessment_ids is None:
+        assessment_ids = assessment_ids_lookup(clean_raw_df)
+    if user_uuids is None:
+        user_uuids = user_uuids_lookup(clean_raw_df)
     grades_df = clean_raw_df['grades']
-    assessments_df = pd.DataFrame(
-        grades_df['assessment_name'].unique(), columns=['name']
+    assessments_df = pd.DataFrame({
+        'name': assessment_ids.index,
+        'id': assessment_ids.to_numpy()
+    })
+    grades_df = map_column(
+        grades_df, 'assessment_name', assessment_ids, 'assessment_id'
     )
-    assessments_df['id'] = assessments_df.index
-    grades_df = pd.merge(
-        grades_df, assessments_df, left_on='assessment_name', right_on='name'
+    grades_df = map_column(
+        grades_df, 'user_id', user_uuids, 'user_uuid'
     )
-    grades_df.rename(columns={'id': 'assessment_id'}, inplace=True)
-    moodle_users = clean_raw_df['moodle_users'][['user_id', 'uuid']]
-    grades_df = pd.merge(grades_df, moodle_users, on='user_id')
-    grades_df.rename(columns={'uuid': 'user_uuid'}, inplace=True)
     grades_df = grades_df[
         ['assessment_id',
          'user_uuid',
@@ -228,26 +414,16 @@ def assessments_and_grades_model(clean_raw_df):
          'time_submitted'
          ]
     ]
-
-    def convert_percentage(x):
-        if x == '-':
-            return None
-        return float(x.strip("%"))
-
-    grades_df['grade_percentage'] = grades_df['grade_percentage'].map(
-        convert_percentage
-    )
     grades_df = grades_df[grades_df['grade_percentage'].notnull()]
     grades_df['time_submitted'] = grades_df['time_submitted'].astype(int)
 
-    for item in assessments_df.to_dict(orient='records'):
-        Assessment.model_validate(item)
-    for item in grades_df.to_dict(orient='records'):
-        Grade.model_validate(item)
+    validator.validate(assessments_df, Assessment)
+    validator.validate(grades_df, Grade)
     return assessments_df, grades_df
 
 
-def ib_input_model(clean_raw_df):
+@metrics.model_stage('ib_input_instances')
+def ib_input_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     ib_input_df = clean_raw_df['ib_input_instances']
     ib_input_df = ib_input_df[
                 ['id',
@@ -256,13 +432,13 @@ def ib_input_model(clean_raw_df):
                  'content',
                  'prompt']]
 
-    for item in ib_input_df.to_dict(orient='records'):
-        InputInteractiveBlock.model_validate(item)
+    validator.validate(ib_input_df, InputInteractiveBlock)
 
     return ib_input_df
 
 
-def ib_problem_model(clean_raw_df):
+@metrics.model_stage('ib_pset_problems')
+def ib_problem_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     ib_problem_df = clean_raw_df['ib_pset_problems']
     ib_problem_df = ib_problem_df[
                   ['id',
@@ -274,13 +450,13 @@ def ib_problem_model(clean_raw_df):
                    'solution',
                    'solution_options']]
 
-    for item in ib_problem_df.to_dict(orient='records'):
-        ProblemSetProblem.model_validate(item)
+    validator.validate(ib_problem_df, ProblemSetProblem)
 
     return ib_problem_df
 
 
-def course_contents_model(clean_raw_df):
+@metrics.model_stage('course_contents')
+def course_contents_model(clean_raw_df, validator=DEFAULT_VALIDATOR):
     course_contents_df = clean_raw_df['course_contents']
     course_contents_df = course_contents_df[
                   ['section',
@@ -289,92 +465,260 @@ def course_contents_model(clean_raw_df):
                    'content_id',
                    ]]
 
-    for item in course_contents_df.to_dict(orient='records'):
-        CourseContents.model_validate(item)
+    validator.validate(course_contents_df, CourseContents)
 
     return course_contents_df
 
 
-def filter_events(event_df, clean_raw_df):
-    enrollments_df = clean_raw_df['enrollments']
-    users_df = clean_raw_df['moodle_users'][['user_id', 'uuid']]
-    enrollments_df = pd.merge(enrollments_df, users_df, on='user_id')
-    enrollments_df.rename(columns={'uuid': 'user_uuid'}, inplace=True)
-    filter_df = enrollments_df[['user_uuid', 'course_id']]
-    event_df = pd.merge(event_df, filter_df,
-                        on=['user_uuid', 'course_id'])
-    return event_df
-
-
-def content_loads_model(clean_raw_df):
-    content_loads_df = clean_raw_df['content_loads']
-    content_loads_df = content_loads_df[
-                    ['user_uuid',
-                     'course_id',
-                     'impression_id',
-                     'timestamp',
-                     'content_id',
-                     'variant']]
-
-    content_loads_df = filter_events(content_loads_df, clean_raw_df)
-
-    for item in content_loads_df.to_dict(orient='records'):
-        ContentLoads.model_validate(item)
-
-    return content_loads_df
-
-
-def ib_input_submissions_model(clean_raw_df):
-    ib_input_submissions_df = clean_raw_df['ib_input_submissions']
-    ib_input_submissions_df = ib_input_submissions_df[
-                    ['user_uuid',
-                     'course_id',
-                     'impression_id',
-                     'timestamp',
-                     'content_id',
-                     'input_content_id',
-                     'variant',
-                     'response']]
-
-    ib_input_submissions_df = filter_events(ib_input_submissions_df,
-                                            clean_raw_df)
-
-    for item in ib_input_submissions_df.to_dict(orient='records'):
-        IBInputSubmissions.model_validate(item)
-
-    return ib_input_submissions_df
-
-
-def ib_pset_problem_attempts_model(clean_raw_df):
-    ib_pset_problem_attempts_df = clean_raw_df['ib_pset_problem_attempts']
-    ib_pset_problem_attempts_df = ib_pset_problem_attempts_df[
-                    ['user_uuid',
-                     'course_id',
-                     'impression_id',
-                     'timestamp',
-                     'content_id',
-                     'pset_content_id',
-                     'pset_problem_content_id',
-                     'variant',
-                     'problem_type',
-                     'response',
-                     'correct',
-                     'attempt',
-                     'final_attempt']]
-
-    ib_pset_problem_attempts_df = filter_events(ib_pset_problem_attempts_df,
-                                                clean_raw_df)
-
-    for item in ib_pset_problem_attempts_df.to_dict(orient='records'):
-        IBProblemAttempts.model_validate(item)
-
-    return ib_pset_problem_attempts_df
+def filter_events(event_df, clean_raw_df, enrollment_keys=None):
+    """Keep events from users enrolled in the course of the event"""
+    if enrollment_keys is None:
+        enrollment_keys = enrollment_keys_lookup(clean_raw_df)
+    enrolled = is_enrolled(
+        enrollment_keys, event_df['user_uuid'], event_df['course_id']
+    )
+    return event_df[enrolled].reset_index(drop=True)
+
+
+@metrics.model_stage('content_loads')
+def content_loads_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                        enrollment_keys=None):
+    if enrollment_keys is None:
+        enrollment_keys = enrollment_keys_lookup(clean_raw_df)
+
+    def build(content_loads_df):
+        content_loads_df = content_loads_df[
+                        ['user_uuid',
+                         'course_id',
+                         'impression_id',
+                         'timestamp',
+                         'content_id',
+                         'variant']]
+
+        content_loads_df = filter_events(
+            content_loads_df, clean_raw_df, enrollment_keys
+        )
+
+        validator.validate(content_loads_df, ContentLoads)
+
+        return content_loads_df
+
+    return map_chunks(build, clean_raw_df['content_loads'])
+
+
+@metrics.model_stage('ib_input_submissions')
+def ib_input_submissions_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                               enrollment_keys=None):
+    if enrollment_keys is None:
+        enrollment_keys = enrollment_keys_lookup(clean_raw_df)
+
+    def build(ib_input_submissions_df):
+        ib_input_submissions_df = ib_input_submissions_df[
+                        ['user_uuid',
+                         'course_id',
+                         'impression_id',
+                         'timestamp',
+                         'content_id',
+                         'input_content_id',
+                         'variant',
+                         'response']]
+
+        ib_input_submissions_df = filter_events(
+            ib_input_submissions_df, clean_raw_df, enrollment_keys
+        )
+
+        validator.validate(ib_input_submissions_df, IBInputSubmissions)
+
+        return ib_input_submissions_df
+
+    return map_chunks(build, clean_raw_df['ib_input_submissions'])
+
+
+@metrics.model_stage('ib_pset_problem_attempts')
+def ib_pset_problem_attempts_model(clean_raw_df, validator=DEFAULT_VALIDATOR,
+                                   enrollment_keys=None):
+    if enrollment_keys is None:
+        enrollment_keys = enrollment_keys_lookup(clean_raw_df)
+
+    def build(ib_pset_problem_attempts_df):
+        columns = ['user_uuid',
+                   'course_id',
+                   'impression_id',
+                   'timestamp',
+                   'content_id',
+                   'pset_content_id',
+                   'pset_problem_content_id',
+                   'variant',
+                   'problem_type',
+                   'response',
+                   'correct',
+                   'attempt',
+                   'final_attempt']
+        ib_pset_problem_attempts_df = ib_pset_problem_attempts_df[
+            columns + rule_columns(
+                ib_pset_problem_attempts_df, IBProblemAttempts
+            )
+        ]
+
+        ib_pset_problem_attempts_df = filter_events(
+            ib_pset_problem_attempts_df, clean_raw_df, enrollment_keys
+        )
+
+        validator.validate(ib_pset_problem_attempts_df, IBProblemAttempts)
 
+        return ib_pset_problem_attempts_df[columns]
 
+    return map_chunks(build, clean_raw_df['ib_pset_problem_attempts'])
+
+
+@metrics.model_stage(
+    'attempts_summary', 'attempt_multichoice_response', 'quiz_data',
+    'quiz_questions'
+)
 def quiz_attempts_and_multichoice_responses_model(
-    clean_raw_df, assessments_df, quiz_multichoice_answers_df
+    clean_raw_df, quiz_multichoice_answers_df,
+    validator=DEFAULT_VALIDATOR, user_uuids=None, assessment_ids=None
+):
+    if user_uuids is None:
+        user_uuids = user_uuids_lookup(clean_raw_df)
+    if assessment_ids is None:
+        assessment_ids = assessment_ids_lookup(clean_raw_df)
+    dfs = lookup_quiz_attempts_and_multichoice_responses(
+        clean_raw_df, quiz_multichoice_answers_df, user_uuids, assessment_ids
+    )
+    if dfs is None:
+        dfs = merge_quiz_attempts_and_multichoice_responses(
+            clean_raw_df, quiz_multichoice_answers_df, user_uuids,
+            assessment_ids
+        )
+    quiz_attempts_df, quiz_attempt_multichoice_responses_df = dfs
+
+    validator.validate(quiz_attempts_df, QuizAttempts)
+
+    validator.validate(
+        quiz_attempt_multichoice_responses_df,
+        QuizAttemptMultichoiceResponses
+    )
+    return quiz_attempts_df, quiz_attempt_multichoice_responses_df
+
+
+def lookup_quiz_attempts_and_multichoice_responses(
+    clean_raw_df, quiz_multichoice_answers_df, user_uuids, assessment_ids
 ):
+    """Build the quiz attempt and multichoice response tables by mapping
+    keys through indexes built once instead of chaining merges. Rows come
+    out in the same order as the inner merges in
+    merge_quiz_attempts_and_multichoice_responses. Attempts are keyed by
+    course and attempt id. Returns None when a lookup key repeats, since
+    the merges would then fan rows out.
+    """
+    quiz_data = clean_raw_df['quiz_data']
+    quiz_questions = clean_raw_df['quiz_questions']
+    attempts_summary = clean_raw_df['attempts_summary']
+    attempt_multichoice_response = clean_raw_df['attempt_multichoice_response']
+    quiz_index = pd.Index(quiz_data['quiz_id'])
+    question_index = pd.MultiIndex.from_frame(
+        quiz_questions[['quiz_name', 'question_number']]
+    )
+    answer_index = pd.MultiIndex.from_frame(
+        quiz_multichoice_answers_df[['question_id', 'text']]
+    )
+    if not (quiz_index.is_unique and question_index.is_unique and
+            answer_index.is_unique):
+        logger.info(
+            "Quiz, question or answer keys repeat, merging quiz responses "
+            "instead of looking them up"
+        )
+        return None
+
+    quiz_positions = quiz_index.get_indexer(attempts_summary['quiz_id'])
+    matched = quiz_positions >= 0
+    quiz_attempts_df = attempts_summary[matched].reset_index(drop=True)
+    quiz_attempts_df['max_grade'] = \
+        quiz_data['max_grade'].to_numpy()[quiz_positions[matched]]
+    quiz_attempts_df['quiz_name'] = \
+        quiz_data['quiz_name'].to_numpy()[quiz_positions[matched]]
+    quiz_attempts_df = map_column(
+        quiz_attempts_df, 'user_id', user_uuids, 'user_uuid'
+    )
+    quiz_attempts_df = map_column(
+        quiz_attempts_df, 'quiz_name', assessment_ids, 'assessment_id'
+    )
+    quiz_attempts_df['id'] = quiz_attempts_df.index
+    # Moodle attempt ids are only unique within a course
+    attempt_index = pd.MultiIndex.from_frame(
+        quiz_attempts_df[['course_id', 'attempt_id']]
+    )
+    if not attempt_index.is_unique:
+        logger.info(
+            "Quiz attempt ids repeat within a course, merging quiz "
+            "responses instead of looking them up"
+        )
+        return None
+
+    # Map every response through the attempt, quiz, question and answer
+    # indexes, narrowing the matched row positions after each lookup
+    attempt_positions = attempt_index.get_indexer(
+        pd.MultiIndex.from_frame(
+            attempt_multichoice_response[['course_id', 'attempt_id']]
+        )
+    )
+    quiz_positions = quiz_index.get_indexer(
+        attempt_multichoice_response['quiz_id']
+    )
+    rows = np.flatnonzero((attempt_positions >= 0) & (quiz_positions >= 0))
+    question_numbers = \
+        attempt_multichoice_response['question_number'].to_numpy()[rows]
+    question_positions = question_index.get_indexer(
+        pd.MultiIndex.from_arrays([
+            quiz_data['quiz_name'].to_numpy()[quiz_positions[rows]],
+            question_numbers
+        ])
+    )
+    matched = question_positions >= 0
+    rows = rows[matched]
+    question_numbers = question_numbers[matched]
+    question_ids = \
+        quiz_questions['question_id'].to_numpy()[question_positions[matched]]
+    answer_positions = answer_index.get_indexer(
+        pd.MultiIndex.from_arrays([
+            question_ids,
+            attempt_multichoice_response['answer'].to_numpy()[rows]
+        ])
+    )
+    matched = answer_positions >= 0
+    quiz_attempt_multichoice_responses_df = pd.DataFrame({
+        'attempt_id': quiz_attempts_df['id'].to_numpy()[
+            attempt_positions[rows[matched]]
+        ],
+        'question_number': question_numbers[matched],
+        'question_id': question_ids[matched],
+        'answer_id': quiz_multichoice_answers_df['id'].to_numpy()[
+            answer_positions[matched]
+        ],
+    })
+
+    quiz_attempts_df['grade_percentage'] = 100 * (
+        quiz_attempts_df['attempt_grade'] / quiz_attempts_df['max_grade']
+    )
+    quiz_attempts_df = quiz_attempts_df[
+        [
+            'id',
+            'assessment_id',
+            'user_uuid',
+            'course_id',
+            'attempt_number',
+            'grade_percentage',
+            'time_started',
+            'time_finished',
+        ]
+    ]
+    return quiz_attempts_df, quiz_attempt_multichoice_responses_df
+
 
+def merge_quiz_attempts_and_multichoice_responses(
+    clean_raw_df, quiz_multichoice_answers_df, user_uuids, assessment_ids
+):
     quiz_data = clean_raw_df['quiz_data']
     quiz_questions = clean_raw_df['quiz_questions']
     attempts_summary = clean_raw_df['attempts_summary']
@@ -383,18 +727,17 @@ def quiz_attempts_and_multichoice_responses_model(
         attempts_summary, quiz_data[['quiz_id', 'max_grade', 'quiz_name']],
         on='quiz_id'
     )
-    users_df = clean_raw_df['moodle_users'][['user_id', 'uuid']]
-    quiz_attempts_df = pd.merge(quiz_attempts_df, users_df, on='user_id')
-    quiz_attempts_df.rename(columns={'uuid': 'user_uuid'}, inplace=True)
-    quiz_attempts_df = pd.merge(
-        quiz_attempts_df, assessments_df, left_on='quiz_name', right_on='name'
+    quiz_attempts_df = map_column(
+        quiz_attempts_df, 'user_id', user_uuids, 'user_uuid'
+    )
+    quiz_attempts_df = map_column(
+        quiz_attempts_df, 'quiz_name', assessment_ids, 'assessment_id'
     )
-    quiz_attempts_df.rename(columns={'id': 'assessment_id'}, inplace=True)
     quiz_attempts_df['id'] = quiz_attempts_df.index
     quiz_attempt_multichoice_responses_df = pd.merge(
         attempt_multichoice_response,
-        quiz_attempts_df[['id', 'attempt_id']],
-        on='attempt_id',
+        quiz_attempts_df[['id', 'course_id', 'attempt_id']],
+        on=['course_id', 'attempt_id'],
     )
     quiz_attempt_multichoice_responses_df.rename(
         columns={'attempt_id': 'moodle_attempt_id'}, inplace=True
@@ -442,13 +785,6 @@ def quiz_attempts_and_multichoice_responses_model(
                                                'question_number',
                                                'question_id',
                                                'answer_id']]
-
-    for item in quiz_attempts_df.to_dict(orient='records'):
-        QuizAttempts.model_validate(item)
-
-    for item in quiz_attempt_multichoice_responses_df\
-            .to_dict(orient='records'):
-        QuizAttemptMultichoiceResponses.model_validate(item)
     return quiz_attempts_df, quiz_attempt_multichoice_responses_df
 
 
@@ -474,3 +810,147 @@ def filter_users_by_enrollments(enrollments_df, users_df):
              'email']
         ]
     return filtered_users_df
+
+
+class ModelNode:
+    """A step of create_models. build is called with the clean raw
+    dataframes, the validator and a keyword argument per dependency
+    (argument name -> output of another node) and returns the outputs in
+    order. raw_tables are the collected dataframes it reads.
+    """
+
+    def __init__(self, outputs, build, raw_tables=(), dependencies=None):
+        self.outputs = outputs
+        self.build = build
+        self.raw_tables = raw_tables
+        self.dependencies = dependencies or {}
+
+
+NODE_USER_UUIDS = "user_uuids"
+NODE_ENROLLMENT_KEYS = "enrollment_keys"
+NODE_ASSESSMENT_IDS = "assessment_ids"
+USER_UUIDS_DEPENDENCY = {'user_uuids': NODE_USER_UUIDS}
+ENROLLMENT_KEYS_DEPENDENCY = {'enrollment_keys': NODE_ENROLLMENT_KEYS}
+ASSESSMENT_IDS_DEPENDENCY = {'assessment_ids': NODE_ASSESSMENT_IDS}
+
+MODEL_NODES = {
+    NODE_USER_UUIDS: ModelNode(
+        [NODE_USER_UUIDS], user_uuids_lookup, ['moodle_users']
+    ),
+    NODE_ENROLLMENT_KEYS: ModelNode(
+        [NODE_ENROLLMENT_KEYS], enrollment_keys_lookup, ['enrollments'],
+        USER_UUIDS_DEPENDENCY
+    ),
+    NODE_ASSESSMENT_IDS: ModelNode(
+        [NODE_ASSESSMENT_IDS], assessment_ids_lookup, ['grades']
+    ),
+    "assessments_and_grades": ModelNode(
+        [MODEL_FILE_ASSESSMENTS, MODEL_FILE_GRADES],
+        assessments_and_grades_model, ['grades'],
+        ASSESSMENT_IDS_DEPENDENCY | USER_UUIDS_DEPENDENCY
+    ),
+    "users": ModelNode(
+        [MODEL_FILE_USERS], users_model, ['moodle_users']
+    ),
+    "enrollments": ModelNode(
+        [MODEL_FILE_ENROLLMENTS], enrollments_model, ['enrollments'],
+        USER_UUIDS_DEPENDENCY
+    ),
+    "courses": ModelNode(
+        [MODEL_FILE_COURSES], courses_model, ['courses']
+    ),
+    "quiz_questions": ModelNode(
+        [MODEL_QUIZ_QUESTIONS], questions_model, ['quiz_questions'],
+        ASSESSMENT_IDS_DEPENDENCY
+    ),
+    "quiz_question_contents": ModelNode(
+        [MODEL_QUIZ_QUESTION_CONTENTS], question_contents_model,
+        ['quiz_question_contents']
+    ),
+    "quiz_multichoice_answers": ModelNode(
+        [MODEL_MULTICHOICE_ANSWERS], multichoice_answer_model,
+        ['quiz_multichoice_answers']
+    ),
+    "ib_input_instances": ModelNode(
+        [MODEL_INPUT_INSTANCES], ib_input_model, ['ib_input_instances']
+    ),
+    "ib_pset_problems": ModelNode(
+        [MODEL_PSET_PROBLEMS], ib_problem_model, ['ib_pset_problems']
+    ),
+    "course_contents": ModelNode(
+        [MODEL_COURSE_CONTENTS], course_contents_model, ['course_contents']
+    ),
+    "content_loads": ModelNode(
+        [MODEL_CONTENT_LOADS], content_loads_model, ['content_loads'],
+        ENROLLMENT_KEYS_DEPENDENCY
+    ),
+    "ib_pset_problem_attempts": ModelNode(
+        [MODEL_IB_PSET_PROBLEM_ATTEMPTS], ib_pset_problem_attempts_model,
+        ['ib_pset_problem_attempts'], ENROLLMENT_KEYS_DEPENDENCY
+    ),
+    "ib_input_submissions": ModelNode(
+        [MODEL_IB_INPUT_SUBMISSIONS], ib_input_submissions_model,
+        ['ib_input_submissions'], ENROLLMENT_KEYS_DEPENDENCY
+    ),
+    "quiz_attempts_and_multichoice_responses": ModelNode(
+        [MODEL_QUIZ_ATTEMPTS, MODEL_QUIZ_ATTEMPT_MULTICHOICE_RESPONSES],
+        quiz_attempts_and_multichoice_responses_model,
+        ['quiz_data', 'quiz_questions', 'attempts_summary',
+         'attempt_multichoice_response'],
+        {
+            'quiz_multichoice_answers_df': MODEL_MULTICHOICE_ANSWERS,
+            'user_uuids': NODE_USER_UUIDS,
+            'assessment_ids': NODE_ASSESSMENT_IDS,
+        }
+    ),
+}
+
+NODE_OUTPUTS = {
+    output: name
+    for name, node in MODEL_NODES.items() for output in node.outputs
+}
+
+# The research filter keeps the users enrolled in research courses, so
+# filtered users also need the enrollments
+RESEARCH_FILTER_DEPENDENCIES = {
+    MODEL_FILE_USERS: [MODEL_FILE_ENROLLMENTS],
+}
+
+
+def required_nodes(models, filtered=False):
+    """Return the names of the nodes needed to build the model files in
+    models, with every node after the nodes it depends on
+    """
+    nodes = []
+
+    def visit(output):
+        name = NODE_OUTPUTS[output]
+        if name in nodes:
+            return
+        node = MODEL_NODES[name]
+        for dependency in node.dependencies.values():
+            visit(dependency)
+        if filtered:
+            for node_output in node.outputs:
+                for dependency in RESEARCH_FILTER_DEPENDENCIES.get(
+                    node_output, []
+                ):
+                    visit(dependency)
+        nodes.append(name)
+
+    for file_name in models:
+        if file_name not in MODEL_CLASSES:
+            raise ValueError(f"Unknown model {file_name}")
+        visit(file_name)
+    return nodes
+
+
+def required_raw_tables(models, filtered=False):
+    """Return the names of the collected dataframes needed to build the
+    model files in models
+    """
+    return {
+        raw_table
+        for name in required_nodes(models, filtered)
+        for raw_table in MODEL_NODES[name].raw_tables
+    }
@@ -0,0 +1,163 @@
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+from enclave_mgmt.object_cache import write_json
+
+METRICS_FILE = "metrics.json"
+
+_recorder = None
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def count_rows(*tables):
+    """Total rows of the given dataframes, or None when any of them is a
+    lazily consumed iterator of chunks
+    """
+    if not all(isinstance(table, pd.DataFrame) for table in tables):
+        return None
+    return sum(len(table) for table in tables)
+
+
+class MetricsRecorder:
+    """Per-stage metrics for a run. CPU time covers every thread in the
+    process and peak RSS is the process high-water mark when the stage
+    ends, so the first stage it jumps in is the one responsible. S3 bytes
+    are attributed to the innermost stage open in the reading thread.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.stages = []
+        self.files = []
+        self.s3_bytes = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def open_stages(self):
+        if not hasattr(self.local, "stages"):
+            self.local.stages = []
+        return self.local.stages
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        entry = {
+            "stage": name,
+            "start_seconds": time.perf_counter() - self.start_wall,
+            "rows_in": rows_in,
+            "rows_out": None,
+            "s3_bytes": 0,
+        }
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        open_stages = self.open_stages()
+        open_stages.append(entry)
+        try:
+            yield entry
+        finally:
+            open_stages.pop()
+            entry["wall_seconds"] = time.perf_counter() - start_wall
+            entry["cpu_seconds"] = time.process_time() - start_cpu
+            entry["peak_rss_bytes"] = peak_rss_bytes()
+            with self.lock:
+                self.stages.append(entry)
+                if self.stream is not None:
+                    print(json.dumps(entry), file=self.stream, flush=True)
+
+    def add_s3_bytes(self, count):
+        open_stages = self.open_stages()
+        if open_stages:
+            open_stages[-1]["s3_bytes"] += count
+        with self.lock:
+            self.s3_bytes += count
+
+    def add_files(self, report):
+        with self.lock:
+            self.files.extend(report)
+
+    def report(self):
+        with self.lock:
+            return {
+                "stages": list(self.stages),
+                "files": list(self.files),
+                "totals": {
+                    "wall_seconds": time.perf_counter() - self.start_wall,
+                    "cpu_seconds": time.process_time() - self.start_cpu,
+                    "peak_rss_bytes": peak_rss_bytes(),
+                    "s3_bytes": self.s3_bytes,
+                    "bytes_written": sum(
+                        entry["bytes"] for entry in self.files
+                    ),
+                },
+            }
+
+    def write_report(self, output_path):
+        write_json(os.path.join(output_path, METRICS_FILE), self.report())
+
+
+@contextmanager
+def recording(stream=None):
+    """Record metrics from the hooks below for the duration of the block.
+    With a stream each stage is also written to it as a JSON line when it
+    ends.
+    """
+    global _recorder
+    recorder = MetricsRecorder(stream)
+    previous, _recorder = _recorder, recorder
+    try:
+        yield recorder
+    finally:
+        _recorder = previous
+
+
+def stage(name, rows_in=None):
+    """Context manager timing a stage. Yields the stage entry so rows_out
+    can be filled in, or a throwaway dict when nothing is recording.
+    """
+    if _recorder is None:
+        return nullcontext({})
+    return _recorder.stage(name, rows_in)
+
+
+def add_s3_bytes(count):
+    if _recorder is not None and count:
+        _recorder.add_s3_bytes(count)
+
+
+def add_files(report):
+    if _recorder is not None:
+        _recorder.add_files(report)
+
+
+def model_stage(*tables):
+    """Decorator recording a stage for a model builder that takes the clean
+    raw dataframes as its first argument and reads the named tables
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(clean_raw_df, *args, **kwargs):
+            if _recorder is None:
+                return function(clean_raw_df, *args, **kwargs)
+            rows_in = count_rows(*(clean_raw_df[name] for name in tables))
+            with stage(function.__name__, rows_in) as entry:
+                result = function(clean_raw_df, *args, **kwargs)
+                entry["rows_out"] = count_rows(
+                    *(result if isinstance(result, tuple) else [result])
+                )
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+from uuid import uuid4
+
+INDEX_FILE = "index.json"
+MANIFEST_FILE = "manifest.json"
+SOURCE_CACHE = "cache"
+SOURCE_S3 = "s3"
+# Bump whenever the parsing of cached objects changes (dtypes, CSV readers,
+# event normalization) so caches written by earlier versions are ignored
+CACHE_FORMAT_VERSION = 1
+
+
+def write_atomic(path, write):
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+    write_atomic(path, write)
+
+
+class ObjectCache:
+    """Local cache of parsed S3 objects keyed by bucket, key and ETag.
+    Every object used during a run is recorded so a manifest of the
+    source object versions can be written next to the outputs.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.shards_dir = os.path.join(cache_dir, "shards")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.shards_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, INDEX_FILE)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            # Every object of an index from another format version is a
+            # cache miss
+            if saved.get("version") == CACHE_FORMAT_VERSION:
+                self.index = saved["objects"]
+        self.manifest = {}
+
+    def object_path(self, bucket, key):
+        name = hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.objects_dir, f"{name}.pkl")
+
+    def etag(self, bucket, key, variant=None):
+        """Return the ETag of the cached copy of an object if it can be
+        reused, otherwise None. variant identifies how the object was
+        parsed (e.g. the course filter applied to events) and must match
+        the cached copy.
+        """
+        entry = self.index.get(f"{bucket}/{key}")
+        if entry is None or entry.get("variant") != variant or \
+                not os.path.exists(self.object_path(bucket, key)):
+            return None
+        if "shard_id" in entry and not self.has_shards(entry["shard_id"]):
+            return None
+        return entry["etag"]
+
+    def has(self, bucket, key, etag, variant=None):
+        return etag is not None and self.etag(bucket, key, variant) == etag
+
+    def get(self, bucket, key):
+        value = pd.read_pickle(self.object_path(bucket, key))
+        self.record(
+            bucket, key, self.index[f"{bucket}/{key}"]["etag"], SOURCE_CACHE
+        )
+        return value
+
+    def put(self, bucket, key, etag, value, variant=None):
+        self.record(bucket, key, etag, SOURCE_S3)
+        if etag is None:
+            return
+        write_atomic(
+            self.object_path(bucket, key),
+            lambda tmp_path: pd.to_pickle(value, tmp_path)
+        )
+        self.index[f"{bucket}/{key}"] = {"etag": etag, "variant": variant}
+
+    def has_shards(self, shard_id):
+        return os.path.isdir(os.path.join(self.shards_dir, shard_id))
+
+    def get_shards(self, shard_id):
+        """Read back the dataframes (table name -> dataframe) stored with
+        put_shards
+        """
+        path = os.path.join(self.shards_dir, shard_id)
+        return {
+            os.path.splitext(file_name)[0]: pd.read_parquet(
+                os.path.join(path, file_name)
+            )
+            for file_name in sorted(os.listdir(path))
+        }
+
+    def put_shards(self, shard_id, shards):
+        """Store intermediate dataframes as Parquet files in a directory
+        that is renamed into place once complete
+        """
+        path = os.path.join(self.shards_dir, shard_id)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        os.makedirs(tmp_path)
+        try:
+            for name, df in shards.items():
+                df.to_parquet(
+                    os.path.join(tmp_path, f"{name}.parquet"), index=False
+                )
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another run stored the same shards first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+
+    def link_shards(self, bucket, key, shard_id):
+        """Record that the shards stored as shard_id were built from an
+        object so they are kept while the index refers to them
+        """
+        entry = self.index.get(f"{bucket}/{key}")
+        if entry is not None:
+            entry["shard_id"] = shard_id
+
+    def prune_shards(self):
+        """Remove shard directories the index no longer refers to, such as
+        those of earlier versions of a course
+        """
+        linked = {
+            entry["shard_id"] for entry in self.index.values()
+            if "shard_id" in entry
+        }
+        for name in os.listdir(self.shards_dir):
+            if name not in linked:
+                shutil.rmtree(
+                    os.path.join(self.shards_dir, name), ignore_errors=True
+                )
+
+    def record(self, bucket, key, etag, source):
+        self.manifest[f"{bucket}/{key}"] = {
+            "bucket": bucket,
+            "key": key,
+            "etag": etag,
+            "source": source,
+        }
+
+    def save(self):
+        write_json(
+            self.index_path,
+            {"version": CACHE_FORMAT_VERSION, "objects": self.index}
+        )
+        self.prune_shards()
+
+    def write_manifest(self, output_path):
+        write_json(
+            os.path.join(output_path, MANIFEST_FILE),
+            {"objects": list(self.manifest.values())}
+        )
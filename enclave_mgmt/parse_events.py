@@ -0,0 +1,133 @@
+import codecs
+import json
+import pandas as pd
+
+DEFAULT_CHUNK_ROWS = 50000
+READ_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _StreamBuffer:
+    """Text buffer over a binary stream that is refilled on demand and
+    trimmed as values are consumed so that only a bounded window of the
+    stream is held in memory
+    """
+
+    def __init__(self, stream, read_size):
+        self.stream = stream
+        self.read_size = read_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        if self.pos > len(self.text) // 2:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        data = self.stream.read(self.read_size)
+        if not data:
+            self.eof = True
+            self.text += self.text_decoder.decode(b"", final=True)
+            return False
+        self.text += self.text_decoder.decode(data)
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.text) and \
+                    self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of events file")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"Expected '{char}' at offset {self.pos} in events file"
+            )
+        self.pos += 1
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A scalar that runs up to the end of the buffer may have been
+            # truncated by the read boundary
+            if end == len(self.text) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_event_records(stream, key="data", read_size=READ_SIZE):
+    """Incrementally decode the records in the top level `key` array of a
+    JSON events file without reading the whole file into memory
+    """
+    buffer = _StreamBuffer(stream, read_size)
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        return
+    while True:
+        name = buffer.decode_value()
+        buffer.expect(":")
+        if name != key:
+            buffer.decode_value()
+        else:
+            buffer.expect("[")
+            if buffer.peek() == "]":
+                return
+            while True:
+                yield buffer.decode_value()
+                if buffer.peek() == "]":
+                    return
+                buffer.expect(",")
+        if buffer.peek() == "}":
+            return
+        buffer.expect(",")
+
+
+def iter_event_chunks(stream, chunk_rows=DEFAULT_CHUNK_ROWS,
+                      normalize_chunk=None, filter_chunk=None):
+    """Yield dataframes of at most chunk_rows events from a JSON events
+    file stream. normalize_chunk can rewrite the columns of each chunk and
+    filter_chunk can drop rows from it as soon as it is built.
+    """
+    records = []
+    for record in iter_event_records(stream):
+        records.append(record)
+        if len(records) == chunk_rows:
+            yield build_chunk(records, normalize_chunk, filter_chunk)
+            records = []
+    if records:
+        yield build_chunk(records, normalize_chunk, filter_chunk)
+
+
+def build_chunk(records, normalize_chunk=None, filter_chunk=None):
+    chunk = pd.DataFrame(records)
+    if normalize_chunk is not None:
+        chunk = normalize_chunk(chunk)
+    if filter_chunk is not None:
+        chunk = filter_chunk(chunk)
+    return chunk
+
+
+def read_events(stream, chunk_rows=DEFAULT_CHUNK_ROWS,
+                normalize_chunk=None, filter_chunk=None):
+    chunks = list(iter_event_chunks(
+        stream, chunk_rows, normalize_chunk, filter_chunk
+    ))
+    if len(chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
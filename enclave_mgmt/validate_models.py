@@ -0,0 +1,421 @@
+import math
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from pydantic import TypeAdapter, ValidationError
+from typing import List, Literal, Union, get_args, get_origin
+from uuid import UUID
+
+from enclave_mgmt import metrics
+from enclave_mgmt.models import Grade, IBProblemAttempts
+
+MAX_REPORTED_ROWS = 10
+
+VALIDATION_MODE_VECTORIZED = "vectorized"
+VALIDATION_MODE_BATCH = "batch"
+VALIDATION_MODE_ROWS = "rows"
+VALIDATION_MODES = [
+    VALIDATION_MODE_VECTORIZED,
+    VALIDATION_MODE_BATCH,
+    VALIDATION_MODE_ROWS,
+]
+
+VALIDATION_LEVEL_FULL = "full"
+VALIDATION_LEVEL_SAMPLED = "sampled"
+VALIDATION_LEVEL_SCHEMA = "schema"
+VALIDATION_LEVEL_OFF = "off"
+VALIDATION_LEVELS = [
+    VALIDATION_LEVEL_FULL,
+    VALIDATION_LEVEL_SAMPLED,
+    VALIDATION_LEVEL_SCHEMA,
+    VALIDATION_LEVEL_OFF,
+]
+DEFAULT_SAMPLE_FRACTION = 0.1
+DEFAULT_SAMPLE_SEED = 0
+
+UUID_PATTERN = (
+    r"(?:urn:uuid:)?(?:"
+    r"[0-9a-fA-F]{32}"
+    r"|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}"
+    r"-[0-9a-fA-F]{12}"
+    r"|\{[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}"
+    r"-[0-9a-fA-F]{12}\})"
+)
+BOOL_STRINGS = {
+    "0", "off", "f", "false", "n", "no",
+    "1", "on", "t", "true", "y", "yes"
+}
+
+
+class ModelValidationError(ValueError):
+    """Raised when rows in a dataframe do not satisfy a model. Each error is
+    a (column, message, row_labels) tuple.
+    """
+
+    def __init__(self, model, errors):
+        self.model = model
+        self.errors = errors
+        details = []
+        for column, message, rows in errors:
+            shown = ", ".join(str(row) for row in rows[:MAX_REPORTED_ROWS])
+            if len(rows) > MAX_REPORTED_ROWS:
+                shown += ", ..."
+            details.append(
+                f"{column}: {message} ({len(rows)} rows: {shown})"
+            )
+        super().__init__(
+            f"{len(errors)} validation errors for {model.__name__}\n" +
+            "\n".join(details)
+        )
+
+
+def value_types(series):
+    return series.map(type)
+
+
+def is_instance(series, types):
+    # Homogeneous string columns are common enough to skip the per value
+    # type lookup entirely
+    if types == (str,) and not series.hasnans and \
+            pd.api.types.infer_dtype(series, skipna=False) == "string":
+        return pd.Series(True, index=series.index)
+    return value_types(series).isin(types)
+
+
+def invalid_int(series):
+    if pd.api.types.is_bool_dtype(series) or \
+            pd.api.types.is_integer_dtype(series):
+        return series.isna()
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype=float, na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            return pd.Series(
+                ~(np.isfinite(values) & (values == np.floor(values))),
+                index=series.index
+            )
+    numeric = pd.to_numeric(series, errors="coerce")
+    return invalid_int(numeric.astype(float))
+
+
+def invalid_float(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.Series(False, index=series.index)
+    numeric = pd.to_numeric(series, errors="coerce")
+    # NaN is a valid float but other missing values are not
+    is_nan = value_types(series).isin((float, np.float64))
+    return numeric.isna() & ~is_nan
+
+
+def invalid_bool(series):
+    if pd.api.types.is_bool_dtype(series) and not series.hasnans:
+        return pd.Series(False, index=series.index)
+    if pd.api.types.is_numeric_dtype(series):
+        return ~series.isin([0, 1])
+    valid = value_types(series).isin((bool, np.bool_, int)) & \
+        series.isin([True, False])
+    is_str = is_instance(series, (str,))
+    valid |= is_str & series.where(is_str, "").str.lower().isin(BOOL_STRINGS)
+    return ~valid
+
+
+def invalid_str(series):
+    return ~is_instance(series, (str,))
+
+
+def invalid_uuid(series):
+    # UUID columns are dominated by repeated keys, so only match the format
+    # of each distinct value once
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    types = value_types(uniques)
+    is_str = types == str
+    valid = types == UUID
+    valid |= is_str & uniques.where(is_str, "").str.fullmatch(UUID_PATTERN)
+    valid = np.append(valid.to_numpy(dtype=bool), False)
+    return pd.Series(~valid[codes], index=series.index)
+
+
+def invalid_literal(values):
+    def check(series):
+        return ~series.isin(values)
+    return check
+
+
+def invalid_str_or_str_list(series):
+    if is_instance(series, (str,)).all():
+        return pd.Series(False, index=series.index)
+    types = value_types(series)
+    is_list = types.isin((list, tuple))
+    valid = types.eq(str).to_numpy()
+    if is_list.any():
+        lists = series[is_list]
+        elements_valid = value_types(lists.explode()).eq(str)\
+            .groupby(level=0).all().reindex(lists.index)
+        valid[is_list.to_numpy()] = \
+            (elements_valid | lists.map(len).eq(0)).to_numpy(dtype=bool)
+    return pd.Series(~valid, index=series.index)
+
+
+def field_check(annotation):
+    origin = get_origin(annotation)
+    if origin is Literal:
+        return invalid_literal(list(get_args(annotation)))
+    if origin is Union and set(get_args(annotation)) == {str, List[str]}:
+        return invalid_str_or_str_list
+    checks = {
+        int: invalid_int,
+        float: invalid_float,
+        bool: invalid_bool,
+        str: invalid_str,
+        UUID: invalid_uuid,
+    }
+    if annotation not in checks:
+        raise TypeError(f"No column check for field type {annotation}")
+    return checks[annotation]
+
+
+def check_column(series, check):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Check each distinct value once and broadcast through the codes
+        categories = pd.Series(series.cat.categories)
+        invalid_categories = np.append(
+            check(categories).to_numpy(dtype=bool), True
+        )
+        return pd.Series(
+            invalid_categories[series.cat.codes.to_numpy()],
+            index=series.index
+        )
+    return check(series)
+
+
+def grade_value(df):
+    # Mirrors Grade.grade_value
+    grade_percentage = pd.to_numeric(
+        df["grade_percentage"], errors="coerce"
+    )
+    return [
+        ("grade_percentage", "Grade value is nan",
+         grade_percentage.isna()),
+        ("grade_percentage", "Grade value is out of expected range",
+         (grade_percentage < 0.0) | (grade_percentage > 100.0)),
+    ]
+
+
+def response_type(df):
+    # Mirrors IBProblemAttempts.response_type
+    is_multiselect = (df["problem_type"] == "multiselect").to_numpy()
+    if "response_is_str" in df.columns:
+        # Set when the response union is resolved from the union member the
+        # response was taken from, so no value has to be typed here
+        is_str = df["response_is_str"].to_numpy(dtype=bool)
+    else:
+        # Responses are checked in a block per kind of problem so the
+        # non-multiselect responses, which are all strings when valid, take
+        # the fast path of is_instance
+        is_str = np.zeros(len(df), dtype=bool)
+        for rows in [is_multiselect, ~is_multiselect]:
+            if rows.any():
+                is_str[rows] = is_instance(df["response"][rows], (str,))
+    return [
+        ("response", "Response must be a list",
+         pd.Series(is_multiselect & is_str, index=df.index)),
+        ("response", "Response must be a string",
+         pd.Series(~is_multiselect & ~is_str, index=df.index)),
+    ]
+
+
+MODEL_RULES = {
+    Grade: [grade_value],
+    IBProblemAttempts: [response_type],
+}
+
+# Columns a model builder may carry next to the fields of a model for the
+# model rules to use. They are not fields and are dropped before writing.
+RULE_COLUMNS = {
+    IBProblemAttempts: ["response_is_str"],
+}
+
+
+def rule_columns(df, model):
+    return [
+        column for column in RULE_COLUMNS.get(model, [])
+        if column in df.columns
+    ]
+
+
+def find_column_errors(df, model):
+    errors = []
+    fields = model.model_fields
+    known_columns = set(fields) | set(RULE_COLUMNS.get(model, []))
+    for column in df.columns:
+        if column not in known_columns:
+            errors.append(
+                (column, "Extra inputs are not permitted", df.index)
+            )
+    for field in fields:
+        if field not in df.columns:
+            errors.append((field, "Field required", df.index))
+    return errors
+
+
+def dtype_matches(series, annotation):
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    if annotation is int:
+        return pd.api.types.is_integer_dtype(dtype) or \
+            pd.api.types.is_bool_dtype(dtype)
+    if annotation is float:
+        return pd.api.types.is_numeric_dtype(dtype)
+    if annotation is bool:
+        return pd.api.types.is_bool_dtype(dtype)
+    # str, UUID, Literal and union values are all held in object columns
+    return pd.api.types.is_object_dtype(dtype) or \
+        pd.api.types.is_string_dtype(dtype)
+
+
+def validate_schema(df, model):
+    """Validate only the columns and dtypes of df against model without
+    looking at individual values
+    """
+    errors = find_column_errors(df, model)
+    for name, field in model.model_fields.items():
+        if name in df.columns and \
+                not dtype_matches(df[name], field.annotation):
+            errors.append((
+                name,
+                f"dtype {df[name].dtype} is not compatible with "
+                f"{field_name(field.annotation)}",
+                df.index[:0]
+            ))
+    if errors:
+        raise ModelValidationError(model, errors)
+
+
+def find_errors(df, model):
+    """Check every column of df against model and return a list of
+    (column, message, row_labels) tuples for the rows that fail
+    """
+    errors = find_column_errors(df, model)
+    labels = df.index
+    df = df.reset_index(drop=True)
+    fields = model.model_fields
+    if any(field not in df.columns for field in fields) or len(df) == 0:
+        return errors
+
+    invalid_rows = pd.Series(False, index=df.index)
+    for name, field in fields.items():
+        invalid = check_column(df[name], field_check(field.annotation))\
+            .astype(bool)
+        if invalid.any():
+            invalid_rows |= invalid
+            errors.append((
+                name,
+                f"Input should be a valid {field_name(field.annotation)}",
+                labels[invalid.to_numpy()]
+            ))
+
+    # Model validators only run for rows with valid field values
+    for rule in MODEL_RULES.get(model, []):
+        for column, message, invalid in rule(df):
+            invalid = invalid & ~invalid_rows
+            if invalid.any():
+                errors.append((column, message, labels[invalid.to_numpy()]))
+    return errors
+
+
+def field_name(annotation):
+    return getattr(annotation, "__name__", str(annotation))
+
+
+def validate_df(df, model):
+    """Validate all rows of df against model using column-wise checks"""
+    errors = find_errors(df, model)
+    if errors:
+        raise ModelValidationError(model, errors)
+
+
+@lru_cache(maxsize=None)
+def list_adapter(model):
+    return TypeAdapter(list[model])
+
+
+def validate_df_batch(df, model):
+    """Validate all rows of df against model with a single pydantic call so
+    that every error is collected rather than stopping at the first
+    """
+    df = df.drop(columns=rule_columns(df, model))
+    try:
+        list_adapter(model).validate_python(df.to_dict(orient='records'))
+    except ValidationError as error:
+        rows_by_error = {}
+        for item in error.errors():
+            row, *location = item["loc"]
+            column = ".".join(str(part) for part in location) or "__root__"
+            rows_by_error.setdefault(
+                (column, item["msg"]), []
+            ).append(df.index[row])
+        raise ModelValidationError(model, [
+            (column, message, pd.Index(rows))
+            for (column, message), rows in rows_by_error.items()
+        ]) from error
+
+
+def validate_df_rows(df, model):
+    """Reference implementation that validates df one row at a time with
+    pydantic
+    """
+    df = df.drop(columns=rule_columns(df, model))
+    for item in df.to_dict(orient='records'):
+        model.model_validate(item)
+
+
+VALIDATION_FUNCTIONS = {
+    VALIDATION_MODE_VECTORIZED: validate_df,
+    VALIDATION_MODE_BATCH: validate_df_batch,
+    VALIDATION_MODE_ROWS: validate_df_rows,
+}
+
+
+class Validator:
+    """Validation settings shared by all of the model builders. The level
+    can be overridden for individual models with model_levels.
+    """
+
+    def __init__(self, mode=VALIDATION_MODE_VECTORIZED,
+                 level=VALIDATION_LEVEL_FULL,
+                 sample_fraction=DEFAULT_SAMPLE_FRACTION,
+                 seed=DEFAULT_SAMPLE_SEED, model_levels=None):
+        if mode not in VALIDATION_FUNCTIONS:
+            raise ValueError(f"Unknown validation mode {mode}")
+        model_levels = model_levels or {}
+        for model_level in [level, *model_levels.values()]:
+            if model_level not in VALIDATION_LEVELS:
+                raise ValueError(f"Unknown validation level {model_level}")
+        if not 0.0 < sample_fraction <= 1.0:
+            raise ValueError(
+                f"Sample fraction {sample_fraction} must be in (0, 1]"
+            )
+        self.mode = mode
+        self.level = level
+        self.sample_fraction = sample_fraction
+        self.seed = seed
+        self.model_levels = model_levels
+
+    def validate(self, df, model):
+        level = self.model_levels.get(model, self.level)
+        if level == VALIDATION_LEVEL_OFF:
+            return
+        if level == VALIDATION_LEVEL_SCHEMA:
+            validate_schema(df, model)
+            return
+        with metrics.stage(f"validate {model.__name__}", len(df)):
+            if level == VALIDATION_LEVEL_SAMPLED and len(df) > 0:
+                df = df.sample(
+                    n=max(1, math.ceil(len(df) * self.sample_fraction)),
+                    random_state=self.seed
+                )
+            VALIDATION_FUNCTIONS[self.mode](df, model)
+
+
+DEFAULT_VALIDATOR = Validator()
@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Literal, Union, get_args, get_origin
+from uuid import UUID, uuid4
+
+from enclave_mgmt import metrics
+from enclave_mgmt.cpus import available_cpus
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_PARQUET = "parquet"
+OUTPUT_FORMAT_ARROW = "arrow"
+OUTPUT_FORMATS = [
+    OUTPUT_FORMAT_CSV,
+    OUTPUT_FORMAT_PARQUET,
+    OUTPUT_FORMAT_ARROW,
+]
+FILE_EXTENSIONS = {
+    OUTPUT_FORMAT_CSV: ".csv",
+    OUTPUT_FORMAT_PARQUET: ".parquet",
+    OUTPUT_FORMAT_ARROW: ".arrow",
+}
+COMPRESSION = "zstd"
+
+WRITE_EXECUTOR_THREAD = "thread"
+WRITE_EXECUTOR_PROCESS = "process"
+WRITE_EXECUTORS = {
+    WRITE_EXECUTOR_THREAD: ThreadPoolExecutor,
+    WRITE_EXECUTOR_PROCESS: ProcessPoolExecutor,
+}
+DEFAULT_WRITE_WORKERS = available_cpus()
+
+ARROW_TYPES = {
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+    str: pa.string(),
+    # UUIDs are kept in their canonical string form so they read back as
+    # plain strings in any Arrow / Parquet client
+    UUID: pa.string(),
+}
+
+
+def is_str_or_str_list(annotation):
+    return get_origin(annotation) is Union and \
+        set(get_args(annotation)) == {str, List[str]}
+
+
+def arrow_field(name, annotation):
+    if get_origin(annotation) is Literal:
+        model_type = "Literal"
+        arrow_type = pa.string()
+    elif is_str_or_str_list(annotation):
+        # Arrow unions cannot be stored in Parquet, so list responses are
+        # JSON encoded into the string column
+        model_type = "str | JSON list[str]"
+        arrow_type = pa.string()
+    else:
+        model_type = annotation.__name__
+        arrow_type = ARROW_TYPES[annotation]
+    # Floats that passed validation can still be NaN (e.g. the grade of a
+    # quiz attempt without sumgrades), which pandas writes as Arrow nulls
+    return pa.field(
+        name, arrow_type, nullable=annotation is float,
+        metadata={"model_type": model_type}
+    )
+
+
+def arrow_schema(model):
+    return pa.schema(
+        [
+            arrow_field(name, field.annotation)
+            for name, field in model.model_fields.items()
+        ],
+        metadata={"model": model.__name__}
+    )
+
+
+def to_arrow_table(df, model):
+    schema = arrow_schema(model)
+    df = df[schema.names].copy()
+    for name, field in model.model_fields.items():
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype(df[name].cat.categories.dtype)
+        if field.annotation is UUID:
+            df[name] = df[name].astype(str)
+        elif is_str_or_str_list(field.annotation):
+            df[name] = df[name].map(
+                lambda value: value if isinstance(value, str)
+                else json.dumps(list(value))
+            )
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def write_model(path, df, model, output_format):
+    if output_format == OUTPUT_FORMAT_CSV:
+        with open(path, "w") as f:
+            df.to_csv(f, index=False)
+    elif output_format == OUTPUT_FORMAT_PARQUET:
+        pq.write_table(
+            to_arrow_table(df, model), path, compression=COMPRESSION
+        )
+    elif output_format == OUTPUT_FORMAT_ARROW:
+        feather.write_feather(
+            to_arrow_table(df, model), path, compression=COMPRESSION
+        )
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
+
+
+def tmp_path_for(path):
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, f".{file_name}.{uuid4().hex}.tmp")
+
+
+def write_model_file(path, df, model, output_format):
+    """Write a model to a temporary file next to path and rename it into
+    place so readers never see a partially written file
+    """
+    start = time.perf_counter()
+    file_name = os.path.basename(path)
+    tmp_path = tmp_path_for(path)
+    try:
+        write_model(tmp_path, df, model, output_format)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {
+        "file": file_name,
+        "format": output_format,
+        "rows": len(df),
+        "bytes": os.path.getsize(path),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class CsvChunkWriter:
+    def __init__(self, path, model):
+        self.file = open(path, "w")
+        self.model = model
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.file, index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        if self.header:
+            pd.DataFrame(columns=list(self.model.model_fields)).to_csv(
+                self.file, index=False
+            )
+        self.file.close()
+
+
+class ArrowChunkWriter:
+    def __init__(self, path, model, output_format):
+        self.model = model
+        schema = arrow_schema(model)
+        if output_format == OUTPUT_FORMAT_PARQUET:
+            self.sink = None
+            self.writer = pq.ParquetWriter(
+                path, schema, compression=COMPRESSION
+            )
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(
+                self.sink, schema,
+                options=pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+            )
+
+    def write(self, df):
+        self.writer.write_table(to_arrow_table(df, self.model))
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def chunk_writer(path, model, output_format):
+    if output_format == OUTPUT_FORMAT_CSV:
+        return CsvChunkWriter(path, model)
+    if output_format in (OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW):
+        return ArrowChunkWriter(path, model, output_format)
+    raise ValueError(f"Unknown output format {output_format}")
+
+
+def write_model_chunks(output_path, stem, chunks, model, output_formats):
+    """Append each dataframe in the chunks iterator to the model file of
+    every output format in a single pass, so only one chunk is held in
+    memory at a time. Files are renamed into place once complete.
+    """
+    start = time.perf_counter()
+    paths = {
+        output_format: f"{output_path}/{stem}{FILE_EXTENSIONS[output_format]}"
+        for output_format in output_formats
+    }
+    tmp_paths = {
+        output_format: tmp_path_for(path)
+        for output_format, path in paths.items()
+    }
+    writers = {}
+    rows = 0
+    try:
+        for output_format, tmp_path in tmp_paths.items():
+            writers[output_format] = chunk_writer(
+                tmp_path, model, output_format
+            )
+        for chunk in chunks:
+            rows += len(chunk)
+            for writer in writers.values():
+                writer.write(chunk)
+        for output_format in list(writers):
+            writers.pop(output_format).close()
+        for output_format, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, paths[output_format])
+    except BaseException:
+        for writer in writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    seconds = time.perf_counter() - start
+    return [
+        {
+            "file": os.path.basename(path),
+            "format": output_format,
+            "rows": rows,
+            "bytes": os.path.getsize(path),
+            "seconds": seconds,
+        }
+        for output_format, path in paths.items()
+    ]
+
+
+def write_models(output_path, tables, models,
+                 output_formats=(OUTPUT_FORMAT_CSV,),
+                 max_workers=DEFAULT_WRITE_WORKERS,
+                 executor=WRITE_EXECUTOR_THREAD):
+    """Write each table in tables (file name -> dataframe or iterator of
+    dataframe chunks) in every output format concurrently, using the
+    matching model in models for typed formats. Returns a report entry per
+    written file.
+    """
+    max_workers = max(1, max_workers)
+    with metrics.stage("write_models") as entry, \
+            WRITE_EXECUTORS[executor](max_workers=max_workers) as pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as chunk_pool:
+        futures = []
+        for file_name, df in tables.items():
+            stem = os.path.splitext(file_name)[0]
+            if not isinstance(df, pd.DataFrame):
+                # Chunk iterators are consumed once for all formats and
+                # cannot be sent to worker processes
+                futures.append(chunk_pool.submit(
+                    write_model_chunks, output_path, stem, df,
+                    models[file_name], output_formats
+                ))
+                continue
+            for output_format in output_formats:
+                futures.append(pool.submit(
+                    write_model_file,
+                    f"{output_path}/{stem}{FILE_EXTENSIONS[output_format]}",
+                    df, models[file_name], output_format
+                ))
+        report = []
+        for future in futures:
+            result = future.result()
+            report.extend(result if isinstance(result, list) else [result])
+        entry["rows_out"] = sum(file_entry["rows"] for file_entry in report)
+    metrics.add_files(report)
+    for entry in report:
+        logger.info(
+            "Wrote %s (%d rows, %d bytes) in %.3fs",
+            entry["file"], entry["rows"], entry["bytes"], entry["seconds"]
+        )
+    return report
@@ -1,4 +1,19 @@
-from enclave_mgmt import collect_data
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
+from botocore.exceptions import (
+    ClientError, ConnectionClosedError, EndpointConnectionError,
+    IncompleteReadError, NoCredentialsError, ParamValidationError,
+    ReadTimeoutError
+)
+from enclave_mgmt import collect_data, parse_events
+from enclave_mgmt.object_cache import ObjectCache
+import io
+import json
+import pandas as pd
+import pytest
+import random
+import threading
+import time
 
 
 def test_generate_grade_df_nodata():
@@ -71,3 +86,476 @@ def test_generate_attempt_multichoice_response_df_nodata():
     ]
 
     assert all(column in res.columns for column in expected_columns)
+
+
+def test_generate_quiz_data_df_nodata():
+    """generate_quiz_data_df should return an empty dataframe with the
+    expected columns when no quizzes exist yet
+    """
+    grade_dict = {
+        1: {
+            'quizzes': []
+        }
+    }
+
+    res = collect_data.generate_quiz_data_df(grade_dict)
+
+    assert len(res) == 0
+    assert list(res.columns) == [
+        'quiz_id', 'quiz_name', 'max_grade', 'course_id'
+    ]
+
+
+def test_column_builder():
+    builder = collect_data.ColumnBuilder(['a', 'b', 'c'])
+    builder.append(1, 'x', 2.0)
+    builder.extend(2, 3, ['y', 'z'], 4.0)
+    builder.extend(0, 5, [], 6.0)
+
+    res = builder.to_df()
+
+    assert res.to_dict(orient='records') == [
+        {'a': 1, 'b': 'x', 'c': 2.0},
+        {'a': 3, 'b': 'y', 'c': 4.0},
+        {'a': 3, 'b': 'z', 'c': 4.0},
+    ]
+
+
+def test_moodle_tables_single_pass(local_file_collections):
+    """MoodleTables should produce the same tables course by course as the
+    per-table generate functions do over all courses
+    """
+    (moodle_grades_2, moodle_users_2,
+     moodle_grades_3, moodle_users_3) = local_file_collections[:4]
+    grade_dict = {2: moodle_grades_2, 3: moodle_grades_3}
+    users_dict = {2: moodle_users_2, 3: moodle_users_3}
+
+    moodle_tables = collect_data.MoodleTables()
+    for course_id in grade_dict:
+        moodle_tables.add_course_grades(course_id, grade_dict[course_id])
+    for course_id in users_dict:
+        moodle_tables.add_course_users(course_id, users_dict[course_id])
+    res = moodle_tables.to_dfs()
+
+    assert res['grades'].equals(collect_data.generate_grade_df(grade_dict))
+    assert res['quiz_data'].equals(
+        collect_data.generate_quiz_data_df(grade_dict)
+    )
+    assert res['attempts_summary'].equals(
+        collect_data.generate_attempts_summary_df(grade_dict)
+    )
+    assert res['attempt_multichoice_response'].equals(
+        collect_data.generate_attempt_multichoice_response_df(grade_dict)
+    )
+    assert res['enrollments'].equals(
+        collect_data.generate_enrollment_df(users_dict)
+    )
+    assert res['courses'].equals(collect_data.generate_courses_df(users_dict))
+    assert res['moodle_users'].drop(columns='uuid').equals(
+        collect_data.generate_users_df(users_dict).drop(columns='uuid')
+    )
+    assert len(res['attempt_multichoice_response']) > 0
+
+
+def test_fetch_objects_preserves_key_order():
+    """fetch_objects should return contents in the order keys were provided
+    even when downloads complete out of order
+    """
+    active, max_active = 0, 0
+    lock = threading.Lock()
+
+    def get_object(Bucket, Key):
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(max_active, active)
+        time.sleep(random.uniform(0, 0.01))
+        with lock:
+            active -= 1
+        return {"Body": io.BytesIO(Key.encode('utf-8'))}
+
+    class S3Client:
+        pass
+
+    s3_client = S3Client()
+    s3_client.get_object = get_object
+    keys = [f"{i}.json" for i in range(50)]
+
+    res = list(collect_data.fetch_objects(
+        s3_client, "bucket", keys, max_workers=8
+    ))
+
+    assert res == [(key, key.encode('utf-8')) for key in keys]
+    assert 1 < max_active <= 8
+
+
+def test_fetch_objects_retries_transient_errors(mocker):
+    """fetch_objects should retry transient failures with backoff"""
+    sleep = mocker.patch("enclave_mgmt.collect_data.time.sleep")
+    s3_client = mocker.Mock()
+    s3_client.get_object.side_effect = [
+        EndpointConnectionError(endpoint_url="https://s3"),
+        ClientError({"Error": {"Code": "SlowDown"}}, "GetObject"),
+        {"Body": io.BytesIO(b"contents")},
+    ]
+
+    res = list(collect_data.fetch_objects(
+        s3_client, "bucket", ["1.json"], max_workers=2
+    ))
+
+    assert res == [("1.json", b"contents")]
+    assert [call.args[0] for call in sleep.call_args_list] == [
+        collect_data.DEFAULT_BACKOFF_SECONDS,
+        collect_data.DEFAULT_BACKOFF_SECONDS * 2
+    ]
+
+
+def test_fetch_objects_does_not_retry_client_errors(mocker):
+    """fetch_objects should fail immediately on non-transient errors"""
+    sleep = mocker.patch("enclave_mgmt.collect_data.time.sleep")
+    s3_client = mocker.Mock()
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+
+    with pytest.raises(ClientError):
+        list(collect_data.fetch_objects(s3_client, "bucket", ["1.json"]))
+
+    assert s3_client.get_object.call_count == 1
+    sleep.assert_not_called()
+
+
+@pytest.mark.parametrize("error,retryable", [
+    (EndpointConnectionError(endpoint_url="https://s3"), True),
+    (ConnectionClosedError(endpoint_url="https://s3"), True),
+    (ReadTimeoutError(endpoint_url="https://s3"), True),
+    (IncompleteReadError(actual_bytes=1, expected_bytes=2), True),
+    (NoCredentialsError(), False),
+    (ParamValidationError(report="Invalid bucket name"), False),
+])
+def test_is_retryable_error_botocore(error, retryable):
+    assert collect_data.is_retryable_error(error) == retryable
+
+
+def test_list_course_objects_skips_other_courses(mocker):
+    mocker.patch.object(
+        collect_data, "list_objects",
+        lambda s3_client, bucket, prefix: [
+            (f"{prefix}/{course_id}.json", f'"etag{course_id}"')
+            for course_id in [2, 3, 10]
+        ]
+    )
+
+    assert list(collect_data.list_course_objects(
+        None, "bucket", "data/moodle/grades", {3, 10}
+    )) == [
+        ("data/moodle/grades/3.json", '"etag3"'),
+        ("data/moodle/grades/10.json", '"etag10"')
+    ]
+    assert len(list(collect_data.list_course_objects(
+        None, "bucket", "data/moodle/grades"
+    ))) == 3
+
+
+def test_course_filter(test_data_path):
+    with open(test_data_path / "content_loaded_v1.json", "rb") as f:
+        res = parse_events.read_events(
+            f, chunk_rows=1, filter_chunk=collect_data.course_filter({3})
+        )
+
+    assert len(res) > 0
+    assert set(res['course_id']) == {3}
+    assert collect_data.course_filter(None) is None
+
+
+@pytest.mark.parametrize("file_name", [
+    "content_loaded_v1.json", "ib_pset_problem_attempted_v1.json"
+])
+def test_read_compact_events(test_data_path, file_name):
+    """Chunks compacted one at a time should combine into the same table as
+    compacting the whole table, keeping the categorical columns
+    """
+    normalize_chunk = collect_data.normalize_pset_problem_attempts
+    with open(test_data_path / file_name, "rb") as f:
+        expected = collect_data.compact_event_df(parse_events.read_events(
+            f, normalize_chunk=normalize_chunk
+        ))
+        f.seek(0)
+        res = collect_data.read_compact_events(
+            f, chunk_rows=1, normalize_chunk=normalize_chunk
+        )
+
+    assert isinstance(res["user_uuid"].dtype, pd.CategoricalDtype)
+    assert res["impression_id"].dtype == collect_data.COMPACT_STRING_DTYPE
+    pd.testing.assert_frame_equal(
+        res, expected, check_categorical=False
+    )
+
+
+def test_concat_event_chunks_empty():
+    assert collect_data.concat_event_chunks([]).empty
+
+
+class ConditionalS3Client:
+    """Minimal S3 client that honors IfNoneMatch like S3 does"""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.requests.append(Key)
+        contents, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError(
+                {
+                    "Error": {"Code": "304", "Message": "Not Modified"},
+                    "ResponseMetadata": {"HTTPStatusCode": 304}
+                },
+                "GetObject"
+            )
+        return {"Body": io.BytesIO(contents), "ETag": etag}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{"Contents": [
+            {"Key": key, "ETag": etag}
+            for key, (_, etag) in self.objects.items()
+            if key.startswith(Prefix)
+        ]}]
+
+
+def test_fetch_cached_objects(tmp_path):
+    s3_client = ConditionalS3Client({
+        "2.json": (b'{"course": 2}', '"a"'),
+        "3.json": (b'{"course": 3}', '"b"'),
+    })
+    cache = ObjectCache(tmp_path)
+
+    def fetch(objects):
+        return list(collect_data.fetch_cached_objects(
+            s3_client, "bucket", objects,
+            lambda key, contents: json.loads(contents), 2, cache
+        ))
+
+    expected = [("2.json", {"course": 2}), ("3.json", {"course": 3})]
+    assert fetch([("2.json", '"a"'), ("3.json", '"b"')]) == expected
+    assert sorted(s3_client.requests) == ["2.json", "3.json"]
+
+    s3_client.objects["3.json"] = (b'{"course": 30}', '"c"')
+    s3_client.requests = []
+    assert fetch([("2.json", '"a"'), ("3.json", '"c"')]) == [
+        ("2.json", {"course": 2}), ("3.json", {"course": 30})
+    ]
+    assert s3_client.requests == ["3.json"]
+
+
+def test_get_parsed_object_not_modified(tmp_path):
+    s3_client = ConditionalS3Client({"a.csv": (b"a,b\n1,2\n", '"a"')})
+    cache = ObjectCache(tmp_path)
+
+    first = collect_data.get_parsed_object(
+        s3_client, "bucket", "a.csv", collect_data.read_content_csv, cache
+    )
+    cache.save()
+    second = collect_data.get_parsed_object(
+        s3_client, "bucket", "a.csv",
+        lambda body: pytest.fail("unchanged object was parsed again"),
+        ObjectCache(tmp_path)
+    )
+
+    assert second.equals(first)
+    assert s3_client.requests == ["a.csv", "a.csv"]
+
+
+def test_collect_moodle_dfs_course_shards(
+    mocker, tmp_path, local_file_collections, autogenerated_user_uuid
+):
+    (moodle_grades_2, moodle_users_2,
+     moodle_grades_3, moodle_users_3) = local_file_collections[:4]
+    s3_client = ConditionalS3Client({
+        f"data/moodle/{kind}/{course_id}.json": (
+            json.dumps(data).encode("utf-8"), f'"{kind}{course_id}"'
+        )
+        for kind, course_id, data in [
+            ("grades", 2, moodle_grades_2), ("grades", 3, moodle_grades_3),
+            ("users", 2, moodle_users_2), ("users", 3, moodle_users_3),
+        ]
+    })
+    mocker.patch("boto3.client", lambda service, **kwargs: s3_client)
+    mocker.patch(
+        "enclave_mgmt.collect_data.uuid4", lambda: autogenerated_user_uuid
+    )
+
+    expected = collect_data.collect_moodle_dfs("bucket", "data")
+    cache = ObjectCache(tmp_path)
+    first = collect_data.collect_moodle_dfs("bucket", "data", cache=cache)
+    cache.save()
+    s3_client.requests = []
+    cached = collect_data.collect_moodle_dfs(
+        "bucket", "data", cache=ObjectCache(tmp_path)
+    )
+
+    assert s3_client.requests == []
+    assert len(list((tmp_path / "shards").iterdir())) == 4
+    for name, df in expected.items():
+        assert len(df) > 0
+        pd.testing.assert_frame_equal(first[name], df)
+        pd.testing.assert_frame_equal(cached[name], df)
+
+
+def test_collect_data_concurrent_shared_client(mocker, tmp_path):
+    data_bucket, data_prefix, events_bucket, events_prefix = generate(
+        tmp_path, courses=2, students=3, events=10
+    )
+    s3_client = LocalS3Client(tmp_path)
+    create_client = mocker.patch("boto3.client", return_value=s3_client)
+
+    sequential = collect_data.collect_data(
+        data_bucket, data_prefix, events_bucket, events_prefix,
+        max_workers=1
+    )
+    concurrent = collect_data.collect_data(
+        data_bucket, data_prefix, events_bucket, events_prefix,
+        max_workers=4
+    )
+
+    assert create_client.call_count == 2
+    config = create_client.call_args.kwargs["config"]
+    assert config.max_pool_connections == \
+        4 + len(collect_data.EVENT_FILES) + 1
+    assert list(concurrent) == list(sequential)
+    for name, df in sequential.items():
+        pd.testing.assert_frame_equal(concurrent[name], df)
+
+
+@pytest.mark.parametrize("spool_bytes", [0, 1024])
+def test_object_body_streams_or_spools(test_data_path, spool_bytes):
+    contents = (test_data_path / "quiz_questions.csv").read_bytes()
+    data = {
+        "Body": io.BytesIO(contents), "ContentLength": len(contents)
+    }
+    with collect_data.object_body(data, spool_bytes) as body:
+        assert (body is data["Body"]) == (len(contents) <= spool_bytes)
+        df = collect_data.read_content_csv(
+            body, collect_data.CONTENT_CSV_DTYPES["quiz_questions"]
+        )
+    assert data["Body"].closed
+    expected = pd.read_csv(
+        test_data_path / "quiz_questions.csv", keep_default_na=False
+    )
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_object_body_closes_stream_on_error():
+    data = {"Body": io.BytesIO(b"a,b\n1,2\n"), "ContentLength": 8}
+    with pytest.raises(ValueError):
+        with collect_data.object_body(data):
+            raise ValueError("parse failed")
+    assert data["Body"].closed
+
+
+def test_normalize_pset_problem_attempts():
+    responses = [
+        {"string": "Option 1", "array": None},
+        {"string": None, "array": ["a", "b"]},
+        {"string": "", "array": ["c"]},
+        {"string": "", "array": []},
+        {"string": "", "array": None},
+    ]
+    df = pd.DataFrame({"attempt": range(len(responses))})
+    df["response"] = responses
+
+    res = collect_data.normalize_pset_problem_attempts(df)
+
+    assert list(res.columns) == ["attempt", "response", "response_is_str"]
+    assert res["response"].tolist() == [
+        response["string"] or response["array"] for response in responses
+    ]
+    assert res["response_is_str"].tolist() == [
+        True, False, False, False, False
+    ]
+
+
+def test_generate_users_df_ignores_email_case():
+    """generate_users_df should treat emails differing only in case as the
+    same user and keep the first one seen
+    """
+    def course_user(user_id, email):
+        return {
+            'id': user_id, 'firstname': 'Tony', 'lastname': 'Soprano',
+            'email': email, 'uuid': f'uuid-{user_id}'
+        }
+    users_dict = {
+        1: [course_user(1, 'TSoprano@gabagool.com')],
+        2: [course_user(2, 'tsoprano@gabagool.com'),
+            course_user(3, 'cmoltisanti@gabagool.com')],
+    }
+
+    res = collect_data.generate_users_df(users_dict)
+
+    assert res['user_id'].tolist() == [1, 3]
+    assert res['email'].tolist() == [
+        'TSoprano@gabagool.com', 'cmoltisanti@gabagool.com'
+    ]
+
+
+def test_collect_moodle_dfs_rebuilds_and_prunes_shards(
+    mocker, tmp_path, local_file_collections
+):
+    moodle_grades_2, moodle_users_2 = local_file_collections[:2]
+    s3_client = ConditionalS3Client({
+        "data/moodle/grades/2.json": (
+            json.dumps(moodle_grades_2).encode("utf-8"), '"grades2"'
+        ),
+        "data/moodle/users/2.json": (
+            json.dumps(moodle_users_2).encode("utf-8"), '"users2"'
+        ),
+    })
+    mocker.patch("boto3.client", lambda service, **kwargs: s3_client)
+
+    def collect():
+        cache = ObjectCache(tmp_path)
+        collect_data.collect_moodle_dfs("bucket", "data", cache=cache)
+        cache.save()
+        return sorted(path.name for path in (tmp_path / "shards").iterdir())
+
+    first = collect()
+    s3_client.objects["data/moodle/grades/2.json"] = (
+        json.dumps(moodle_grades_2 | {"quizzes": []}).encode("utf-8"),
+        '"grades2-changed"'
+    )
+    changed = collect()
+
+    assert len(first) == len(changed) == 2
+    assert first[1] == changed[1]
+    assert first[0] != changed[0]
+
+    mocker.patch.object(
+        collect_data, "SHARD_FORMAT_VERSION",
+        collect_data.SHARD_FORMAT_VERSION + 1
+    )
+    s3_client.requests = []
+    bumped = collect()
+
+    assert sorted(s3_client.requests) == [
+        "data/moodle/grades/2.json", "data/moodle/users/2.json"
+    ]
+    assert len(bumped) == 2
+    assert set(bumped).isdisjoint(changed)
+
+
+def test_get_event_chunks_requests_object_lazily(test_data_path):
+    with open(test_data_path / "content_loaded_v1.json", "rb") as f:
+        s3_client = ConditionalS3Client({"events.json": (f.read(), '"a"')})
+
+    chunks = collect_data.get_event_chunks(
+        s3_client, "bucket", "events.json", chunk_rows=1
+    )
+    assert s3_client.requests == []
+
+    assert len(next(chunks)) == 1
+    assert s3_client.requests == ["events.json"]
+    assert len(list(chunks)) > 0
@@ -1,15 +1,23 @@
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
 import boto3
 from botocore.stub import Stubber
 from enclave_mgmt import compile_models
+import argparse
 import io
 import json
 import os
 import csv
+import pandas as pd
 import pytest
 
 
-@pytest.fixture
-def stubber_setup(local_file_collections):
+RESEARCH_FILTER_BUCKET = "sample_filter_bucket"
+RESEARCH_FILTER_KEY = "algebra1/ay2023/automation/courses.csv"
+
+
+def setup_stubber(local_file_collections, research_filter=None,
+                  course_ids=(2, 3)):
     (moodle_grades_2, moodle_users_2,
      moodle_grades_3, moodle_users_3,
         quiz_questions, quiz_question_contents,
@@ -30,18 +38,20 @@ def stubber_setup(local_file_collections):
     event_data_bucket_name = "sample_event_bucket"
     event_data_key = "event_data_files"
 
+    moodle_grades = {2: moodle_grades_2, 3: moodle_grades_3}
+    moodle_users = {2: moodle_users_2, 3: moodle_users_3}
     grade_list = {"Contents": [{"Key": "2.json"}, {"Key": "3.json"}]}
     user_list = {"Contents": [{"Key": "2.json"}, {"Key": "3.json"}]}
 
-    grades_data_2 = json.dumps(moodle_grades_2).encode('utf-8')
-    grades_data_2_obj = {"Body": io.BytesIO(grades_data_2)}
-    users_data_2 = json.dumps(moodle_users_2).encode('utf-8')
-    users_data_2_obj = {"Body": io.BytesIO(users_data_2)}
-
-    grades_data_3 = json.dumps(moodle_grades_3).encode('utf-8')
-    grades_data_3_obj = {"Body": io.BytesIO(grades_data_3)}
-    users_data_3 = json.dumps(moodle_users_3).encode('utf-8')
-    users_data_3_obj = {"Body": io.BytesIO(users_data_3)}
+    if research_filter is not None:
+        body = io.BytesIO(research_filter.encode('utf-8'))
+        stubber_client.add_response(
+            'get_object', {"Body": body},
+            expected_params={
+                'Bucket': RESEARCH_FILTER_BUCKET,
+                'Key': RESEARCH_FILTER_KEY
+            }
+        )
 
     stubber_client.add_response(
         "list_objects", grade_list,
@@ -49,20 +59,15 @@ def stubber_setup(local_file_collections):
             'Bucket': data_bucket_name,
             'Prefix': f"{data_key}/moodle/grades"
         })
-    stubber_client.add_response(
-        'get_object', grades_data_2_obj,
-        expected_params={
-            'Bucket': data_bucket_name,
-            'Key': '2.json'
-        }
-    )
-    stubber_client.add_response(
-        'get_object', grades_data_3_obj,
-        expected_params={
-            'Bucket': data_bucket_name,
-            'Key': '3.json'
-        }
-    )
+    for course_id in course_ids:
+        grades_data = json.dumps(moodle_grades[course_id]).encode('utf-8')
+        stubber_client.add_response(
+            'get_object', {"Body": io.BytesIO(grades_data)},
+            expected_params={
+                'Bucket': data_bucket_name,
+                'Key': f'{course_id}.json'
+            }
+        )
     stubber_client.add_response(
         "list_objects", user_list,
         expected_params={
@@ -70,20 +75,15 @@ def stubber_setup(local_file_collections):
             'Prefix': f"{data_key}/moodle/users"
         }
     )
-    stubber_client.add_response(
-        'get_object', users_data_2_obj,
-        expected_params={
-            'Bucket': data_bucket_name,
-            'Key': '2.json'
-        }
-    )
-    stubber_client.add_response(
-        'get_object', users_data_3_obj,
-        expected_params={
-            'Bucket': data_bucket_name,
-            'Key': '3.json'
-        }
-    )
+    for course_id in course_ids:
+        users_data = json.dumps(moodle_users[course_id]).encode('utf-8')
+        stubber_client.add_response(
+            'get_object', {"Body": io.BytesIO(users_data)},
+            expected_params={
+                'Bucket': data_bucket_name,
+                'Key': f'{course_id}.json'
+            }
+        )
 
     body = io.BytesIO(quiz_questions.encode('utf-8'))
     stubber_client.add_response(
@@ -176,6 +176,21 @@ def stubber_setup(local_file_collections):
     )
 
 
+@pytest.fixture
+def stubber_setup(local_file_collections):
+    return setup_stubber(local_file_collections)
+
+
+@pytest.fixture
+def filtered_stubber_setup(local_file_collections, local_research_filter):
+    """Stubbed S3 responses when only course 3 participates in research so
+    course 2 objects are never fetched
+    """
+    return setup_stubber(
+        local_file_collections, local_research_filter, course_ids=(3,)
+    )
+
+
 def compare_results_against_expected_csvs(output_path, expected_csvs):
     (expected_assignments,
      expected_users,
@@ -296,11 +311,25 @@ def compare_results_against_expected_csvs(output_path, expected_csvs):
             assert i in results
 
 
+@pytest.mark.parametrize("extra_args", [
+    [],
+    ["--validation_mode", "batch"],
+    ["--validation_level", "schema"],
+    ["--validation_level", "sampled", "--validation_sample_fraction", "0.5",
+     "--table_validation_level", "grades=full",
+     "--table_validation_level", "content_loads.csv=off"],
+    ["--output_format", "csv", "parquet", "arrow"],
+    ["--cache_dir", "{tmp_path}/cache"],
+    ["--event_chunk_rows", "1"],
+    ["--event_chunk_rows", "2", "--cache_dir", "{tmp_path}/cache",
+     "--output_format", "csv", "parquet", "arrow"],
+])
 def test_compile_models(
     mocker, tmp_path, autogenerated_user_uuid,
-    local_expected_csvs, stubber_setup
+    local_expected_csvs, stubber_setup, extra_args
 ):
     os.environ["CSV_OUTPUT_DIR"] = str(tmp_path)
+    extra_args = [arg.format(tmp_path=tmp_path) for arg in extra_args]
 
     mocker.patch(
         "enclave_mgmt.collect_data.uuid4",
@@ -313,12 +342,12 @@ def test_compile_models(
      ) = stubber_setup
 
     stubber_client.activate()
-    mocker.patch('boto3.client', lambda service: s3_client)
+    mocker.patch('boto3.client', lambda service, **kwargs: s3_client)
 
     mocker.patch(
         "sys.argv",
         ["", data_bucket_name, data_key, event_data_bucket_name,
-         event_data_key]
+         event_data_key, "--max_workers", "1"] + extra_args
     )
     compile_models.main()
 
@@ -326,11 +355,28 @@ def test_compile_models(
 
     compare_results_against_expected_csvs(tmp_path, local_expected_csvs)
 
-
+    if "parquet" in extra_args:
+        for csv_path in tmp_path.glob("*.csv"):
+            expected = pd.read_csv(csv_path)
+            for extension in [".parquet", ".arrow"]:
+                res = pd.read_parquet(csv_path.with_suffix(extension)) \
+                    if extension == ".parquet" else \
+                    pd.read_feather(csv_path.with_suffix(extension))
+                assert sorted(res.columns) == sorted(expected.columns)
+                assert len(res) == len(expected)
+
+    if "--cache_dir" in extra_args:
+        with open(tmp_path / "manifest.json") as f:
+            manifest = json.load(f)
+        assert f"{data_key}/content/quiz_questions.csv" in [
+            entry["key"] for entry in manifest["objects"]
+        ]
+
+
+@pytest.mark.parametrize("extra_args", [[], ["--event_chunk_rows", "1"]])
 def test_compile_models_filtered(
     mocker, tmp_path, autogenerated_user_uuid,
-    local_expected_filtered_csvs, local_research_filter,
-    stubber_setup
+    local_expected_filtered_csvs, filtered_stubber_setup, extra_args
 ):
     os.environ["CSV_OUTPUT_DIR"] = str(tmp_path)
 
@@ -342,28 +388,17 @@ def test_compile_models_filtered(
     (s3_client, stubber_client,
      data_bucket_name, data_key,
      event_data_bucket_name, event_data_key
-     ) = stubber_setup
-
-    research_filter_bucket = "sample_filter_bucket"
-    research_filter_key = "algebra1/ay2023/automation/courses.csv"
-
-    body = io.BytesIO(local_research_filter.encode('utf-8'))
-    stubber_client.add_response(
-        'get_object', {"Body": body},
-        expected_params={
-            'Bucket': research_filter_bucket,
-            'Key': research_filter_key
-        }
-    )
+     ) = filtered_stubber_setup
 
     stubber_client.activate()
-    mocker.patch('boto3.client', lambda service: s3_client)
+    mocker.patch('boto3.client', lambda service, **kwargs: s3_client)
 
     mocker.patch(
         "sys.argv",
         ["", data_bucket_name, data_key, event_data_bucket_name,
-         event_data_key, "--research_filter_bucket", research_filter_bucket,
-         "--research_filter_prefix", research_filter_key]
+         event_data_key, "--research_filter_bucket", RESEARCH_FILTER_BUCKET,
+         "--research_filter_prefix", RESEARCH_FILTER_KEY,
+         "--max_workers", "1"] + extra_args
     )
     compile_models.main()
 
@@ -373,3 +408,142 @@ def test_compile_models_filtered(
         tmp_path,
         local_expected_filtered_csvs
     )
+
+
+def test_compile_models_invalid_table_validation_level(mocker, tmp_path):
+    os.environ["CSV_OUTPUT_DIR"] = str(tmp_path)
+    mocker.patch(
+        "sys.argv",
+        ["", "bucket", "data", "bucket", "events",
+         "--table_validation_level", "unknown=off"]
+    )
+
+    with pytest.raises(SystemExit):
+        compile_models.main()
+
+
+def test_load_research_filter_blank_participation(mocker):
+    research_filter = (
+        "course_id,district,research_participation\n"
+        "2,District 2,0\n"
+        "3,District 3,1\n"
+        "4,District 4,\n"
+    )
+    s3_client = mocker.Mock()
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(research_filter.encode("utf-8"))
+    }
+    mocker.patch("boto3.client", lambda service, **kwargs: s3_client)
+
+    res = compile_models.load_research_filter(
+        RESEARCH_FILTER_BUCKET, RESEARCH_FILTER_KEY
+    )
+
+    assert res['course_id'].tolist() == [3]
+
+
+@pytest.mark.parametrize("data_prefix,args", [
+    ("data", ["--years", "ay2023", "ay2024"]),
+    ("data", ["--year_spec", "ay2023=data"]),
+    ("data/{year}", ["--year_spec", "ay2023=data,events",
+                     "--years", "ay2023"]),
+])
+def test_compile_models_invalid_years(mocker, tmp_path, data_prefix, args):
+    os.environ["CSV_OUTPUT_DIR"] = str(tmp_path)
+    mocker.patch(
+        "sys.argv", ["", "bucket", data_prefix, "bucket", "events"] + args
+    )
+
+    with pytest.raises(SystemExit):
+        compile_models.main()
+
+
+def test_year_args_uses_year_specs():
+    args = argparse.Namespace(
+        data_prefix="{year}/data", events_prefix="events/{year}",
+        research_filter_prefix="{year}/courses.csv", cache_dir=None,
+        year_specs={"ay2022": {
+            "data_prefix": "archive/ay2022", "events_prefix": "events"
+        }}
+    )
+
+    spec = compile_models.year_args(args, "ay2022")
+    template = compile_models.year_args(args, "ay2023")
+
+    assert (spec.data_prefix, spec.events_prefix,
+            spec.research_filter_prefix) == (
+        "archive/ay2022", "events", "ay2022/courses.csv"
+    )
+    assert (template.data_prefix, template.events_prefix) == (
+        "ay2023/data", "events/ay2023"
+    )
+    assert spec.cache_dir is None
+
+    args.cache_dir = "cache"
+    assert compile_models.year_args(args, "ay2022").cache_dir == \
+        os.path.join("cache", "ay2022")
+
+
+def test_compile_models_years(tmp_path, mocker):
+    data_path = tmp_path / "s3"
+    output_path = tmp_path / "output"
+    output_path.mkdir()
+    for students, year in [(2, "ay2023"), (3, "ay2024")]:
+        generate(
+            data_path, courses=1, students=students, events=5,
+            data_prefix=f"{year}/data", events_prefix=f"events/{year}"
+        )
+    # An older year laid out differently from the prefix templates
+    generate(
+        data_path, courses=1, students=4, events=5,
+        data_prefix="archive/ay2022", events_prefix="legacy-events"
+    )
+    s3_client = LocalS3Client(data_path)
+    mocker.patch(
+        "boto3.client", lambda service, **kwargs: s3_client
+    )
+    mocker.patch(
+        "sys.argv",
+        ["", "raise-data", "{year}/data", "raise-events", "events/{year}",
+         "--years", "ay2023", "ay2024", "--year_workers", "1",
+         "--year_spec", "ay2022=archive/ay2022,legacy-events"]
+    )
+    mocker.patch.dict("os.environ", {"CSV_OUTPUT_DIR": str(output_path)})
+
+    compile_models.main()
+
+    for students, year in [(2, "ay2023"), (3, "ay2024"), (4, "ay2022")]:
+        users = pd.read_csv(output_path / year / "users.csv")
+        assert len(users) == students + 1
+        assert (output_path / year / "metrics.json").exists()
+    assert not (output_path / "users.csv").exists()
+
+
+def test_compile_models_selected_models(tmp_path, mocker):
+    data_path = tmp_path / "s3"
+    output_path = tmp_path / "output"
+    output_path.mkdir()
+    data_bucket, data_prefix, events_bucket, events_prefix = generate(
+        data_path, courses=2, students=3, events=20
+    )
+    s3_client = LocalS3Client(data_path)
+    get_object = mocker.spy(s3_client, "get_object")
+    mocker.patch(
+        "boto3.client", lambda service, **kwargs: s3_client
+    )
+    mocker.patch(
+        "sys.argv",
+        ["", data_bucket, data_prefix, events_bucket, events_prefix,
+         "--models", "users", "quiz_questions.csv"]
+    )
+    mocker.patch.dict("os.environ", {"CSV_OUTPUT_DIR": str(output_path)})
+
+    compile_models.main()
+
+    assert sorted(path.name for path in output_path.glob("*.csv")) == [
+        "quiz_questions.csv", "users.csv"
+    ]
+    fetched = {call.kwargs["Key"] for call in get_object.call_args_list}
+    assert f"{data_prefix}/content/quiz_questions.csv" in fetched
+    assert f"{data_prefix}/content/ib_pset_problems.csv" not in fetched
+    assert not any(key.startswith(events_prefix) for key in fetched)
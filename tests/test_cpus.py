@@ -0,0 +1,39 @@
+from enclave_mgmt import cpus
+import pytest
+
+
+@pytest.mark.parametrize("cpu_max,expected", [
+    ("max 100000", None),
+    ("200000 100000", 2),
+    ("150000 100000", 2),
+    ("50000 100000", 1),
+])
+def test_cgroup_cpu_limit_v2(mocker, tmp_path, cpu_max, expected):
+    cpu_max_path = tmp_path / "cpu.max"
+    cpu_max_path.write_text(f"{cpu_max}\n")
+    mocker.patch.object(cpus, "CGROUP_V2_CPU_MAX", str(cpu_max_path))
+
+    assert cpus.cgroup_cpu_limit() == expected
+
+
+@pytest.mark.parametrize("quota,expected", [("-1", None), ("300000", 3)])
+def test_cgroup_cpu_limit_v1(mocker, tmp_path, quota, expected):
+    (tmp_path / "quota").write_text(f"{quota}\n")
+    (tmp_path / "period").write_text("100000\n")
+    mocker.patch.object(cpus, "CGROUP_V2_CPU_MAX", str(tmp_path / "missing"))
+    mocker.patch.object(cpus, "CGROUP_V1_CPU_QUOTA", str(tmp_path / "quota"))
+    mocker.patch.object(
+        cpus, "CGROUP_V1_CPU_PERIOD", str(tmp_path / "period")
+    )
+
+    assert cpus.cgroup_cpu_limit() == expected
+
+
+def test_available_cpus_capped_by_quota(mocker):
+    mocker.patch("os.sched_getaffinity", lambda pid: set(range(8)),
+                 create=True)
+    mocker.patch.object(cpus, "cgroup_cpu_limit", lambda: 2)
+    assert cpus.available_cpus() == 2
+
+    mocker.patch.object(cpus, "cgroup_cpu_limit", lambda: None)
+    assert cpus.available_cpus() == 8
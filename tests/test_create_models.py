@@ -1,6 +1,11 @@
-from enclave_mgmt import create_models
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
+from enclave_mgmt import collect_data, create_models
 from uuid import UUID
+import json
 import pandas as pd
+import pytest
+import threading
 
 
 def test_duplicate_user_uuid():
@@ -33,3 +38,275 @@ def test_duplicate_user_uuid():
     expected_df = pd.DataFrame(expected_data)
 
     assert res.equals(expected_df)
+
+
+def test_map_column_drops_unmatched_rows():
+    df = pd.DataFrame({'user_id': [3, 1, 2, 1], 'value': ['a', 'b', 'c', 'd']})
+    lookup = pd.Series(['uuid1', 'uuid3'], index=[1, 3])
+
+    res = create_models.map_column(df, 'user_id', lookup, 'user_uuid')
+
+    expected = pd.merge(
+        df, pd.DataFrame({'user_id': [1, 3], 'uuid': ['uuid1', 'uuid3']}),
+        on='user_id'
+    ).drop(columns='user_id').rename(columns={'uuid': 'user_uuid'})
+    assert res.to_dict(orient='records') == \
+        expected.to_dict(orient='records')
+    assert list(res.columns) == ['user_uuid', 'value']
+    assert list(res.index) == [0, 1, 2]
+
+
+def test_filter_events_uses_enrollment_keys():
+    clean_raw_df = {
+        'moodle_users': pd.DataFrame({
+            'user_id': [1, 2], 'uuid': ['uuid1', 'uuid2']
+        }),
+        'enrollments': pd.DataFrame({
+            'user_id': [1, 2, 3], 'course_id': [10, 20, 10]
+        }),
+    }
+    events_df = pd.DataFrame({
+        'user_uuid': ['uuid1', 'uuid1', 'uuid2', 'uuid3'],
+        'course_id': [10, 20, 20, 10],
+        'timestamp': [1, 2, 3, 4]
+    })
+
+    enrollment_keys = create_models.enrollment_keys_lookup(clean_raw_df)
+    res = create_models.filter_events(
+        events_df, clean_raw_df, enrollment_keys
+    )
+
+    assert list(res['timestamp']) == [1, 3]
+
+
+def test_required_nodes_follow_dependencies():
+    nodes = create_models.required_nodes([
+        create_models.MODEL_QUIZ_ATTEMPTS, create_models.MODEL_FILE_COURSES
+    ])
+    assert nodes == [
+        "quiz_multichoice_answers", "user_uuids", "assessment_ids",
+        "quiz_attempts_and_multichoice_responses", "courses"
+    ]
+    assert create_models.required_raw_tables([
+        create_models.MODEL_FILE_COURSES
+    ]) == {"courses"}
+    assert create_models.required_raw_tables([
+        create_models.MODEL_FILE_USERS
+    ]) == {"moodle_users"}
+    assert create_models.required_raw_tables(
+        [create_models.MODEL_FILE_USERS], filtered=True
+    ) == {"moodle_users", "enrollments"}
+    assert create_models.required_raw_tables([
+        create_models.MODEL_FILE_ENROLLMENTS
+    ]) == {"moodle_users", "enrollments"}
+    assert create_models.required_raw_tables([
+        create_models.MODEL_CONTENT_LOADS
+    ]) == {"moodle_users", "enrollments", "content_loads"}
+    assert create_models.required_raw_tables([
+        create_models.MODEL_QUIZ_QUESTIONS
+    ]) == {"grades", "quiz_questions"}
+
+
+def test_required_nodes_unknown_model():
+    with pytest.raises(ValueError):
+        create_models.required_nodes(["unknown.csv"])
+
+
+def test_build_nodes_runs_independent_nodes_concurrently(mocker):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def independent(clean_raw_df, validator=None):
+        barrier.wait()
+        return clean_raw_df["x"]
+
+    def dependent(clean_raw_df, validator=None, a=None, b=None):
+        return a + b
+
+    nodes = {
+        "a": create_models.ModelNode(["a"], independent),
+        "b": create_models.ModelNode(["b"], independent),
+        "c": create_models.ModelNode(
+            ["c"], dependent, dependencies={"a": "a", "b": "b"}
+        ),
+    }
+    mocker.patch.object(create_models, "MODEL_NODES", nodes)
+    mocker.patch.object(
+        create_models, "NODE_OUTPUTS", {"a": "a", "b": "b", "c": "c"}
+    )
+
+    built = create_models.build_nodes(
+        ["a", "b", "c"], {"x": 1}, None, max_workers=2
+    )
+    assert built == {"a": 1, "b": 1, "c": 2}
+
+    with pytest.raises(ValueError):
+        create_models.build_nodes(["c"], {"x": 1}, None, max_workers=2)
+
+
+def synthetic_clean_raw_df(tmp_path, mocker, **kwargs):
+    data_bucket, data_prefix, _, _ = generate(tmp_path, **kwargs)
+    s3_client = LocalS3Client(tmp_path)
+    mocker.patch("boto3.client", lambda service, **kwargs: s3_client)
+    raw_dfs = collect_data.collect_moodle_dfs(data_bucket, data_prefix) | \
+        collect_data.collect_content_dfs(data_bucket, data_prefix)
+    return create_models.scrub_raw_dfs(raw_dfs)
+
+
+def quiz_lookups(clean_raw_df):
+    return (
+        create_models.user_uuids_lookup(clean_raw_df),
+        create_models.assessment_ids_lookup(clean_raw_df),
+    )
+
+
+@pytest.mark.parametrize("students", [0, 5])
+def test_quiz_attempts_lookup_matches_merges(tmp_path, mocker, students):
+    clean_raw_df = synthetic_clean_raw_df(
+        tmp_path, mocker, courses=3, students=students, events=0
+    )
+    lookups = quiz_lookups(clean_raw_df)
+    answers_df = create_models.multichoice_answer_model(clean_raw_df)
+
+    looked_up = create_models.lookup_quiz_attempts_and_multichoice_responses(
+        clean_raw_df, answers_df, *lookups
+    )
+    merged = create_models.merge_quiz_attempts_and_multichoice_responses(
+        clean_raw_df, answers_df, *lookups
+    )
+
+    assert looked_up is not None
+    for looked_up_df, merged_df in zip(looked_up, merged):
+        pd.testing.assert_frame_equal(looked_up_df, merged_df)
+    if students:
+        assert len(looked_up[1]) > 0
+
+
+def fixture_clean_raw_df(test_data_path):
+    grades, users = {}, {}
+    for course_id in [2, 3]:
+        with open(test_data_path / f"grades_{course_id}.json") as f:
+            grades[course_id] = json.load(f)
+        with open(test_data_path / f"users_{course_id}.json") as f:
+            users[course_id] = json.load(f)
+    raw_dfs = {
+        'moodle_users': collect_data.generate_users_df(users),
+        'grades': collect_data.generate_grade_df(grades),
+        'quiz_data': collect_data.generate_quiz_data_df(grades),
+        'attempts_summary':
+            collect_data.generate_attempts_summary_df(grades),
+        'attempt_multichoice_response':
+            collect_data.generate_attempt_multichoice_response_df(grades),
+    }
+    for name in ['quiz_questions', 'quiz_multichoice_answers']:
+        raw_dfs[name] = collect_data.read_content_csv(
+            test_data_path / f"{name}.csv",
+            collect_data.CONTENT_CSV_DTYPES.get(name)
+        )
+    return create_models.scrub_raw_dfs(raw_dfs)
+
+
+def test_quiz_attempts_lookup_keys_attempts_by_course(test_data_path, mocker):
+    """Attempt ids repeat across the courses of the fixtures, so attempts
+    are keyed by course and the lookup should run rather than fall back
+    """
+    clean_raw_df = fixture_clean_raw_df(test_data_path)
+    attempts_summary = clean_raw_df['attempts_summary']
+    assert attempts_summary['attempt_id'].duplicated().any()
+    lookups = quiz_lookups(clean_raw_df)
+    answers_df = create_models.multichoice_answer_model(clean_raw_df)
+    merge = mocker.spy(
+        create_models, 'merge_quiz_attempts_and_multichoice_responses'
+    )
+
+    attempts_df, responses_df = \
+        create_models.quiz_attempts_and_multichoice_responses_model(
+            clean_raw_df, answers_df, user_uuids=lookups[0],
+            assessment_ids=lookups[1]
+        )
+
+    merge.assert_not_called()
+    merged = create_models.merge_quiz_attempts_and_multichoice_responses(
+        clean_raw_df, answers_df, *lookups
+    )
+    pd.testing.assert_frame_equal(attempts_df, merged[0])
+    pd.testing.assert_frame_equal(responses_df, merged[1])
+    # Responses are only attached to the attempt of their own course
+    course_ids = attempts_df.set_index('id')['course_id']
+    assert set(course_ids[responses_df['attempt_id']]) == {2}
+
+
+def test_quiz_attempts_lookup_falls_back_on_repeated_attempt_ids(
+    tmp_path, mocker, caplog
+):
+    clean_raw_df = synthetic_clean_raw_df(
+        tmp_path, mocker, courses=1, students=1, events=0
+    )
+    attempts_summary = clean_raw_df['attempts_summary']
+    clean_raw_df['attempts_summary'] = pd.concat(
+        [attempts_summary, attempts_summary.head(1)], ignore_index=True
+    )
+    user_uuids, assessment_ids = quiz_lookups(clean_raw_df)
+    answers_df = create_models.multichoice_answer_model(clean_raw_df)
+
+    with caplog.at_level("INFO", logger="enclave_mgmt.create_models"):
+        assert create_models.lookup_quiz_attempts_and_multichoice_responses(
+            clean_raw_df, answers_df, user_uuids, assessment_ids
+        ) is None
+    assert "merging quiz responses" in caplog.text
+    _, responses_df = \
+        create_models.quiz_attempts_and_multichoice_responses_model(
+            clean_raw_df, answers_df, user_uuids=user_uuids,
+            assessment_ids=assessment_ids
+        )
+    _, merged_responses_df = \
+        create_models.merge_quiz_attempts_and_multichoice_responses(
+            clean_raw_df, answers_df, user_uuids, assessment_ids
+        )
+    pd.testing.assert_frame_equal(responses_df, merged_responses_df)
+
+
+def test_scrub_raw_dfs_coerces_grades_and_emails():
+    raw_dfs = {
+        'moodle_users': pd.DataFrame({'email': ['TSoprano@Gabagool.com']}),
+        'grades': pd.DataFrame({
+            'assessment_name': ['Quiz 1', 'Quiz 1', None, 'Quiz 2'],
+            'grade_percentage': ['85.00 %', '-', '50.00 %', '85.00 %'],
+            'time_submitted': [1700000000, None, 1700000001, 1700000002],
+        }),
+    }
+
+    res = create_models.scrub_raw_dfs(raw_dfs)
+
+    assert res['moodle_users']['email'].tolist() == ['tsoprano@gabagool.com']
+    pd.testing.assert_frame_equal(res['grades'], pd.DataFrame({
+        'assessment_name': ['Quiz 1', 'Quiz 1', 'Quiz 2'],
+        'grade_percentage': [85.0, float('nan'), 85.0],
+        'time_submitted': [1700000000.0, float('nan'), 1700000002.0],
+    }, index=[0, 1, 3]))
+
+
+def test_create_models_model_workers_match_sequential(tmp_path, mocker):
+    data_bucket, data_prefix, events_bucket, events_prefix = generate(
+        tmp_path / "s3", courses=3, students=10, events=20
+    )
+    s3_client = LocalS3Client(tmp_path / "s3")
+    mocker.patch("boto3.client", lambda service, **kwargs: s3_client)
+
+    outputs = {}
+    for model_workers in [1, 8, 8]:
+        output_path = tmp_path / f"output-{len(outputs)}"
+        output_path.mkdir()
+        all_raw_dfs = collect_data.collect_data(
+            data_bucket, data_prefix, events_bucket, events_prefix
+        )
+        create_models.create_models(
+            str(output_path), all_raw_dfs, model_workers=model_workers
+        )
+        outputs[output_path] = {
+            path.name: path.read_bytes() for path in output_path.iterdir()
+        }
+
+    sequential, *concurrent = outputs.values()
+    assert len(sequential) == len(create_models.MODEL_CLASSES)
+    for files in concurrent:
+        assert files == sequential
@@ -0,0 +1,76 @@
+import io
+import json
+import threading
+import pandas as pd
+from enclave_mgmt import metrics
+
+
+def test_stage_without_recording():
+    with metrics.stage("noop") as entry:
+        entry["rows_out"] = 1
+    metrics.add_s3_bytes(10)
+
+
+def test_recording_stages(tmp_path):
+    stream = io.StringIO()
+    with metrics.recording(stream) as recorder:
+        with metrics.stage("outer", rows_in=3) as outer:
+            metrics.add_s3_bytes(5)
+            with metrics.stage("inner"):
+                metrics.add_s3_bytes(7)
+            outer["rows_out"] = 2
+        metrics.add_files([{"file": "a.csv", "rows": 2, "bytes": 11}])
+    recorder.write_report(tmp_path)
+
+    with open(tmp_path / metrics.METRICS_FILE) as f:
+        report = json.load(f)
+    inner, outer = report["stages"]
+    assert inner["stage"] == "inner"
+    assert inner["s3_bytes"] == 7
+    assert outer["stage"] == "outer"
+    assert outer["s3_bytes"] == 5
+    assert outer["rows_in"] == 3
+    assert outer["rows_out"] == 2
+    assert outer["wall_seconds"] >= inner["wall_seconds"]
+    assert outer["peak_rss_bytes"] > 0
+    assert report["totals"]["s3_bytes"] == 12
+    assert report["totals"]["bytes_written"] == 11
+    assert [
+        json.loads(line)["stage"] for line in stream.getvalue().splitlines()
+    ] == ["inner", "outer"]
+
+
+def test_s3_bytes_attributed_to_thread_stage():
+    with metrics.recording() as recorder:
+        def collect():
+            with metrics.stage("worker"):
+                metrics.add_s3_bytes(3)
+
+        with metrics.stage("main"):
+            thread = threading.Thread(target=collect)
+            thread.start()
+            thread.join()
+    stages = {entry["stage"]: entry for entry in recorder.report()["stages"]}
+    assert stages["worker"]["s3_bytes"] == 3
+    assert stages["main"]["s3_bytes"] == 0
+
+
+def test_model_stage_counts_rows():
+    @metrics.model_stage("a", "b")
+    def build(clean_raw_df):
+        return clean_raw_df["a"], clean_raw_df["b"].head(1)
+
+    clean_raw_df = {
+        "a": pd.DataFrame({"x": [1, 2]}),
+        "b": pd.DataFrame({"x": [1, 2, 3]}),
+    }
+    with metrics.recording() as recorder:
+        build(clean_raw_df)
+    entry, = recorder.report()["stages"]
+    assert entry["stage"] == "build"
+    assert entry["rows_in"] == 5
+    assert entry["rows_out"] == 3
+
+
+def test_count_rows_chunks():
+    assert metrics.count_rows(pd.DataFrame({"x": [1]}), iter([])) is None
@@ -0,0 +1,53 @@
+from enclave_mgmt import object_cache
+from enclave_mgmt.object_cache import ObjectCache
+import json
+import pandas as pd
+
+
+def test_object_cache_persists(tmp_path):
+    cache = ObjectCache(tmp_path / "cache")
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", ["y", "z"]]})
+    cache.put("bucket", "events.json", '"etag"', df, variant=[3])
+    cache.save()
+
+    cache = ObjectCache(tmp_path / "cache")
+    assert cache.has("bucket", "events.json", '"etag"', variant=[3])
+    assert not cache.has("bucket", "events.json", '"other"', variant=[3])
+    assert not cache.has("bucket", "events.json", '"etag"')
+    assert cache.etag("bucket", "missing.json") is None
+    assert cache.get("bucket", "events.json").equals(df)
+
+
+def test_object_cache_manifest(tmp_path):
+    cache = ObjectCache(tmp_path / "cache")
+    cache.put("bucket", "a.json", '"a"', {"a": 1})
+    cache.put("bucket", "b.json", None, {"b": 1})
+    cache.get("bucket", "a.json")
+    cache.write_manifest(tmp_path)
+
+    with open(tmp_path / "manifest.json") as f:
+        manifest = json.load(f)
+
+    assert manifest["objects"] == [
+        {"bucket": "bucket", "key": "a.json", "etag": '"a"',
+         "source": "cache"},
+        {"bucket": "bucket", "key": "b.json", "etag": None, "source": "s3"},
+    ]
+    assert cache.etag("bucket", "b.json") is None
+
+
+def test_object_cache_format_version(tmp_path, mocker):
+    cache = ObjectCache(tmp_path / "cache")
+    cache.put("bucket", "a.csv", '"a"', pd.DataFrame({"a": [1]}))
+    cache.save()
+    assert ObjectCache(tmp_path / "cache").has("bucket", "a.csv", '"a"')
+
+    mocker.patch(
+        "enclave_mgmt.object_cache.CACHE_FORMAT_VERSION",
+        object_cache.CACHE_FORMAT_VERSION + 1
+    )
+    assert not ObjectCache(tmp_path / "cache").has("bucket", "a.csv", '"a"')
+
+    with open(tmp_path / "cache" / "index.json", "w") as f:
+        json.dump({"bucket/a.csv": {"etag": '"a"', "variant": None}}, f)
+    assert not ObjectCache(tmp_path / "cache").has("bucket", "a.csv", '"a"')
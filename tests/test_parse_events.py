@@ -0,0 +1,67 @@
+from enclave_mgmt import parse_events
+import io
+import json
+import pytest
+
+
+def test_iter_event_records_small_reads(test_data_path):
+    """iter_event_records should decode the same records as json.loads when
+    values straddle read boundaries
+    """
+    with open(test_data_path / "ib_pset_problem_attempted_v1.json", "rb") as f:
+        contents = f.read()
+
+    res = list(parse_events.iter_event_records(
+        io.BytesIO(contents), read_size=7
+    ))
+
+    assert res == json.loads(contents)['data']
+
+
+def test_iter_event_records_skips_other_keys():
+    contents = json.dumps({
+        "meta": {"data": [0], "count": 12345},
+        "data": [{"a": 1, "b": "é"}, {"a": 22, "b": None}],
+        "trailer": 1.5
+    }).encode('utf-8')
+
+    res = list(parse_events.iter_event_records(
+        io.BytesIO(contents), read_size=3
+    ))
+
+    assert res == [{"a": 1, "b": "é"}, {"a": 22, "b": None}]
+
+
+@pytest.mark.parametrize(
+    "contents", [b'{}', b'{"data": []}', b' {"data" : [ ] } ']
+)
+def test_read_events_empty(contents):
+    res = parse_events.read_events(io.BytesIO(contents))
+
+    assert len(res) == 0
+
+
+def test_iter_event_chunks(test_data_path):
+    """iter_event_chunks should split events into chunks of at most
+    chunk_rows rows
+    """
+    with open(test_data_path / "content_loaded_v1.json", "rb") as f:
+        contents = f.read()
+    expected = json.loads(contents)['data']
+
+    chunks = list(parse_events.iter_event_chunks(
+        io.BytesIO(contents), chunk_rows=2
+    ))
+
+    assert [len(chunk) for chunk in chunks[:-1]] == [2] * (len(chunks) - 1)
+    assert sum(len(chunk) for chunk in chunks) == len(expected)
+    assert parse_events.read_events(
+        io.BytesIO(contents), chunk_rows=2
+    ).to_dict(orient='records') == expected
+
+
+def test_iter_event_records_truncated():
+    with pytest.raises(ValueError):
+        list(parse_events.iter_event_records(
+            io.BytesIO(b'{"data": [{"a": 1}, {"a"')
+        ))
@@ -0,0 +1,63 @@
+from benchmarks.local_s3 import LocalS3Client
+from benchmarks.synthetic_data import generate
+from enclave_mgmt import compile_models
+from enclave_mgmt.create_models import MODEL_CLASSES
+import json
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+
+
+def test_synthetic_data_compiles(tmp_path, mocker):
+    data_path = tmp_path / "s3"
+    output_path = tmp_path / "output"
+    output_path.mkdir()
+    data_bucket, data_prefix, events_bucket, events_prefix = generate(
+        data_path, courses=2, students=3, events=20
+    )
+    s3_client = LocalS3Client(data_path)
+    mocker.patch(
+        "boto3.client", lambda service, **kwargs: s3_client
+    )
+    mocker.patch(
+        "sys.argv",
+        ["", data_bucket, data_prefix, events_bucket, events_prefix]
+    )
+    mocker.patch.dict("os.environ", {"CSV_OUTPUT_DIR": str(output_path)})
+
+    compile_models.main()
+
+    for file_name in MODEL_CLASSES:
+        assert len(pd.read_csv(output_path / file_name)) > 0
+    users = pd.read_csv(output_path / "users.csv")
+    assert len(users) == 2 * 4
+
+    with open(output_path / "metrics.json") as f:
+        report = json.load(f)
+    stages = {entry["stage"]: entry for entry in report["stages"]}
+    assert stages["collect_moodle_dfs"]["s3_bytes"] > 0
+    assert stages["collect_event_data_dfs"]["s3_bytes"] > 0
+    assert stages["users_model"]["rows_out"] == len(users)
+    assert report["totals"]["bytes_written"] == sum(
+        (output_path / file_name).stat().st_size
+        for file_name in MODEL_CLASSES
+    )
+
+
+def test_local_s3_client_conditional_get(tmp_path):
+    generate(tmp_path, courses=1, students=1, events=1)
+    s3_client = LocalS3Client(tmp_path)
+    key = "data/moodle/grades/1.json"
+    pages = list(s3_client.get_paginator("list_objects").paginate(
+        Bucket="raise-data", Prefix="data/moodle/grades"
+    ))
+    assert [item["Key"] for item in pages[0]["Contents"]] == [key]
+
+    data = s3_client.get_object(Bucket="raise-data", Key=key)
+    data["Body"].close()
+    assert data["ETag"] == pages[0]["Contents"][0]["ETag"]
+    with pytest.raises(ClientError) as error:
+        s3_client.get_object(
+            Bucket="raise-data", Key=key, IfNoneMatch=data["ETag"]
+        )
+    assert error.value.response["ResponseMetadata"]["HTTPStatusCode"] == 304
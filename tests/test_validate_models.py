@@ -0,0 +1,210 @@
+from enclave_mgmt.collect_data import compact_event_df
+from enclave_mgmt.models import Enrollment, Grade, IBProblemAttempts
+from enclave_mgmt.validate_models import (
+    ModelValidationError, Validator, validate_df, validate_df_batch,
+    validate_df_rows
+)
+from pydantic import ValidationError
+from uuid import UUID
+import pandas as pd
+import pytest
+
+
+GRADE_ROW = {
+    "assessment_id": 1,
+    "user_uuid": "3c2ab175-f9b9-42b5-9857-9fd789914a7c",
+    "course_id": 1,
+    "grade_percentage": 50.0,
+    "time_submitted": 1630500000,
+}
+PSET_ATTEMPT_ROW = {
+    "user_uuid": "123e4567-e89b-12d3-a456-426655440000",
+    "course_id": 1,
+    "impression_id": "123e4567-e89b-12d3-a456-426655440001",
+    "timestamp": 1630500000,
+    "content_id": "123e4567-e89b-12d3-a456-426655440002",
+    "pset_content_id": "123e4567-e89b-12d3-a456-426655440003",
+    "pset_problem_content_id": "123e4567-e89b-12d3-a456-426655440004",
+    "variant": "A",
+    "problem_type": "multiplechoice",
+    "response": "Option 1",
+    "correct": True,
+    "attempt": 1,
+    "final_attempt": False,
+}
+ENROLLMENT_ROW = {
+    "user_uuid": UUID("123e4567-e89b-12d3-a456-426655440000"),
+    "course_id": 1,
+    "role": "student",
+}
+
+
+def make_df(row, count=5, **overrides):
+    """Build a dataframe of valid rows where the row labelled 13 has the
+    given column overrides
+    """
+    rows = [dict(row) for _ in range(count)]
+    rows[3].update(overrides)
+    return pd.DataFrame(rows, index=range(10, 10 + count))
+
+
+@pytest.mark.parametrize("model,row", [
+    (Grade, GRADE_ROW),
+    (IBProblemAttempts, PSET_ATTEMPT_ROW),
+    (Enrollment, ENROLLMENT_ROW),
+])
+def test_validate_df_valid(model, row):
+    df = make_df(row, problem_type="multiselect", response=["a", "b"]) \
+        if model is IBProblemAttempts else make_df(row)
+
+    validate_df(df, model)
+    validate_df_batch(df, model)
+    validate_df_rows(df, model)
+    validate_df(df.astype({
+        column: "category" for column in df.columns if column != "response"
+    }), model)
+
+
+@pytest.mark.parametrize("model,row,overrides,message", [
+    (Grade, GRADE_ROW, {"grade_percentage": float("nan")},
+     "Grade value is nan"),
+    (Grade, GRADE_ROW, {"grade_percentage": -4.0},
+     "Grade value is out of expected range"),
+    (Grade, GRADE_ROW, {"user_uuid": "not-a-uuid"},
+     "Input should be a valid UUID"),
+    (Grade, GRADE_ROW, {"time_submitted": 1.5},
+     "Input should be a valid int"),
+    (IBProblemAttempts, PSET_ATTEMPT_ROW, {"problem_type": "multiselect"},
+     "Response must be a list"),
+    (IBProblemAttempts, PSET_ATTEMPT_ROW, {"response": ["Option 1"]},
+     "Response must be a string"),
+    (IBProblemAttempts, PSET_ATTEMPT_ROW, {"correct": "maybe"},
+     "Input should be a valid bool"),
+    (IBProblemAttempts, PSET_ATTEMPT_ROW, {"variant": None},
+     "Input should be a valid str"),
+    (Enrollment, ENROLLMENT_ROW, {"role": "admin"},
+     "Input should be a valid"),
+])
+def test_validate_df_invalid(model, row, overrides, message):
+    """validate_df should reject the same rows as the pydantic reference
+    implementation and report the offending row labels
+    """
+    df = make_df(row, **overrides)
+
+    with pytest.raises(ValidationError):
+        validate_df_rows(df, model)
+    with pytest.raises(ModelValidationError, match=message) as exc_info:
+        validate_df(df, model)
+
+    assert [list(rows) for _, _, rows in exc_info.value.errors] == [[13]]
+
+    with pytest.raises(ModelValidationError) as exc_info:
+        validate_df_batch(df, model)
+
+    assert [list(rows) for _, _, rows in exc_info.value.errors] == [[13]]
+
+
+def test_validate_df_batch_collects_all_errors():
+    df = make_df(GRADE_ROW, grade_percentage=101.0)
+    df["course_id"] = df["course_id"].astype(object)
+    df.loc[11, "course_id"] = "one"
+
+    with pytest.raises(ModelValidationError) as exc_info:
+        validate_df_batch(df, Grade)
+
+    assert [
+        (column, list(rows)) for column, _, rows in exc_info.value.errors
+    ] == [("course_id", [11]), ("grade_percentage", [13])]
+
+
+def test_validator_modes():
+    with pytest.raises(ValueError):
+        Validator("unknown")
+    with pytest.raises(ValueError):
+        Validator(level="unknown")
+    with pytest.raises(ValueError):
+        Validator(level="sampled", sample_fraction=0.0)
+    with pytest.raises(ValidationError):
+        Validator("rows").validate(make_df(GRADE_ROW, course_id="1.5"), Grade)
+
+
+def test_validator_levels():
+    df = make_df(GRADE_ROW, count=20, grade_percentage=101.0)
+
+    Validator(level="off").validate(df, Grade)
+    Validator(level="schema").validate(df, Grade)
+    Validator(level="full", model_levels={Grade: "off"}).validate(df, Grade)
+    with pytest.raises(ModelValidationError, match="dtype object"):
+        Validator(level="schema").validate(
+            df.astype({"course_id": str}), Grade
+        )
+    with pytest.raises(ModelValidationError):
+        Validator(level="sampled", sample_fraction=1.0).validate(df, Grade)
+    with pytest.raises(ModelValidationError):
+        Validator(level="off", model_levels={Grade: "full"}).validate(
+            df, Grade
+        )
+
+    # Sampling is deterministic for a given seed
+    outcomes = set()
+    for _ in range(3):
+        try:
+            Validator(
+                level="sampled", sample_fraction=0.1, seed=3
+            ).validate(df, Grade)
+            outcomes.add("valid")
+        except ModelValidationError:
+            outcomes.add("invalid")
+    assert len(outcomes) == 1
+
+
+def test_validate_df_columns():
+    df = make_df(GRADE_ROW)
+    df["extra"] = 1
+
+    with pytest.raises(ModelValidationError, match="extra: Extra inputs"):
+        validate_df(df, Grade)
+    with pytest.raises(ModelValidationError, match="course_id: Field"):
+        validate_df(make_df(GRADE_ROW).drop(columns="course_id"), Grade)
+
+
+@pytest.mark.parametrize("validate", [
+    validate_df, validate_df_batch, validate_df_rows
+])
+def test_validate_df_response_is_str(validate):
+    """The response type is taken from response_is_str when it is set, and
+    the column is accepted next to the model fields
+    """
+    df = make_df(PSET_ATTEMPT_ROW, problem_type="multiselect",
+                 response=["a", "b"])
+    df["response_is_str"] = df["problem_type"] != "multiselect"
+    validate(df, IBProblemAttempts)
+
+    df.loc[13, "response_is_str"] = True
+    if validate is validate_df:
+        with pytest.raises(ModelValidationError,
+                           match="Response must be a list") as exc_info:
+            validate(df, IBProblemAttempts)
+        assert [list(rows) for _, _, rows in exc_info.value.errors] == [[13]]
+
+
+def test_validate_df_categorical_missing():
+    df = make_df(ENROLLMENT_ROW, role=None).astype({"role": "category"})
+
+    with pytest.raises(ModelValidationError) as exc_info:
+        validate_df(df, Enrollment)
+
+    assert [list(rows) for _, _, rows in exc_info.value.errors] == [[13]]
+
+
+def test_validate_df_compact_event_dtypes():
+    df = compact_event_df(make_df(PSET_ATTEMPT_ROW))
+    validate_df(df, IBProblemAttempts)
+
+    df = compact_event_df(make_df(PSET_ATTEMPT_ROW, impression_id=None))
+    assert df["impression_id"].dtype == "string[pyarrow]"
+    with pytest.raises(ModelValidationError) as exc_info:
+        validate_df(df, IBProblemAttempts)
+
+    assert [(column, list(rows)) for column, _, rows
+            in exc_info.value.errors] == [("impression_id", [13])]
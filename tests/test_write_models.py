@@ -0,0 +1,217 @@
+from enclave_mgmt import write_models
+from enclave_mgmt.collect_data import compact_event_df
+from enclave_mgmt.models import IBProblemAttempts, QuizAttempts, User
+from uuid import UUID
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pytest
+
+
+@pytest.fixture
+def pset_attempts_df():
+    return pd.DataFrame({
+        "user_uuid": [UUID("123e4567-e89b-12d3-a456-426655440000"),
+                      "123e4567-e89b-12d3-a456-426655440001"],
+        "course_id": [1, 2],
+        "impression_id": ["123e4567-e89b-12d3-a456-426655440002"] * 2,
+        "timestamp": [1630500000, 1630500001],
+        "content_id": ["123e4567-e89b-12d3-a456-426655440003"] * 2,
+        "pset_content_id": ["123e4567-e89b-12d3-a456-426655440004"] * 2,
+        "pset_problem_content_id":
+            ["123e4567-e89b-12d3-a456-426655440005"] * 2,
+        "variant": ["main", "main"],
+        "problem_type": ["input", "multiselect"],
+        "response": ["some input", ["red", "green"]],
+        "correct": [True, False],
+        "attempt": [1, 2],
+        "final_attempt": [False, True],
+    })
+
+
+def test_arrow_schema():
+    schema = write_models.arrow_schema(IBProblemAttempts)
+
+    assert schema.names == list(IBProblemAttempts.model_fields)
+    assert schema.field("course_id").type == pa.int64()
+    assert schema.field("correct").type == pa.bool_()
+    assert schema.field("user_uuid").type == pa.string()
+    assert schema.field("user_uuid").metadata == {b"model_type": b"UUID"}
+    assert schema.metadata == {b"model": b"IBProblemAttempts"}
+
+
+@pytest.mark.parametrize("output_format,read", [
+    ("parquet", pq.read_table),
+    ("arrow", feather.read_table),
+])
+@pytest.mark.parametrize("compact", [False, True])
+def test_write_models_typed_formats(
+    tmp_path, pset_attempts_df, output_format, read, compact
+):
+    if compact:
+        pset_attempts_df = compact_event_df(pset_attempts_df)
+    write_models.write_models(
+        tmp_path,
+        {"ib_pset_problem_attempts.csv": pset_attempts_df},
+        {"ib_pset_problem_attempts.csv": IBProblemAttempts},
+        [output_format]
+    )
+
+    table = read(tmp_path / f"ib_pset_problem_attempts.{output_format}")
+
+    assert table.schema.equals(
+        write_models.arrow_schema(IBProblemAttempts)
+    )
+    res = table.to_pandas()
+    assert res["user_uuid"].tolist() == [
+        "123e4567-e89b-12d3-a456-426655440000",
+        "123e4567-e89b-12d3-a456-426655440001"
+    ]
+    assert res["response"].tolist() == ["some input", '["red", "green"]']
+    assert res["correct"].dtype == bool
+
+
+def test_write_models_multiple_formats(tmp_path):
+    users_df = pd.DataFrame({
+        "uuid": ["123e4567-e89b-12d3-a456-426655440000"],
+        "first_name": ["Tony"],
+        "last_name": ["Soprano"],
+        "email": ["tsoprano@gabagool.com"]
+    })
+
+    write_models.write_models(
+        tmp_path, {"users.csv": users_df}, {"users.csv": User},
+        ["csv", "parquet", "arrow"]
+    )
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "users.arrow", "users.csv", "users.parquet"
+    ]
+    assert pd.read_csv(tmp_path / "users.csv").equals(
+        pd.read_parquet(tmp_path / "users.parquet")
+    )
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_write_models_report(tmp_path, pset_attempts_df, executor):
+    tables = {
+        f"table_{i}.csv": pset_attempts_df for i in range(4)
+    }
+    models = {file_name: IBProblemAttempts for file_name in tables}
+
+    report = write_models.write_models(
+        tmp_path, tables, models, ["csv", "parquet"],
+        max_workers=3, executor=executor
+    )
+
+    assert [(entry["file"], entry["format"]) for entry in report] == [
+        (f"table_{i}.{extension}", extension)
+        for i in range(4) for extension in ["csv", "parquet"]
+    ]
+    for entry in report:
+        assert entry["rows"] == 2
+        assert entry["bytes"] == (tmp_path / entry["file"]).stat().st_size
+        assert entry["seconds"] >= 0
+    assert len(list(tmp_path.iterdir())) == 8
+
+
+def test_write_models_atomic(mocker, tmp_path, pset_attempts_df):
+    """A failed write should leave neither a partial file nor a temporary
+    file behind and should not replace an existing output
+    """
+    (tmp_path / "ib_pset_problem_attempts.parquet").write_text("previous")
+
+    def write_partial_model(path, df, model, output_format):
+        with open(path, "w") as f:
+            f.write("partial")
+        raise OSError("No space left on device")
+
+    mocker.patch(
+        "enclave_mgmt.write_models.write_model", write_partial_model
+    )
+
+    with pytest.raises(OSError):
+        write_models.write_models(
+            tmp_path,
+            {"ib_pset_problem_attempts.csv": pset_attempts_df},
+            {"ib_pset_problem_attempts.csv": IBProblemAttempts},
+            ["parquet"]
+        )
+
+    assert [path.name for path in tmp_path.iterdir()] == [
+        "ib_pset_problem_attempts.parquet"
+    ]
+    assert (tmp_path / "ib_pset_problem_attempts.parquet").read_text() == \
+        "previous"
+
+
+@pytest.mark.parametrize("chunk_count", [0, 3])
+def test_write_models_chunks(tmp_path, pset_attempts_df, chunk_count):
+    tables = {
+        "ib_pset_problem_attempts.csv":
+            (pset_attempts_df for _ in range(chunk_count))
+    }
+    models = {"ib_pset_problem_attempts.csv": IBProblemAttempts}
+
+    report = write_models.write_models(
+        tmp_path, tables, models, ["csv", "parquet", "arrow"]
+    )
+
+    assert [entry["rows"] for entry in report] == [2 * chunk_count] * 3
+    csv = pd.read_csv(tmp_path / "ib_pset_problem_attempts.csv")
+    assert list(csv.columns) == list(IBProblemAttempts.model_fields)
+    for output_format, read in [
+        ("parquet", pq.read_table), ("arrow", feather.read_table)
+    ]:
+        table = read(tmp_path / f"ib_pset_problem_attempts.{output_format}")
+        assert table.schema.equals(
+            write_models.arrow_schema(IBProblemAttempts)
+        )
+        assert table.num_rows == 2 * chunk_count
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_write_models_chunks_atomic(tmp_path, pset_attempts_df):
+    def chunks():
+        yield pset_attempts_df
+        raise OSError("Connection reset")
+
+    with pytest.raises(OSError):
+        write_models.write_models(
+            tmp_path,
+            {"ib_pset_problem_attempts.csv": chunks()},
+            {"ib_pset_problem_attempts.csv": IBProblemAttempts},
+            ["csv", "parquet"]
+        )
+
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("output_format,read", [
+    ("parquet", pq.read_table),
+    ("arrow", feather.read_table),
+])
+@pytest.mark.parametrize("chunked", [False, True])
+def test_write_models_nan_float(tmp_path, output_format, read, chunked):
+    quiz_attempts_df = pd.DataFrame({
+        "id": [0, 1],
+        "assessment_id": [0, 0],
+        "user_uuid": ["123e4567-e89b-12d3-a456-426655440000"] * 2,
+        "course_id": [1, 1],
+        "attempt_number": [1, 2],
+        "grade_percentage": [50.0, float("nan")],
+        "time_started": [1630500000, 1630500001],
+        "time_finished": [1630500100, 0],
+    })
+    table = quiz_attempts_df if not chunked else iter([quiz_attempts_df])
+
+    write_models.write_models(
+        tmp_path, {"quiz_attempts.csv": table},
+        {"quiz_attempts.csv": QuizAttempts}, [output_format]
+    )
+
+    res = read(tmp_path / f"quiz_attempts.{output_format}")
+    assert res.schema.field("grade_percentage").nullable
+    assert not res.schema.field("course_id").nullable
+    pd.testing.assert_frame_equal(res.to_pandas(), quiz_attempts_df)